@@ -8,20 +8,173 @@
 
 #include <uvw.hpp>
 #include <bson.h>
+#include <algorithm>
+#include <chrono>
+#include <deque>
+#include <functional>
 #include <memory>
 #include <iostream>
+#include <map>
 #include <mutex>
+#include <set>
+#include <string>
+#include <utility>
+#include <vector>
+
+// zlib is needed to read compressed frames; without it they're refused
+#if __has_include(<zlib.h>)
+#include <zlib.h>
+#define HAVE_ZLIB 1
+#endif
 
 #define NETWORK_DEBUG true
 
+// disable Nagle's algorithm; we already batch writes ourselves (see UvClient::flush)
+#define NETWORK_NO_DELAY true
+
 #ifndef streq
 #define streq(a, b) (!strcmp(a, b))
 #endif
 
 #define PUBLISH_TID 0
 
+// A frame with this tid is a batch: its body is a sequence of ordinary frames
+#define BATCH_TID 0xFFFFFFFF
+
+// The top bit of a frame's length marks a zlib-compressed body, the next one a
+// chunk: a piece of a larger frame (header included) with the same tid, sent so
+// that smaller frames can go out between its pieces, and the next a trace extension
+// between the header and the body (counted in the length; see py/tracing.py)
+#define COMPRESSED_FLAG 0x80000000
+#define CHUNK_FLAG 0x40000000
+#define TRACE_FLAG 0x20000000
+#define LENGTH_MASK 0x1FFFFFFF
+
+// trace_id and sent_at_us (64 bits each, echoed back as they came), then when we
+// started decoding the request, called its handler and queued the reply, in 32-bit
+// microseconds since we read it
+#define TRACE_EXTENSION_SIZE 28
+
+// compressed bodies that would inflate to more than this are refused
+#define MAX_DECOMPRESSED_SIZE (64 * 1024 * 1024)
+
 #define BROADCAST_DELAY_MS 1000
 
+// A client with more than this many bytes of writes outstanding isn't keeping up.
+// Until they drain to the low water mark we stop reading its requests and hold
+// back its broadcasts, keeping only the latest of each cmd.
+#define SEND_HIGH_WATER (1024 * 1024)
+#define SEND_LOW_WATER (256 * 1024)
+
+// clients with more than this outstanding are disconnected
+#define MAX_SEND_QUEUE (64 * 1024 * 1024)
+
+// How many connections the OS holds for us until we accept them (capped by its own
+// limit); enough for every client reconnecting at once after a restart
+#define DEFAULT_LISTEN_BACKLOG 1024
+
+// max_accept_rate is enforced over intervals this long
+#define ACCEPT_RATE_INTERVAL_MS 100
+
+// An encoded message (header and body) that can be shared between clients
+typedef std::shared_ptr<const std::vector<char>> SharedFrame;
+
+void append_frame(std::vector<char> &buffer, uint32_t tid, const uint8_t *msg, size_t length) {
+    uint32_t header[2] = { htonl(tid), htonl(length) };
+    auto header_data = reinterpret_cast<const char *>(header);
+    auto msg_data = reinterpret_cast<const char *>(msg);
+    buffer.insert(buffer.end(), header_data, header_data + sizeof(header));
+    buffer.insert(buffer.end(), msg_data, msg_data + length);
+}
+
+// A traced request's trace extension, and when we read it
+struct Trace {
+    uint64_t trace_id;
+    uint64_t sent_at_us;
+    uint32_t decode_started_us;
+    uint32_t dispatched_us;
+    uint32_t enqueued_us;
+    std::chrono::steady_clock::time_point received_at;
+
+    uint32_t since_received_us() const {
+        auto elapsed = std::chrono::duration_cast<std::chrono::microseconds>(
+            std::chrono::steady_clock::now() - received_at).count();
+        return static_cast<uint32_t>(std::min<int64_t>(std::max<int64_t>(elapsed, 0), UINT32_MAX));
+    }
+};
+
+static uint64_t read_uint64(const uint8_t *data) {
+    uint64_t value = 0;
+    for (int i = 0; i < 8; i++) value = (value << 8) | data[i];
+    return value;
+}
+
+static void append_uint64(std::vector<char> &buffer, uint64_t value) {
+    for (int shift = 56; shift >= 0; shift -= 8) buffer.push_back(static_cast<char>(value >> shift));
+}
+
+static void append_uint32(std::vector<char> &buffer, uint32_t value) {
+    uint32_t network = htonl(value);
+    auto data = reinterpret_cast<const char *>(&network);
+    buffer.insert(buffer.end(), data, data + sizeof(network));
+}
+
+Trace read_trace(const uint8_t *extension, std::chrono::steady_clock::time_point received_at) {
+    Trace trace;
+    trace.trace_id = read_uint64(extension);
+    trace.sent_at_us = read_uint64(extension + 8);
+    trace.decode_started_us = 0;
+    trace.dispatched_us = 0;
+    trace.enqueued_us = 0;
+    trace.received_at = received_at;
+    return trace;
+}
+
+// Like append_frame(), but with trace's extension between the header and the body
+void append_traced_frame(std::vector<char> &buffer, uint32_t tid, const Trace &trace,
+                         const uint8_t *msg, size_t length) {
+    append_uint32(buffer, tid);
+    append_uint32(buffer, (TRACE_EXTENSION_SIZE + length) | TRACE_FLAG);
+    append_uint64(buffer, trace.trace_id);
+    append_uint64(buffer, trace.sent_at_us);
+    append_uint32(buffer, trace.decode_started_us);
+    append_uint32(buffer, trace.dispatched_us);
+    append_uint32(buffer, trace.enqueued_us);
+    auto msg_data = reinterpret_cast<const char *>(msg);
+    buffer.insert(buffer.end(), msg_data, msg_data + length);
+}
+
+SharedFrame build_frame(uint32_t tid, const uint8_t *msg, size_t length) {
+    auto frame = std::make_shared<std::vector<char>>();
+    append_frame(*frame, tid, msg, length);
+    return frame;
+}
+
+// Inflates a compressed frame body into out; returns false if it's invalid or too big
+bool decompress_body(const uint8_t *body, size_t length, std::vector<uint8_t> &out) {
+#ifdef HAVE_ZLIB
+    z_stream stream = {};
+    if (inflateInit(&stream) != Z_OK) return false;
+    stream.next_in = const_cast<Bytef *>(body);
+    stream.avail_in = length;
+    int result = Z_OK;
+    while (result == Z_OK && out.size() < MAX_DECOMPRESSED_SIZE) {
+        size_t used = out.size();
+        size_t chunk = std::min<size_t>(64 * 1024, MAX_DECOMPRESSED_SIZE - used);
+        out.resize(used + chunk);
+        stream.next_out = reinterpret_cast<Bytef *>(out.data() + used);
+        stream.avail_out = chunk;
+        result = inflate(&stream, Z_NO_FLUSH);
+        out.resize(used + chunk - stream.avail_out);
+    }
+    inflateEnd(&stream);
+    return result == Z_STREAM_END;
+#else
+    std::cout << "Can't read compressed message: built without zlib" << std::endl;
+    return false;
+#endif
+}
+
 void dump_vector(std::vector<char> buffer) {
     for (auto const& c : buffer) {
         std::cout << std::hex << (int) c;
@@ -29,13 +182,130 @@ void dump_vector(std::vector<char> buffer) {
     std::cout << std::dec << std::endl;
 }
 
-class UvClient {
+// The cmd of an encoded message, or "" if it has none
+std::string message_cmd(const uint8_t *msg, size_t length) {
+    bson_t b;
+    bson_iter_t iter;
+    if (bson_init_static(&b, msg, length) && bson_iter_init_find(&iter, &b, "cmd")
+            && BSON_ITER_HOLDS_UTF8(&iter)) {
+        return bson_iter_utf8(&iter, NULL);
+    }
+    return "";
+}
+
+// Sends an encoded message to every client
+typedef std::function<void(const uint8_t *msg, size_t length)> Broadcaster;
+
+// A broadcast's topic is its cmd. Clients subscribe to patterns: a topic itself, or
+// one ending in TOPIC_WILDCARD that matches every topic starting with what comes
+// before it ("news.*" matches "news.sport", and "*" matches everything).
+#define TOPIC_WILDCARD '*'
+
+class UvClient;
+typedef std::shared_ptr<UvClient> ClientPtr;
+
+// Which clients want which broadcasts, so that publishing only looks at the ones
+// that do: one lookup for the topic and one per prefix of it for wildcards. Clients
+// that have never subscribed get everything, as they did before subscriptions;
+// once a client subscribes it only gets what it subscribed to.
+class TopicIndex {
     public:
-        UvClient(std::shared_ptr<uvw::TCPHandle> tcp) {
+        // Adds a client that gets everything until it subscribes to something
+        void add(ClientPtr client) {
+            std::lock_guard<std::mutex> guard(lock);
+            receives_all.insert(client);
+        }
+
+        void subscribe(ClientPtr client, const std::string &pattern) {
+            std::lock_guard<std::mutex> guard(lock);
+            receives_all.erase(client);
+            if (!patterns[client].insert(pattern).second) return;
+            index_for(pattern)[key_for(pattern)].insert(client);
+        }
+
+        // Unsubscribing from something never subscribed to still stops the client
+        // getting everything
+        void unsubscribe(ClientPtr client, const std::string &pattern) {
+            std::lock_guard<std::mutex> guard(lock);
+            receives_all.erase(client);
+            if (patterns[client].erase(pattern) == 0) return;
+            remove_from_index(client, pattern);
+        }
+
+        // Forgets a client altogether, e.g. once it's disconnected
+        void remove(ClientPtr client) {
+            std::lock_guard<std::mutex> guard(lock);
+            receives_all.erase(client);
+            auto found = patterns.find(client);
+            if (found == patterns.end()) return;
+            for (auto const& pattern : found->second) remove_from_index(client, pattern);
+            patterns.erase(found);
+        }
+
+        std::vector<std::string> patterns_of(ClientPtr client) {
+            std::lock_guard<std::mutex> guard(lock);
+            auto found = patterns.find(client);
+            if (found == patterns.end()) return {};
+            return std::vector<std::string>(found->second.begin(), found->second.end());
+        }
+
+        std::set<ClientPtr> subscribers(const std::string &topic) {
+            std::lock_guard<std::mutex> guard(lock);
+            std::set<ClientPtr> result(receives_all);
+            auto exact = by_topic.find(topic);
+            if (exact != by_topic.end()) result.insert(exact->second.begin(), exact->second.end());
+            if (!by_prefix.empty()) {
+                for (size_t end = 0; end <= topic.size(); end++) {
+                    auto found = by_prefix.find(topic.substr(0, end));
+                    if (found != by_prefix.end()) {
+                        result.insert(found->second.begin(), found->second.end());
+                    }
+                }
+            }
+            return result;
+        }
+
+    private:
+        typedef std::map<std::string, std::set<ClientPtr>> Index;
+        std::set<ClientPtr> receives_all;
+        // topic -> clients subscribed to exactly that topic
+        Index by_topic;
+        // prefix -> clients subscribed to prefix followed by the wildcard
+        Index by_prefix;
+        // client -> the patterns it's subscribed to, once it's subscribed
+        std::map<ClientPtr, std::set<std::string>> patterns;
+        std::mutex lock;
+
+        static bool is_wildcard(const std::string &pattern) {
+            return !pattern.empty() && pattern.back() == TOPIC_WILDCARD;
+        }
+
+        Index &index_for(const std::string &pattern) {
+            return is_wildcard(pattern) ? by_prefix : by_topic;
+        }
+
+        static std::string key_for(const std::string &pattern) {
+            return is_wildcard(pattern) ? pattern.substr(0, pattern.size() - 1) : pattern;
+        }
+
+        void remove_from_index(ClientPtr client, const std::string &pattern) {
+            auto &index = index_for(pattern);
+            auto found = index.find(key_for(pattern));
+            if (found == index.end()) return;
+            found->second.erase(client);
+            if (found->second.empty()) index.erase(found);
+        }
+};
+
+class UvClient : public std::enable_shared_from_this<UvClient> {
+    public:
+        UvClient(std::shared_ptr<uvw::TCPHandle> tcp, Broadcaster broadcast, TopicIndex &topics)
+                : topics(topics) {
             // TODO: would prefer to have a pointer to a function just for sending X bytes
             // But my C++ foo is not strong enough yet to be sure whether that is safe.
             // So for now let's stash the whole TCPHandle.
             this->tcp = tcp;
+            this->broadcast = broadcast;
         }
 
         void onEnd(const uvw::EndEvent &, uvw::TCPHandle &client) {
@@ -45,6 +315,8 @@ class UvClient {
         void onData(const uvw::DataEvent &event, uvw::TCPHandle &client) {
             if (NETWORK_DEBUG) std::cout << "client on data " << event.length << std::endl;
             lock.lock();
+            // traced requests' timings are measured from here
+            read_at = std::chrono::steady_clock::now();
             auto data = &event.data[0];
             recv_buffer.insert(recv_buffer.end(), data, data + event.length);
             if (NETWORK_DEBUG) dump_vector(recv_buffer);
@@ -55,6 +327,10 @@ class UvClient {
                         uint32_t * recv_buffer_start = reinterpret_cast<uint32_t *>(recv_buffer.data());
                         msg_tid = htonl(recv_buffer_start[0]);
                         msg_len = htonl(recv_buffer_start[1]);
+                        msg_compressed = (msg_len & COMPRESSED_FLAG) != 0;
+                        msg_chunk = (msg_len & CHUNK_FLAG) != 0;
+                        msg_traced = (msg_len & TRACE_FLAG) != 0;
+                        msg_len &= LENGTH_MASK;
                         if (NETWORK_DEBUG) {
                             std::cout << "read tid " << msg_tid << std::endl;
                             std::cout << "read len " << msg_len << std::endl;
@@ -67,48 +343,17 @@ class UvClient {
                     std::cout << "message: tid=" << msg_tid << ", len=" << msg_len << std::endl;
                     uint8_t * buff_start = reinterpret_cast<uint8_t *>(&recv_buffer[0]);
 
-                    char *cmd = NULL;
-                    int32_t counter = 0;
-
-                    bson_t *b;
-                    b = bson_new_from_data(buff_start, msg_len);
-                    if (!b) {
-                        fprintf(stderr, "The specified length embedded in <my_data> did not match "
-                                            "<my_data_len>\n");
-                        //TODO some kind of error handling?
+                    bool valid = msg_chunk
+                        ? handle_chunk(msg_tid, buff_start, msg_len)
+                        : handle_frame(msg_tid, msg_compressed, msg_traced, buff_start, msg_len);
+                    if (!valid) {
+                        // there's no telling where the next frame starts
+                        lock.unlock();
+                        client.close();
                         return;
                     }
-                    bson_iter_t iter;
-                    if (bson_iter_init(&iter, b)) {
-                        while (bson_iter_next(&iter)) {
-                            const char *key = bson_iter_key(&iter);
-                            printf("Found element key: \"%s\" of type %#04x\n", bson_iter_key(&iter), bson_iter_type(&iter));
-                            if (streq(key, "cmd") && BSON_ITER_HOLDS_UTF8(&iter)) {
-                                cmd = bson_iter_dup_utf8(&iter, NULL);
-                            } else if (streq(key, "pingpong-counter") && BSON_ITER_HOLDS_INT32(&iter)) {
-                                counter = bson_iter_int32(&iter);
-                            }
-                        }
-                    }
-                    bson_destroy(b);
                     recv_buffer.erase(recv_buffer.begin(), recv_buffer.begin() + msg_len);
 
-                    bson_t reply = BSON_INITIALIZER;
-                    if streq(cmd, "ping") {
-                        std::cout << "Recognized ping! Received counter is " << counter << std::endl;
-                        counter++;
-                        std::cout << "Sending ping back! New counter is " << counter << std::endl;
-
-                        BSON_APPEND_UTF8(&reply, "cmd", "pong");
-                        BSON_APPEND_INT32 (&reply, "pingpong-counter", counter);
-                    } else {
-                        std::cout << "Unrecognized cmd: " << cmd << std::endl;
-                    }
-
-                    uint32_t reply_length;
-                    uint8_t *reply_data = bson_destroy_with_steal(&reply, true, &reply_length);
-                    write_message(msg_tid, reply_data, reply_length);
-
                     msg_tid = 0;
                     msg_len = 0;
                 } else {
@@ -116,34 +361,320 @@ class UvClient {
                 }
             }
 
+            // replies to everything that arrived in this read go out together
+            flush();
             lock.unlock();
         }
 
-        void publish(uint8_t *msg, size_t length) {
-            write_message(PUBLISH_TID, msg, length);
+        // Sends a frame that may also be being sent to other clients. While the
+        // client is backlogged it replaces any held back frame with the same cmd.
+        void publish(SharedFrame frame, const std::string &cmd) {
+            if (backlogged) {
+                for (auto &held : held_broadcasts) {
+                    if (held.first == cmd) {
+                        held.second = frame;
+                        return;
+                    }
+                }
+                held_broadcasts.emplace_back(cmd, frame);
+                return;
+            }
+            flush();
+            write_frame(frame);
+        }
+
+        void onWrite(const uvw::WriteEvent &, uvw::TCPHandle &) {
+            // libuv completes writes in the order they were made
+            if (in_flight.empty()) return;
+            queued_bytes -= in_flight.front()->size();
+            in_flight.pop_front();
+
+            if (backlogged && queued_bytes <= SEND_LOW_WATER) {
+                std::cout << "Client caught up; resuming" << std::endl;
+                backlogged = false;
+                tcp->read();
+                auto held = std::move(held_broadcasts);
+                held_broadcasts.clear();
+                for (auto &broadcast : held) write_frame(broadcast.second);
+            }
+        }
+
+        // Failed and cancelled writes are reported as ErrorEvents, which we can't
+        // tell apart from read errors, so we can't pop them as they happen. Instead
+        // errors close the handle, and by the time the close is reported libuv has
+        // finished with every write, so everything left can go. Releasing the handle
+        // also breaks the reference cycle between it and its listeners.
+        void onClose() {
+            in_flight.clear();
+            held_broadcasts.clear();
+            tcp.reset();
         }
 
     private:
         std::shared_ptr<uvw::TCPHandle> tcp;
+        Broadcaster broadcast;
+        TopicIndex &topics;
         std::vector<char> recv_buffer;
+        std::vector<char> send_buffer;
+        // frames being written; kept alive until libuv is done with them
+        std::deque<SharedFrame> in_flight;
+        // total size of the frames in in_flight
+        size_t queued_bytes = 0;
+        bool backlogged = false;
+        // (cmd, frame) for broadcasts held back while backlogged
+        std::vector<std::pair<std::string, SharedFrame>> held_broadcasts;
         std::mutex lock;
 
         uint32_t msg_tid = 0;
         uint32_t msg_len = 0;
+        bool msg_compressed = false;
+        bool msg_chunk = false;
+        bool msg_traced = false;
+        // when the data being handled was read
+        std::chrono::steady_clock::time_point read_at;
+        // tid -> what's arrived so far of a frame being sent in chunks
+        std::map<uint32_t, std::vector<uint8_t>> partial_frames;
+
+        // Adds a chunk to the frame it's part of, handling that once it's complete.
+        // Returns false if the chunks don't add up to a valid frame.
+        bool handle_chunk(uint32_t tid, const uint8_t *body, size_t length) {
+            auto &partial = partial_frames[tid];
+            partial.insert(partial.end(), body, body + length);
+            if (partial.size() < sizeof(uint32_t) * 2) return true;
+
+            const uint32_t *header = reinterpret_cast<const uint32_t *>(partial.data());
+            uint32_t frame_length = ntohl(header[1]);
+            size_t body_length = frame_length & LENGTH_MASK;
+            if (ntohl(header[0]) != tid || (frame_length & CHUNK_FLAG) != 0
+                    || body_length > MAX_DECOMPRESSED_SIZE) {
+                return false;
+            }
+            if (partial.size() < sizeof(uint32_t) * 2 + body_length) return true;
+            if (partial.size() > sizeof(uint32_t) * 2 + body_length) return false;
+
+            auto frame = std::move(partial);
+            partial_frames.erase(tid);
+            bool compressed = (frame_length & COMPRESSED_FLAG) != 0;
+            bool traced = (frame_length & TRACE_FLAG) != 0;
+            return handle_frame(tid, compressed, traced, frame.data() + sizeof(uint32_t) * 2, body_length);
+        }
+
+        // Handles a frame's body (trace extension included, if it's traced), queuing
+        // any replies. Returns false if it's malformed.
+        bool handle_frame(uint32_t tid, bool compressed, bool traced, const uint8_t *body, size_t length) {
+            Trace trace;
+            if (traced) {
+                if (length < TRACE_EXTENSION_SIZE) return false;
+                trace = read_trace(body, read_at);
+                body += TRACE_EXTENSION_SIZE;
+                length -= TRACE_EXTENSION_SIZE;
+            }
+            std::vector<uint8_t> inflated;
+            if (compressed) {
+                if (!decompress_body(body, length, inflated)) return false;
+                body = inflated.data();
+                length = inflated.size();
+            }
+            // a batch's own trace is ignored; the frames in it carry their own
+            if (tid == BATCH_TID) return handle_batch(body, length);
+            handle_message(tid, body, length, send_buffer, traced ? &trace : NULL);
+            return true;
+        }
 
-        void write_message(uint32_t tid, uint8_t *msg, size_t length) {
-            uint32_t tid_network = ntohl(tid);
-            uint32_t length_network = ntohl(length);
-            tcp->write(reinterpret_cast<char *>(&tid_network), sizeof(uint32_t));
-            tcp->write(reinterpret_cast<char *>(&length_network), sizeof(uint32_t));
-            tcp->write(reinterpret_cast<char *>(msg), length);
-            std::cout << "Client sent data; total bytes=" << (sizeof(uint32_t) * 2 + length) << std::endl;
+        // Handles each frame in a batch, replying with a batch of the replies.
+        // Returns false if the batch is malformed.
+        bool handle_batch(const uint8_t *body, size_t length) {
+            std::vector<char> replies;
+            size_t reply_count = 0;
+            size_t offset = 0;
+            while (offset < length) {
+                if (length - offset < sizeof(uint32_t) * 2) return false;
+                const uint32_t *header = reinterpret_cast<const uint32_t *>(body + offset);
+                uint32_t tid = ntohl(header[0]);
+                uint32_t len = ntohl(header[1]) & LENGTH_MASK;
+                bool compressed = (ntohl(header[1]) & COMPRESSED_FLAG) != 0;
+                bool chunk = (ntohl(header[1]) & CHUNK_FLAG) != 0;
+                bool traced = (ntohl(header[1]) & TRACE_FLAG) != 0;
+                offset += sizeof(uint32_t) * 2;
+                if (tid == BATCH_TID || chunk || length - offset < len) return false;
+
+                const uint8_t *msg = body + offset;
+                size_t msg_length = len;
+                Trace trace;
+                if (traced) {
+                    if (msg_length < TRACE_EXTENSION_SIZE) return false;
+                    trace = read_trace(msg, read_at);
+                    msg += TRACE_EXTENSION_SIZE;
+                    msg_length -= TRACE_EXTENSION_SIZE;
+                }
+                std::vector<uint8_t> inflated;
+                if (compressed) {
+                    if (!decompress_body(msg, msg_length, inflated)) return false;
+                    msg = inflated.data();
+                    msg_length = inflated.size();
+                }
+                if (handle_message(tid, msg, msg_length, replies, traced ? &trace : NULL)) {
+                    reply_count++;
+                }
+                offset += len;
+            }
+            if (reply_count > 1) {
+                append_frame(send_buffer, BATCH_TID, reinterpret_cast<uint8_t *>(replies.data()), replies.size());
+            } else {
+                send_buffer.insert(send_buffer.end(), replies.begin(), replies.end());
+            }
+            return true;
+        }
+
+        // Appends the framed reply to msg (if any) to replies; returns whether it did.
+        // If the request was traced, so is the reply, with our timings filled in.
+        bool handle_message(uint32_t tid, const uint8_t *msg, size_t length,
+                            std::vector<char> &replies, Trace *trace) {
+            if (trace) trace->decode_started_us = trace->since_received_us();
+            char *cmd = NULL;
+            int32_t counter = 0;
+            // the patterns in a subscribe or unsubscribe request
+            std::vector<std::string> patterns;
+            bool patterns_valid = false;
+
+            bson_t *b;
+            b = bson_new_from_data(msg, length);
+            if (!b) {
+                fprintf(stderr, "The specified length embedded in <my_data> did not match "
+                                    "<my_data_len>\n");
+                //TODO some kind of error handling?
+                return false;
+            }
+            bson_iter_t iter;
+            if (bson_iter_init(&iter, b)) {
+                while (bson_iter_next(&iter)) {
+                    const char *key = bson_iter_key(&iter);
+                    printf("Found element key: \"%s\" of type %#04x\n", bson_iter_key(&iter), bson_iter_type(&iter));
+                    if (streq(key, "cmd") && BSON_ITER_HOLDS_UTF8(&iter)) {
+                        cmd = bson_iter_dup_utf8(&iter, NULL);
+                    } else if (streq(key, "pingpong-counter") && BSON_ITER_HOLDS_INT32(&iter)) {
+                        counter = bson_iter_int32(&iter);
+                    } else if (streq(key, "topics") && BSON_ITER_HOLDS_ARRAY(&iter)) {
+                        patterns_valid = read_patterns(&iter, patterns);
+                    }
+                }
+            }
+            bson_destroy(b);
+
+            if (cmd == NULL) {
+                std::cout << "Message without a cmd" << std::endl;
+                return false;
+            }
+            if (trace) trace->dispatched_us = trace->since_received_us();
+
+            bson_t reply = BSON_INITIALIZER;
+            if streq(cmd, "ping") {
+                std::cout << "Recognized ping! Received counter is " << counter << std::endl;
+                counter++;
+                std::cout << "Sending ping back! New counter is " << counter << std::endl;
+
+                BSON_APPEND_UTF8(&reply, "cmd", "pong");
+                BSON_APPEND_INT32 (&reply, "pingpong-counter", counter);
+            } else if streq(cmd, "broadcast") {
+                // sends the message on to every client, this one included
+                broadcast(msg, length);
+                BSON_APPEND_UTF8(&reply, "cmd", "broadcast");
+                BSON_APPEND_BOOL(&reply, "success", true);
+            } else if (streq(cmd, "subscribe") || streq(cmd, "unsubscribe")) {
+                BSON_APPEND_UTF8(&reply, "cmd", cmd);
+                BSON_APPEND_BOOL(&reply, "success", patterns_valid);
+                if (patterns_valid) {
+                    for (auto const& pattern : patterns) {
+                        if streq(cmd, "subscribe") {
+                            topics.subscribe(shared_from_this(), pattern);
+                        } else {
+                            topics.unsubscribe(shared_from_this(), pattern);
+                        }
+                    }
+                    append_patterns(&reply, topics.patterns_of(shared_from_this()));
+                } else {
+                    BSON_APPEND_UTF8(&reply, "error", "topics must be a list of strings");
+                }
+            } else if streq(cmd, "codec") {
+                // we only speak BSON, whatever the client would prefer
+                BSON_APPEND_UTF8(&reply, "cmd", "codec");
+                BSON_APPEND_UTF8(&reply, "codec", "bson");
+            } else {
+                std::cout << "Unrecognized cmd: " << cmd << std::endl;
+            }
+            bson_free(cmd);
+
+            uint32_t reply_length;
+            uint8_t *reply_data = bson_destroy_with_steal(&reply, true, &reply_length);
+            if (trace) {
+                trace->enqueued_us = trace->since_received_us();
+                append_traced_frame(replies, tid, *trace, reply_data, reply_length);
+            } else {
+                append_frame(replies, tid, reply_data, reply_length);
+            }
+            bson_free(reply_data);
+            return true;
+        }
+
+        // Reads an array of strings into patterns; returns false if it holds anything else
+        static bool read_patterns(const bson_iter_t *array, std::vector<std::string> &patterns) {
+            bson_iter_t child;
+            if (!bson_iter_recurse(array, &child)) return false;
+            while (bson_iter_next(&child)) {
+                if (!BSON_ITER_HOLDS_UTF8(&child)) return false;
+                patterns.push_back(bson_iter_utf8(&child, NULL));
+            }
+            return true;
+        }
+
+        static void append_patterns(bson_t *reply, const std::vector<std::string> &patterns) {
+            bson_t array;
+            BSON_APPEND_ARRAY_BEGIN(reply, "topics", &array);
+            for (size_t i = 0; i < patterns.size(); i++) {
+                char index_buffer[16];
+                const char *index_key;
+                bson_uint32_to_string(i, &index_key, index_buffer, sizeof(index_buffer));
+                BSON_APPEND_UTF8(&array, index_key, patterns[i].c_str());
+            }
+            bson_append_array_end(reply, &array);
+        }
+
+        // Sends every message queued since the last flush as one write
+        void flush() {
+            if (send_buffer.empty()) return;
+            auto frame = std::make_shared<const std::vector<char>>(std::move(send_buffer));
+            send_buffer.clear();
+            write_frame(frame);
+        }
+
+        void write_frame(SharedFrame frame) {
+            if (!tcp || tcp->closing()) return;
+            if (queued_bytes + frame->size() > MAX_SEND_QUEUE) {
+                std::cout << "Client send queue full; disconnecting" << std::endl;
+                tcp->close();
+                return;
+            }
+            in_flight.push_back(frame);
+            queued_bytes += frame->size();
+            tcp->write(const_cast<char *>(frame->data()), frame->size());
+            std::cout << "Client sent data; total bytes=" << frame->size() << std::endl;
+
+            if (!backlogged && queued_bytes > SEND_HIGH_WATER) {
+                std::cout << "Client not keeping up; pausing" << std::endl;
+                backlogged = true;
+                tcp->stop();
+            }
         }
 };
 
 class UvServer {
     public:
-        UvServer();
+        // Once max_connections clients are connected (0 for no limit), new
+        // connections are closed as soon as they're accepted, and no more than
+        // max_accept_rate connections are accepted per second (0 for no limit; the
+        // rest wait in the backlog)
+        UvServer(int listen_backlog = DEFAULT_LISTEN_BACKLOG, size_t max_connections = 0,
+                 unsigned int max_accept_rate = 0);
         ~UvServer();
         void listen(const char *host, int port);
         void startBroadcasting();
@@ -152,12 +683,29 @@ class UvServer {
         void publish(const uint8_t *msg, size_t length);
     private:
         std::list<std::shared_ptr<UvClient>> clients;
+        TopicIndex topics;
         std::shared_ptr<uvw::Loop> loop;
         std::mutex lock;
+
+        int listen_backlog;
+        size_t max_connections;
+        unsigned int accepts_per_interval;
+        uint64_t accept_interval_started_at = 0;
+        unsigned int accepts_this_interval = 0;
+        // accepts the connection left waiting when the rate limit was reached
+        std::shared_ptr<uvw::TimerHandle> accept_timer;
+
+        bool takeAcceptToken();
+        void acceptConnection(uvw::TCPHandle &srv);
 };
 
-UvServer::UvServer() {
+UvServer::UvServer(int listen_backlog, size_t max_connections, unsigned int max_accept_rate)
+        : listen_backlog(listen_backlog), max_connections(max_connections) {
     loop = uvw::Loop::create();
+    accepts_per_interval = 0;
+    if (max_accept_rate > 0) {
+        accepts_per_interval = std::max(max_accept_rate * ACCEPT_RATE_INTERVAL_MS / 1000, 1u);
+    }
 }
 
 UvServer::~UvServer() {
@@ -166,48 +714,104 @@ UvServer::~UvServer() {
     loop->close();
 }
 
+// libuv calls the listen callback for each waiting connection until there are none
+// left, and stops watching the listening socket while one is left unaccepted; that's
+// how the rate limit holds connections back. (It also sets SO_REUSEADDR itself, so
+// a restarted server can listen again straight away.)
 void UvServer::listen(const char *host, int port) {
     std::shared_ptr<uvw::TCPHandle> tcp = loop->resource<uvw::TCPHandle>();
 
     tcp->on<uvw::ListenEvent>([this](const uvw::ListenEvent &, uvw::TCPHandle &srv) {
-        std::shared_ptr<uvw::TCPHandle> tcpClient = srv.loop().resource<uvw::TCPHandle>();
-        auto peer = tcpClient->peer();
-        std::cout << "accepted " << tcpClient << " " << peer.ip << ":" << peer.port << std::endl;
-
-        auto client = std::make_shared<UvClient>(tcpClient);
-        tcpClient->on<uvw::CloseEvent>([this, client](const uvw::CloseEvent &, uvw::TCPHandle &tcpClient) {
-            auto peer = tcpClient.peer();
-            std::cout << "close " << &tcpClient << " " << peer.ip << ":" << peer.port << std::endl;
-            lock.lock();
-            clients.remove(client);
-            lock.unlock();
-        });
-        tcpClient->on<uvw::ErrorEvent>([client](const uvw::ErrorEvent &event, uvw::TCPHandle &tcpClient) {
-            auto peer = tcpClient.peer();
-            std::cout << "error " << &tcpClient << " " << peer.ip << ":" << peer.port;
-            std::cout << "; details: code=" << event.code() << " name=" << event.name() << std::endl;
-        });
-        tcpClient->on<uvw::EndEvent>([client](const uvw::EndEvent &event, uvw::TCPHandle &tcpClient) {
-            client->onEnd(event, tcpClient);
-        });
-        tcpClient->on<uvw::DataEvent>([client](const uvw::DataEvent &event, uvw::TCPHandle &tcpClient) {
-            client->onData(event, tcpClient);
-        });
-        tcpClient->on<uvw::WriteEvent>([client](const uvw::WriteEvent &event, uvw::TCPHandle &tcpClient) {
-            auto peer = tcpClient.peer();
-            if (NETWORK_DEBUG) std::cout << "wrote to " << &tcpClient << " " << peer.ip << ":" << peer.port << std::endl;
+        if (accepts_per_interval > 0 && !takeAcceptToken()) {
+            uint64_t until_next_interval = accept_interval_started_at + ACCEPT_RATE_INTERVAL_MS - loop->now().count();
+            std::cout << "Accept rate limit reached; pausing accepts" << std::endl;
+            accept_timer->start(std::chrono::milliseconds(until_next_interval), std::chrono::milliseconds(0));
+            return;
+        }
+        acceptConnection(srv);
+    });
+
+    if (accepts_per_interval > 0) {
+        accept_timer = loop->resource<uvw::TimerHandle>();
+        accept_timer->on<uvw::TimerEvent>([this, tcp](const uvw::TimerEvent &, uvw::TimerHandle &) {
+            // a new interval has begun, so the waiting connection can be let in;
+            // accepting it has libuv watch for the rest again
+            takeAcceptToken();
+            acceptConnection(*tcp);
         });
+    }
 
-        lock.lock();
-        clients.push_back(client);
-        lock.unlock();
+    tcp->bind(host, port);
+    tcp->listen(listen_backlog);
+}
 
+// Returns whether the rate limit allows accepting another connection now
+bool UvServer::takeAcceptToken() {
+    uint64_t now = loop->now().count();
+    if (now - accept_interval_started_at >= ACCEPT_RATE_INTERVAL_MS) {
+        accept_interval_started_at = now;
+        accepts_this_interval = 0;
+    }
+    if (accepts_this_interval >= accepts_per_interval) return false;
+    accepts_this_interval++;
+    return true;
+}
+
+void UvServer::acceptConnection(uvw::TCPHandle &srv) {
+    std::shared_ptr<uvw::TCPHandle> tcpClient = srv.loop().resource<uvw::TCPHandle>();
+    lock.lock();
+    bool at_capacity = max_connections > 0 && clients.size() >= max_connections;
+    lock.unlock();
+    if (at_capacity) {
+        // it has to be accepted for libuv to carry on with the rest
         srv.accept(*tcpClient);
-        tcpClient->read();
+        std::cout << "Rejecting connection: too many clients" << std::endl;
+        tcpClient->close();
+        return;
+    }
+
+    auto peer = tcpClient->peer();
+    std::cout << "accepted " << tcpClient << " " << peer.ip << ":" << peer.port << std::endl;
+
+    auto client = std::make_shared<UvClient>(tcpClient, [this](const uint8_t *msg, size_t length) {
+        publish(msg, length);
+    }, topics);
+    tcpClient->on<uvw::CloseEvent>([this, client](const uvw::CloseEvent &, uvw::TCPHandle &tcpClient) {
+        auto peer = tcpClient.peer();
+        std::cout << "close " << &tcpClient << " " << peer.ip << ":" << peer.port << std::endl;
+        lock.lock();
+        clients.remove(client);
+        lock.unlock();
+        topics.remove(client);
+        client->onClose();
+        tcpClient.clear();
+    });
+    tcpClient->on<uvw::ErrorEvent>([client](const uvw::ErrorEvent &event, uvw::TCPHandle &tcpClient) {
+        auto peer = tcpClient.peer();
+        std::cout << "error " << &tcpClient << " " << peer.ip << ":" << peer.port;
+        std::cout << "; details: code=" << event.code() << " name=" << event.name() << std::endl;
+        if (!tcpClient.closing()) tcpClient.close();
+    });
+    tcpClient->on<uvw::EndEvent>([client](const uvw::EndEvent &event, uvw::TCPHandle &tcpClient) {
+        client->onEnd(event, tcpClient);
+    });
+    tcpClient->on<uvw::DataEvent>([client](const uvw::DataEvent &event, uvw::TCPHandle &tcpClient) {
+        client->onData(event, tcpClient);
+    });
+    tcpClient->on<uvw::WriteEvent>([client](const uvw::WriteEvent &event, uvw::TCPHandle &tcpClient) {
+        auto peer = tcpClient.peer();
+        if (NETWORK_DEBUG) std::cout << "wrote to " << &tcpClient << " " << peer.ip << ":" << peer.port << std::endl;
+        client->onWrite(event, tcpClient);
     });
 
-    tcp->bind(host, port);
-    tcp->listen();
+    lock.lock();
+    clients.push_back(client);
+    lock.unlock();
+    topics.add(client);
+
+    srv.accept(*tcpClient);
+    tcpClient->noDelay(NETWORK_NO_DELAY);
+    tcpClient->read();
 }
 
 void UvServer::startBroadcasting() {
@@ -217,17 +821,25 @@ void UvServer::startBroadcasting() {
         uint64_t time_now = std::chrono::milliseconds(loop->now()).count();
         std::cout << "Sending broadcast happened! Time is " << time_now << std::endl;
 
-        for (auto const& client : clients) {
-            bson_t *b = BCON_NEW("cmd", BCON_UTF8("time"), "time", BCON_INT64(time_now));
-            uint32_t length;
-            uint8_t *msg = bson_destroy_with_steal(b, true, &length);
-            client->publish(msg, length);
-        }
+        bson_t *b = BCON_NEW("cmd", BCON_UTF8("time"), "time", BCON_INT64(time_now));
+        uint32_t length;
+        uint8_t *msg = bson_destroy_with_steal(b, true, &length);
+        publish(msg, length);
+        bson_free(msg);
     });
 
     timer->start(std::chrono::milliseconds(BROADCAST_DELAY_MS), std::chrono::milliseconds(BROADCAST_DELAY_MS));
 }
 
+// Encodes the frame once and shares it between every client subscribed to its cmd
+void UvServer::publish(const uint8_t *msg, size_t length) {
+    auto frame = build_frame(PUBLISH_TID, msg, length);
+    auto cmd = message_cmd(msg, length);
+    for (auto const& client : topics.subscribers(cmd)) {
+        client->publish(frame, cmd);
+    }
+}
+
 void UvServer::run() {
     loop->run();
 }
@@ -0,0 +1,32 @@
+import asyncio
+
+import async_networking
+from client import build_ping_message
+
+PIPELINED_PINGS = 100
+
+
+async def print_broadcasts(connection):
+    async for message in connection:
+        print("Received broadcast: {}".format(message))
+
+
+async def run():
+    connection = await async_networking.connect("localhost", 8000)
+    asyncio.ensure_future(print_broadcasts(connection))
+
+    count = 0
+    while True:
+        replies = await asyncio.gather(
+            *[
+                connection.request(build_ping_message(count + i))
+                for i in range(PIPELINED_PINGS)
+            ]
+        )
+        count = max(reply["pingpong-counter"] for reply in replies)
+        print("Received {} pongs; highest counter is {}".format(len(replies), count))
+        await asyncio.sleep(1)  # a nice sleep to make output easier to read
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(run())
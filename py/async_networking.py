@@ -0,0 +1,213 @@
+import asyncio
+
+import buffer_pool
+import message_codecs
+import networking
+
+MAX_TRANSACTION_ID = 2 ** 32 - 1
+
+CODEC_NEGOTIATION_TIMEOUT_SECS = 2
+
+
+class MessageProtocol(asyncio.Protocol):
+    """The same framing as networking.Messenger, but driven by an asyncio event loop.
+    on_message(tid, message) is called for each message received, and
+    on_connection_lost(exc) once the connection is gone."""
+
+    def __init__(
+        self,
+        on_message,
+        on_connection_lost=None,
+        compression_threshold=networking.DEFAULT_COMPRESSION_THRESHOLD,
+    ):
+        self.on_message = on_message
+        self.on_connection_lost = on_connection_lost
+        self.transport = None
+        self.compression_threshold = compression_threshold
+        self._read_buffer = buffer_pool.SegmentedBuffer(networking.DEFAULT_MAX_BUFFER_SIZE)
+        self.codec = message_codecs.get_codec(message_codecs.DEFAULT_CODEC_NAME)
+        self._parser = networking.MessageReader(self.codec)
+        self._batch = []
+        self._batch_size = 0
+
+    def set_codec(self, name):
+        self.codec = message_codecs.get_codec(name)
+        self._parser.codec = self.codec
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if networking.is_tcp_socket(transport.get_extra_info("socket")):
+            networking.set_tcp_nodelay(transport.get_extra_info("socket"), True)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.on_connection_lost is not None:
+            self.on_connection_lost(exc)
+
+    def data_received(self, data):
+        try:
+            self._read_buffer.write(data)
+        except ValueError:
+            self.transport.close()
+            return
+
+        try:
+            frames = self._parser.parse_frames(self._read_buffer)
+        except ValueError:
+            # a malformed frame; there's no telling where the next one starts
+            self.transport.close()
+            return
+        while len(frames) > 0:
+            tid, frame = frames.popleft()
+            try:
+                # decoded one at a time, as on_message() may switch codec
+                message = self._parser.decode(frame)
+            except ValueError:
+                self.transport.close()
+                return
+            self.on_message(tid, message)
+
+    def send_message(self, tid, message):
+        if self.transport is None:
+            raise networking.MessengerConnectionBroken("Connection is closed", None)
+        self.flush_batch()
+        header, body = networking.pack_frame(
+            tid, self.codec.encode(message), self.compression_threshold
+        )
+        self.transport.writelines([header, body])
+
+    def batch_message(self, tid, message):
+        """Like send_message(), but the message goes out in a batch with any others
+        sent before the event loop next gets round to it (see
+        networking.Messenger.batch_message())"""
+        if self.transport is None:
+            raise networking.MessengerConnectionBroken("Connection is closed", None)
+        if len(self._batch) == 0:
+            asyncio.get_event_loop().call_soon(self.flush_batch)
+        frame = networking.encode_frame(
+            tid, message, self.codec, self.compression_threshold
+        )
+        if self._batch_size + len(frame) > networking.MAX_BATCH_SIZE:
+            self.flush_batch()
+        self._batch.append(frame)
+        self._batch_size += len(frame)
+
+    def flush_batch(self):
+        if len(self._batch) == 0:
+            return
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+        if self.transport is None:
+            return
+        if len(batch) == 1:
+            self.transport.write(batch[0])
+        else:
+            self.transport.write(networking.encode_batch(batch))
+
+
+class Connection(object):
+    """A connection to the server where each request gets its own transaction id, so
+    any number of requests can be outstanding at once. Iterate over it with
+    `async for` to receive broadcasts."""
+
+    _CLOSED = object()
+
+    def __init__(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._next_tid = 1
+        self._pending = {}
+        self._broadcasts = asyncio.Queue()
+        self._codec_request_tid = None
+        self.protocol = MessageProtocol(self._handle_message, self._handle_connection_lost)
+
+    async def request(self, message):
+        """Sends message and returns the reply with the same transaction id"""
+        return await self._request(self._allocate_tid(), message)
+
+    async def _request(self, tid, message):
+        future = self._loop.create_future()
+        self._pending[tid] = future
+        try:
+            # requests made together (e.g. with asyncio.gather()) go out as one batch
+            self.protocol.batch_message(tid, message)
+            return await future
+        finally:
+            self._pending.pop(tid, None)
+
+    async def negotiate_codec(self, codec_names=None, timeout=CODEC_NEGOTIATION_TIMEOUT_SECS):
+        """Agrees on the fastest codec that both ends support. Servers that don't
+        support negotiation either reply without a codec or not at all, so after
+        timeout seconds we carry on with the default. Call this before making any
+        other requests."""
+        self._codec_request_tid = self._allocate_tid()
+        try:
+            await asyncio.wait_for(
+                self._request(
+                    self._codec_request_tid, networking.build_codec_request(codec_names)
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            # a reply that turns up later still switches codec (as the server will
+            # have switched too), so leave _codec_request_tid set
+            pass
+        return self.protocol.codec.name
+
+    def close(self):
+        if self.protocol.transport is not None:
+            self.protocol.transport.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._broadcasts.get()
+        if message is self._CLOSED:
+            # leave the marker in place for any other iterators
+            self._broadcasts.put_nowait(self._CLOSED)
+            raise StopAsyncIteration
+        return message
+
+    def _allocate_tid(self):
+        while True:
+            tid = self._next_tid
+            self._next_tid = tid + 1 if tid < MAX_TRANSACTION_ID else 1
+            if tid not in self._pending:
+                return tid
+
+    def _handle_message(self, tid, message):
+        if tid == networking.BROADCAST_TRANSACTION_ID:
+            self._broadcasts.put_nowait(message)
+            return
+
+        if tid == self._codec_request_tid:
+            # switch before anything else in the same read gets decoded, since the
+            # server has already switched too
+            self._codec_request_tid = None
+            if message.get("cmd") == networking.CODEC_CMD:
+                self.protocol.set_codec(message["codec"])
+
+        future = self._pending.get(tid)
+        if future is None or future.done():
+            print("unexpected reply, tid: {}  message: {}".format(tid, message))
+            return
+        future.set_result(message)
+
+    def _handle_connection_lost(self, exc):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(
+                    networking.MessengerConnectionBroken("Connection lost", None)
+                )
+        self._broadcasts.put_nowait(self._CLOSED)
+
+
+async def connect(host="localhost", port=8000, loop=None, codec_names=None):
+    """Connects and negotiates a codec; pass codec_names=[] to stick with the default"""
+    loop = loop or asyncio.get_event_loop()
+    connection = Connection(loop)
+    await loop.create_connection(lambda: connection.protocol, host, port)
+    if codec_names != []:
+        await connection.negotiate_codec(codec_names)
+    return connection
@@ -0,0 +1,138 @@
+import asyncio
+import struct
+import unittest
+from unittest import mock
+
+import networking
+import async_networking
+
+
+class PongServer(object):
+    """Replies to pings, and broadcasts or hangs up on request"""
+
+    def __init__(self):
+        self.protocols = []
+        self.supports_codecs = True
+
+    def make_protocol(self):
+        protocol = async_networking.MessageProtocol(
+            lambda tid, message: self.handle_message(protocol, tid, message)
+        )
+        self.protocols.append(protocol)
+        return protocol
+
+    def handle_message(self, protocol, tid, message):
+        if message["cmd"] == "ping":
+            counter = message["pingpong-counter"]
+            protocol.send_message(tid, {"cmd": "pong", "pingpong-counter": counter + 1})
+        elif message["cmd"] == "broadcast":
+            protocol.send_message(networking.BROADCAST_TRANSACTION_ID, {"cmd": "time"})
+            protocol.send_message(tid, {"cmd": "broadcast", "success": True})
+        elif message["cmd"] == "hangup":
+            protocol.transport.close()
+        elif message["cmd"] == networking.CODEC_CMD and self.supports_codecs:
+            reply = networking.build_codec_reply(message)
+            protocol.send_message(tid, reply)
+            protocol.set_codec(reply["codec"])
+            protocol.send_message(networking.BROADCAST_TRANSACTION_ID, {"cmd": "time"})
+
+
+class TestConnection(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = PongServer()
+        self.listener = self.loop.run_until_complete(
+            self.loop.create_server(self.server.make_protocol, "127.0.0.1", 0)
+        )
+        self.port = self.listener.sockets[0].getsockname()[1]
+        self.connection = self.loop.run_until_complete(
+            async_networking.connect("127.0.0.1", self.port, loop=self.loop, codec_names=[])
+        )
+
+    def tearDown(self):
+        self.connection.close()
+        self.listener.close()
+        self.loop.run_until_complete(self.listener.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_request(self):
+        reply = self.loop.run_until_complete(
+            self.connection.request({"cmd": "ping", "pingpong-counter": 1})
+        )
+        self.assertEqual(reply, {"cmd": "pong", "pingpong-counter": 2})
+
+    def test_pipelined_requests(self):
+        replies = self.loop.run_until_complete(
+            asyncio.gather(
+                *[
+                    self.connection.request({"cmd": "ping", "pingpong-counter": i})
+                    for i in range(200)
+                ]
+            )
+        )
+        self.assertEqual([r["pingpong-counter"] for r in replies], list(range(1, 201)))
+
+    def test_broadcasts(self):
+        async def request_and_receive():
+            await self.connection.request({"cmd": "broadcast"})
+            return await self.connection.__anext__()
+
+        self.assertEqual(self.loop.run_until_complete(request_and_receive()), {"cmd": "time"})
+
+    def test_connection_lost_fails_requests_and_ends_broadcasts(self):
+        async def hang_up():
+            with self.assertRaises(networking.MessengerConnectionBroken):
+                await self.connection.request({"cmd": "hangup"})
+            return [message async for message in self.connection]
+
+        self.assertEqual(self.loop.run_until_complete(hang_up()), [])
+
+    def test_allocated_tids_skip_zero_and_pending(self):
+        self.connection._next_tid = async_networking.MAX_TRANSACTION_ID
+        self.connection._pending[1] = None
+        self.assertEqual(
+            self.connection._allocate_tid(), async_networking.MAX_TRANSACTION_ID
+        )
+        self.assertEqual(self.connection._allocate_tid(), 2)
+
+    def test_negotiate_codec(self):
+        async def negotiate():
+            codec_name = await self.connection.negotiate_codec(["unknown", "json"])
+            # the broadcast arrives straight after the reply, in the new codec
+            broadcast = await self.connection.__anext__()
+            reply = await self.connection.request({"cmd": "ping", "pingpong-counter": 1})
+            return codec_name, broadcast, reply
+
+        self.assertEqual(
+            self.loop.run_until_complete(negotiate()),
+            ("json", {"cmd": "time"}, {"cmd": "pong", "pingpong-counter": 2}),
+        )
+        self.assertEqual(self.server.protocols[0].codec.name, "json")
+
+    def test_negotiate_codec_times_out_to_default(self):
+        self.server.supports_codecs = False
+
+        async def negotiate():
+            codec_name = await self.connection.negotiate_codec(["json"], timeout=0.05)
+            reply = await self.connection.request({"cmd": "ping", "pingpong-counter": 1})
+            return codec_name, reply
+
+        self.assertEqual(
+            self.loop.run_until_complete(negotiate()),
+            ("bson", {"cmd": "pong", "pingpong-counter": 2}),
+        )
+
+class TestMessageProtocol(unittest.TestCase):
+    def test_malformed_message_closes_connection(self):
+        received = []
+        protocol = async_networking.MessageProtocol(
+            lambda tid, message: received.append((tid, message))
+        )
+        protocol.transport = mock.Mock()
+        # a BSON document that isn't terminated by a null byte
+        body = b"\x05\x00\x00\x00\x01"
+        protocol.data_received(struct.pack(networking.MSG_HEADER_FMT, 1, len(body)) + body)
+        protocol.transport.close.assert_called_once_with()
+        self.assertEqual(received, [])
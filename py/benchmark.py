@@ -0,0 +1,206 @@
+"""Load generator for either server: opens many clients, keeps a number of requests
+in flight on each, and reports throughput and round-trip latency percentiles.
+
+    python benchmark.py --clients 50 --depth 8 --duration 10 --output results.json
+"""
+import argparse
+import itertools
+import json
+import selectors
+import time
+
+import networking
+import tracing
+import transports
+
+WORKLOADS = ("ping", "broadcast")
+
+PERCENTILES = (50, 99, 99.9)
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if len(sorted_values) == 0:
+        return None
+    rank = max(int(-(-percent * len(sorted_values) // 100)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize_latencies(latencies):
+    latencies = sorted(latencies)
+    summary = {"count": len(latencies)}
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        summary["p{:g}_ms".format(percent)] = None if value is None else value * 1000
+    summary["max_ms"] = latencies[-1] * 1000 if len(latencies) > 0 else None
+    summary["mean_ms"] = (
+        sum(latencies) / len(latencies) * 1000 if len(latencies) > 0 else None
+    )
+    return summary
+
+
+class LoadGenerator(object):
+    """Drives a set of connected client sockets. Each client keeps depth requests
+    in flight, starting the next as soon as a reply arrives.
+
+    ping: every client sends pings; latency is the time to each pong.
+    broadcast: the first client asks the server to broadcast messages; latency is
+    the time from sending one to every client (the first included) receiving it.
+
+    If trace is set, requests are traced and the results break their round trips
+    down into stages (see tracing), by the cmd of the reply.
+    """
+
+    def __init__(self, sockets, workload="ping", depth=1, trace=False):
+        if workload not in WORKLOADS:
+            raise ValueError("Unknown workload {}".format(workload))
+        self.workload = workload
+        self.depth = depth
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        for sock in sockets:
+            client = networking.Messenger(sock)
+            client.on_send_state_change = self.update_write_interest
+            self.selector.register(sock, selectors.EVENT_READ, client)
+            self.clients.append(client)
+        # (client, tid) -> when the request was sent
+        self.sent_at = {}
+        # broadcast sequence number -> (when it was sent, clients yet to receive it)
+        self.broadcasts = {}
+        self.next_sequence = 0
+        self.latencies = []
+        self.received = 0
+        self.recording = True
+        self.trace_stats = tracing.TraceStats() if trace else None
+        self.trace_ids = itertools.count(1)
+
+    def update_write_interest(self, client, has_messages_to_send):
+        events = selectors.EVENT_READ
+        if has_messages_to_send:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(client.socket, events, client)
+
+    def run(self, duration_secs, warmup_secs=0):
+        """Returns a summary of the run; nothing from the warmup is counted"""
+        senders = self.clients if self.workload == "ping" else self.clients[:1]
+        for client in senders:
+            for tid in range(1, self.depth + 1):
+                self.send_request(client, tid)
+            client.flush_batch()
+
+        self.recording = False
+        started_at = time.perf_counter()
+        measure_from = started_at + warmup_secs
+        stop_at = measure_from + duration_secs
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                break
+            if not self.recording and now >= measure_from:
+                self.recording = True
+                self.latencies = []
+                self.received = 0
+                if self.trace_stats is not None:
+                    self.trace_stats = tracing.TraceStats()
+            self.poll(stop_at - now)
+
+        results = {
+            "workload": self.workload,
+            "clients": len(self.clients),
+            "depth": self.depth,
+            "duration_secs": duration_secs,
+            "received": self.received,
+            "received_per_sec": self.received / duration_secs,
+            "latency": summarize_latencies(self.latencies),
+        }
+        if self.trace_stats is not None:
+            results["stages"] = self.trace_stats.summary()
+        return results
+
+    def poll(self, timeout):
+        for key, events in self.selector.select(timeout):
+            client = key.data
+            if events & selectors.EVENT_WRITE:
+                client.send_messages()
+            if events & selectors.EVENT_READ:
+                for tid, message in client.read_messages():
+                    self.handle_message(client, tid, message)
+                client.flush_batch()
+
+    def send_request(self, client, tid):
+        if self.workload == "ping":
+            message = {"cmd": "ping", "pingpong-counter": 0}
+        else:
+            message = {"cmd": "broadcast", "sequence": self.next_sequence}
+            self.broadcasts[self.next_sequence] = (time.perf_counter(), len(self.clients))
+            self.next_sequence += 1
+        self.sent_at[(client, tid)] = time.perf_counter()
+        trace = None
+        if self.trace_stats is not None:
+            trace = tracing.Trace(next(self.trace_ids))
+        client.batch_message(tid, message, trace=trace)
+
+    def handle_message(self, client, tid, message):
+        now = time.perf_counter()
+        if tid == networking.BROADCAST_TRANSACTION_ID:
+            if message.get("cmd") == "broadcast":
+                self.handle_broadcast(message["sequence"], now)
+            # anything else is the server's own periodic broadcast
+            return
+
+        sent_at = self.sent_at.pop((client, tid), None)
+        if sent_at is None:
+            return
+        if self.trace_stats is not None:
+            trace = client.received_traces.pop(tid, None)
+            if trace is not None and self.recording:
+                self.trace_stats.add(str(message.get("cmd")), trace)
+        if self.workload == "ping" and self.recording:
+            self.latencies.append(now - sent_at)
+            self.received += 1
+        self.send_request(client, tid)
+
+    def handle_broadcast(self, sequence, now):
+        if sequence not in self.broadcasts:
+            return
+        sent_at, remaining = self.broadcasts[sequence]
+        if self.recording:
+            self.latencies.append(now - sent_at)
+            self.received += 1
+        if remaining == 1:
+            del self.broadcasts[sequence]
+        else:
+            self.broadcasts[sequence] = (sent_at, remaining - 1)
+
+
+def connect_clients(url, count):
+    """url is the server's; see transports for the schemes"""
+    return [transports.connect(url) for _ in range(count)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--url", default=transports.DEFAULT_URL, help="tcp://host:port, unix:///path or shm:///path"
+    )
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=1, help="requests in flight per client")
+    parser.add_argument("--workload", choices=WORKLOADS, default="ping")
+    parser.add_argument("--duration", type=float, default=10, help="in seconds")
+    parser.add_argument("--warmup", type=float, default=1, help="in seconds")
+    parser.add_argument("--output", help="file to write the results to, as JSON")
+    parser.add_argument(
+        "--trace", action="store_true", help="break round trips down into stages"
+    )
+    args = parser.parse_args()
+
+    generator = LoadGenerator(
+        connect_clients(args.url, args.clients), args.workload, args.depth, args.trace
+    )
+    results = generator.run(args.duration, args.warmup)
+    results["server"] = args.url
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
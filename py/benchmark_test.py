@@ -0,0 +1,68 @@
+import threading
+import unittest
+
+import benchmark
+import server
+
+
+class TestPercentiles(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = list(range(1, 1001))
+        self.assertEqual(benchmark.percentile(values, 50), 500)
+        self.assertEqual(benchmark.percentile(values, 99), 990)
+        self.assertEqual(benchmark.percentile(values, 99.9), 999)
+        self.assertEqual(benchmark.percentile(values, 100), 1000)
+        self.assertEqual(benchmark.percentile([7], 50), 7)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_summary(self):
+        summary = benchmark.summarize_latencies([0.003, 0.001, 0.002])
+        self.assertEqual(summary["count"], 3)
+        self.assertAlmostEqual(summary["p50_ms"], 2)
+        self.assertAlmostEqual(summary["max_ms"], 3)
+        self.assertAlmostEqual(summary["mean_ms"], 2)
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server(("127.0.0.1", 0), sends_time_broadcasts=False)
+        self.server.listen()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.stopping = True
+        self.thread.join()
+        self.server.server_socket.close()
+        for sock in list(self.server.known_clients):
+            self.server.remove_client(sock)
+
+    def serve(self):
+        while not self.stopping:
+            self.server.poll(0.01)
+
+    def run_workload(self, workload, trace=False):
+        sockets = benchmark.connect_clients(self.server.url, 3)
+        try:
+            generator = benchmark.LoadGenerator(sockets, workload, depth=4, trace=trace)
+            return generator.run(0.2)
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    def test_ping(self):
+        results = self.run_workload("ping")
+        self.assertGreater(results["received"], 0)
+        self.assertEqual(results["latency"]["count"], results["received"])
+        self.assertLessEqual(results["latency"]["p50_ms"], results["latency"]["p99_ms"])
+
+    def test_traced_ping(self):
+        results = self.run_workload("ping", trace=True)
+        stages = results["stages"]["pong"]
+        self.assertEqual(stages["total"]["count"], results["received"])
+        self.assertLessEqual(stages["handler"]["p50_us"], stages["total"]["max_us"])
+
+    def test_broadcast(self):
+        results = self.run_workload("broadcast")
+        self.assertGreater(results["received"], 0)
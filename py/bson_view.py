@@ -0,0 +1,144 @@
+import collections.abc
+import struct
+
+import bson
+
+_INT32 = struct.Struct("<i")
+_INT64 = struct.Struct("<q")
+_DOUBLE = struct.Struct("<d")
+
+# sizes of the fixed-size element types the bson package understands
+_FIXED_SIZES = {
+    0x01: 8,  # double
+    0x07: 12,  # object id
+    0x08: 1,  # boolean
+    0x09: 8,  # UTC datetime
+    0x0A: 0,  # null
+    0x10: 4,  # int32
+    0x11: 8,  # uint64
+    0x12: 8,  # int64
+}
+# types whose value starts with an int32 length
+_STRING_TYPES = (0x02,)  # int32 length (including the trailing NUL) + bytes
+_DOCUMENT_TYPES = (0x03, 0x04)  # int32 length of the whole document
+_BINARY_TYPES = (0x05,)  # int32 length + subtype byte + bytes
+
+
+class BsonView(collections.abc.Mapping):
+    """A read-only dict-like view of an encoded BSON document. Nothing is decoded
+    up front: looking up a key scans the element list only as far as that key
+    (remembering the offset of every element it passes), and each value is decoded
+    the first time it's accessed. Embedded documents are views themselves, so a
+    large payload that is only forwarded or ignored is never decoded at all.
+
+    Values decode exactly as bson.loads() would decode them."""
+
+    def __init__(self, data):
+        """data must not change while the view is in use, so pass bytes (or a
+        memoryview of bytes) rather than a view into a reusable buffer"""
+        self.data = memoryview(data)
+        (length,) = _INT32.unpack_from(self.data)
+        if length < 5 or length > len(self.data) or self.data[length - 1] != 0:
+            raise ValueError("Invalid BSON document")
+        self.data = self.data[:length]
+        # key -> (element type, offset of the element, of its value, of the next element)
+        self._index = {}
+        self._scan_offset = 4
+        self._values = {}
+
+    def raw(self):
+        """The encoded document, e.g. to send it on without re-encoding it"""
+        return self.data.tobytes()
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        element = self._find(key)
+        if element is None:
+            raise KeyError(key)
+        value = self._decode(*element)
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __iter__(self):
+        while self._scan_offset is not None:
+            self._scan_next()
+        return iter(self._index)
+
+    def __len__(self):
+        while self._scan_offset is not None:
+            self._scan_next()
+        return len(self._index)
+
+    def __repr__(self):
+        return "BsonView({!r})".format(dict(self))
+
+    def _find(self, key):
+        element = self._index.get(key)
+        while element is None and self._scan_offset is not None:
+            if self._scan_next() == key:
+                element = self._index[key]
+        return element
+
+    def _scan_next(self):
+        """Indexes the next element and returns its key"""
+        data = self.data
+        offset = self._scan_offset
+        element_type = data[offset]
+        if element_type == 0:
+            self._scan_offset = None
+            return None
+
+        key_end = offset + 1
+        while data[key_end] != 0:
+            key_end += 1
+        key = data[offset + 1 : key_end].tobytes().decode("utf-8")
+        value_offset = key_end + 1
+
+        if element_type in _FIXED_SIZES:
+            next_offset = value_offset + _FIXED_SIZES[element_type]
+        elif element_type in _STRING_TYPES:
+            next_offset = value_offset + 4 + _INT32.unpack_from(data, value_offset)[0]
+        elif element_type in _DOCUMENT_TYPES:
+            next_offset = value_offset + _INT32.unpack_from(data, value_offset)[0]
+        elif element_type in _BINARY_TYPES:
+            next_offset = value_offset + 5 + _INT32.unpack_from(data, value_offset)[0]
+        else:
+            raise ValueError("Unsupported BSON element type 0x{:02x}".format(element_type))
+        if next_offset >= len(data):
+            raise ValueError("Invalid BSON document")
+
+        self._index.setdefault(key, (element_type, offset, value_offset, next_offset))
+        self._scan_offset = next_offset
+        return key
+
+    def _decode(self, element_type, offset, value_offset, next_offset):
+        data = self.data
+        if element_type == 0x02:
+            (length,) = _INT32.unpack_from(data, value_offset)
+            start = value_offset + 4
+            return data[start : start + length - 1].tobytes().decode("utf-8")
+        elif element_type == 0x03:
+            return BsonView(data[value_offset:])
+        elif element_type == 0x04:
+            return list(BsonView(data[value_offset:]).values())
+        elif element_type == 0x08:
+            return data[value_offset] == 1
+        elif element_type == 0x0A:
+            return None
+        elif element_type == 0x10:
+            return _INT32.unpack_from(data, value_offset)[0]
+        elif element_type == 0x12:
+            return _INT64.unpack_from(data, value_offset)[0]
+        elif element_type == 0x01:
+            return _DOUBLE.unpack_from(data, value_offset)[0]
+
+        # anything less common is handed to the bson package as a one-element
+        # document, so it decodes exactly as it would have done before
+        element = data[offset:next_offset]
+        document = _INT32.pack(len(element) + 5) + element.tobytes() + b"\x00"
+        return next(iter(bson.loads(document).values()))
+
@@ -0,0 +1,69 @@
+import datetime
+import json
+import unittest
+
+import bson
+
+import message_codecs
+from bson_view import BsonView
+
+
+class TestBsonView(unittest.TestCase):
+    def setUp(self):
+        self.message = {
+            "cmd": "ping",
+            "pingpong-counter": 1,
+            "big": 2 ** 40,
+            "ratio": 1.5,
+            "ok": True,
+            "nothing": None,
+            "data": b"\x00\x01",
+            "time": datetime.datetime(2018, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+            "payload": {"words": ["a", "b", {"c": 1}], "inner": {}},
+        }
+        self.encoded = bson.dumps(self.message)
+
+    def test_decodes_like_bson_package(self):
+        view = BsonView(self.encoded)
+        self.assertEqual(view, bson.loads(self.encoded))
+        self.assertEqual(dict(view), bson.loads(self.encoded))
+        self.assertEqual(list(view), list(self.message))
+        self.assertEqual(len(view), len(self.message))
+
+    def test_only_scans_as_far_as_the_key(self):
+        view = BsonView(self.encoded)
+        self.assertEqual(view["cmd"], "ping")
+        self.assertEqual(list(view._index), ["cmd"])
+        self.assertEqual(list(view._values), ["cmd"])
+        self.assertIn("pingpong-counter", view)
+        self.assertEqual(list(view._values), ["cmd"])
+
+    def test_embedded_documents_are_views(self):
+        view = BsonView(self.encoded)
+        payload = view["payload"]
+        self.assertIsInstance(payload, BsonView)
+        self.assertEqual(payload._index, {})
+        self.assertEqual(payload["words"][2], {"c": 1})
+
+    def test_missing_key(self):
+        view = BsonView(self.encoded)
+        with self.assertRaises(KeyError):
+            view["missing"]
+        self.assertNotIn("missing", view)
+        self.assertIsNone(view.get("missing"))
+
+    def test_invalid_document(self):
+        with self.assertRaises(ValueError):
+            BsonView(self.encoded[:-1])
+        with self.assertRaises(ValueError):
+            BsonView(b"\x05\x00\x00\x00\x01")
+
+    def test_reencode(self):
+        codec = message_codecs.get_codec("bson")
+        view = codec.decode(memoryview(self.encoded))
+        self.assertIsInstance(view, BsonView)
+        self.assertEqual(codec.encode(view), self.encoded)
+        self.assertEqual(bson.loads(codec.encode({"forwarded": view})), {"forwarded": self.message})
+
+        as_json = json.loads(message_codecs.get_codec("json").encode(view["payload"]))
+        self.assertEqual(as_json, {"words": ["a", "b", {"c": 1}], "inner": {}})
@@ -0,0 +1,203 @@
+import collections
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+
+# spare segments a pool keeps for reuse; any more are left to the garbage collector
+DEFAULT_MAX_FREE_SEGMENTS = 256
+
+
+class SegmentPool(object):
+    """Fixed-size bytearray segments shared between the buffers of many connections,
+    so memory is only held for data that's actually in flight. Not thread-safe;
+    give each thread running an event loop its own pool."""
+
+    def __init__(
+        self, segment_size=DEFAULT_SEGMENT_SIZE, max_free_segments=DEFAULT_MAX_FREE_SEGMENTS
+    ):
+        self.segment_size = segment_size
+        self.max_free_segments = max_free_segments
+        self._free = []
+        self.allocated = 0
+
+    def acquire(self):
+        if len(self._free) > 0:
+            return self._free.pop()
+        self.allocated += 1
+        return bytearray(self.segment_size)
+
+    def release(self, segment):
+        if len(self._free) < self.max_free_segments:
+            self._free.append(segment)
+        else:
+            self.allocated -= 1
+
+    def get_stats(self):
+        return {
+            "segment_size": self.segment_size,
+            "segments_allocated": self.allocated,
+            "segments_free": len(self._free),
+        }
+
+
+DEFAULT_POOL = SegmentPool()
+
+
+class SegmentedBuffer(object):
+    """A FIFO byte buffer with the same interface as RingBuffer, but made of
+    segments drawn from a SegmentPool as data arrives and handed back as soon as
+    it's consumed, so an idle buffer holds no memory at all. It can grow up to
+    max_size bytes."""
+
+    def __init__(self, max_size, pool=None):
+        self.max_size = max_size
+        self.pool = pool or DEFAULT_POOL
+        self.segments = collections.deque()
+        # offset of the first unread byte in segments[0]
+        self.start = 0
+        # bytes written into segments[-1]
+        self.end = 0
+        self.num_bytes_used = 0
+
+    def __repr__(self):
+        return "SegmentedBuffer(segments={}, start={}, num_bytes_used={})".format(
+            len(self.segments), self.start, self.num_bytes_used
+        )
+
+    def bytes_total(self):
+        return self.max_size
+
+    def bytes_used(self):
+        return self.num_bytes_used
+
+    def bytes_free(self):
+        return self.max_size - self.num_bytes_used
+
+    def segments_held(self):
+        return len(self.segments)
+
+    def _room_at_end(self):
+        if len(self.segments) == 0:
+            return 0
+        return len(self.segments[-1]) - self.end
+
+    def free_regions(self):
+        """Returns a memoryview over space that can be written directly and then
+        committed with commit_write(), taking a new segment if the last one is full.
+        Segments that are taken but not written to are handed back by
+        release_unused()."""
+        free = self.bytes_free()
+        if free == 0:
+            return []
+        if self._room_at_end() == 0:
+            self.segments.append(self.pool.acquire())
+            self.end = 0
+            if len(self.segments) == 1:
+                self.start = 0
+        room = min(self._room_at_end(), free)
+        return [memoryview(self.segments[-1])[self.end : self.end + room]]
+
+    def commit_write(self, num_bytes):
+        """Marks bytes written directly into the view from free_regions() as used"""
+        if num_bytes > min(self._room_at_end(), self.bytes_free()):
+            message = "Can't commit {} bytes into buffer ({} used, {} free of total {})".format(
+                num_bytes, self.bytes_used(), self.bytes_free(), self.bytes_total()
+            )
+            raise ValueError(message)
+        self.end += num_bytes
+        self.num_bytes_used += num_bytes
+
+    def release_unused(self):
+        """Hands back segments that hold no data, e.g. after free_regions() was
+        called for a read that turned out to have nothing to read"""
+        if self.num_bytes_used == 0:
+            while len(self.segments) > 0:
+                self.pool.release(self.segments.pop())
+            self.start = 0
+            self.end = 0
+
+    def used_regions(self):
+        """Returns memoryviews over the data in the order it will be read, one per
+        segment"""
+        regions = []
+        last = len(self.segments) - 1
+        for i, segment in enumerate(self.segments):
+            start = self.start if i == 0 else 0
+            end = self.end if i == last else len(segment)
+            if end > start:
+                regions.append(memoryview(segment)[start:end])
+        return regions
+
+    def write(self, bs):
+        if len(bs) > self.bytes_free():
+            message = "Can't fit {} bytes into buffer ({} used, {} free of total {})".format(
+                len(bs), self.bytes_used(), self.bytes_free(), self.bytes_total()
+            )
+            raise ValueError(message)
+
+        view = memoryview(bs)
+        while len(view) > 0:
+            region = self.free_regions()[0]
+            written = min(len(region), len(view))
+            region[:written] = view[:written]
+            self.commit_write(written)
+            view = view[written:]
+
+    def peek(self, desired_bytes):
+        """Returns the next desired_bytes bytes without consuming them, or None if
+        there aren't that many. This is a memoryview into the buffer (no copy) unless
+        the bytes span more than one segment."""
+        if desired_bytes < 0:
+            raise ValueError("desired bytes of {} is less than 0".format(desired_bytes))
+        elif self.num_bytes_used < desired_bytes:
+            return None
+        if desired_bytes == 0:
+            return memoryview(b"")
+
+        first = self.segments[0]
+        if self.start + desired_bytes <= len(first):
+            return memoryview(first)[self.start : self.start + desired_bytes]
+        joined = bytearray()
+        for region in self.used_regions():
+            joined += region[: desired_bytes - len(joined)]
+            if len(joined) == desired_bytes:
+                break
+        return joined
+
+    def discard(self, num_bytes):
+        """Consumes num_bytes bytes without returning them (e.g. after a peek()),
+        handing back each segment once it's been consumed"""
+        if num_bytes < 0 or num_bytes > self.num_bytes_used:
+            raise ValueError(
+                "Can't discard {} bytes from buffer ({} used)".format(
+                    num_bytes, self.num_bytes_used
+                )
+            )
+        self.num_bytes_used -= num_bytes
+        remaining = num_bytes
+        while remaining > 0:
+            in_first = (self.end if len(self.segments) == 1 else len(self.segments[0])) - self.start
+            if remaining < in_first:
+                self.start += remaining
+                break
+            remaining -= in_first
+            self.pool.release(self.segments.popleft())
+            self.start = 0
+        if self.num_bytes_used == 0:
+            self.release_unused()
+
+    def read(self):
+        """Returns (and consumes) whatever is in the first segment"""
+        regions = self.used_regions()
+        if len(regions) == 0:
+            return None
+        data = bytearray(regions[0])
+        self.discard(len(data))
+        return data
+
+    def read_exactly(self, desired_bytes):
+        data = self.peek(desired_bytes)
+        if data is None:
+            return None
+        data = bytearray(data)
+        self.discard(desired_bytes)
+        return data
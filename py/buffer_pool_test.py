@@ -0,0 +1,89 @@
+import random
+import unittest
+
+from buffer_pool import SegmentedBuffer, SegmentPool
+
+
+class TestSegmentPool(unittest.TestCase):
+    def test_reuses_released_segments(self):
+        pool = SegmentPool(8, max_free_segments=1)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEqual(pool.allocated, 2)
+        pool.release(first)
+        pool.release(second)
+        # only one is kept for reuse
+        self.assertEqual(
+            pool.get_stats(), {"segment_size": 8, "segments_allocated": 1, "segments_free": 1}
+        )
+        self.assertIs(pool.acquire(), first)
+
+
+class TestSegmentedBuffer(unittest.TestCase):
+    def setUp(self):
+        self.pool = SegmentPool(4)
+        self.buffer = SegmentedBuffer(10, self.pool)
+
+    def test_write_and_read_across_segments(self):
+        self.buffer.write(b"abcdefg")
+        self.assertEqual(self.buffer.segments_held(), 2)
+        self.assertEqual([bytes(r) for r in self.buffer.used_regions()], [b"abcd", b"efg"])
+        self.assertEqual(self.buffer.read_exactly(5), b"abcde")
+        self.assertEqual(self.buffer.segments_held(), 1)
+        self.assertEqual(self.buffer.read(), b"fg")
+        self.assertIsNone(self.buffer.read())
+        self.assertEqual(self.buffer.segments_held(), 0)
+
+    def test_grows_up_to_max_size(self):
+        self.buffer.write(b"x" * 10)
+        self.assertEqual(self.buffer.bytes_free(), 0)
+        self.assertEqual(self.buffer.free_regions(), [])
+        with self.assertRaises(ValueError):
+            self.buffer.write(b"y")
+
+    def test_peek_is_a_view_within_a_segment_and_a_copy_across_them(self):
+        self.buffer.write(b"abcdef")
+        within = self.buffer.peek(3)
+        self.assertIsInstance(within, memoryview)
+        self.assertEqual(bytes(within), b"abc")
+        self.assertEqual(bytes(self.buffer.peek(6)), b"abcdef")
+        self.assertIsNone(self.buffer.peek(7))
+        self.assertEqual(self.buffer.bytes_used(), 6)
+
+    def test_commit_write_into_free_regions(self):
+        region = self.buffer.free_regions()[0]
+        self.assertEqual(len(region), 4)
+        region[:3] = b"abc"
+        self.buffer.commit_write(3)
+        self.assertEqual(len(self.buffer.free_regions()[0]), 1)
+        with self.assertRaises(ValueError):
+            self.buffer.commit_write(2)
+        self.assertEqual(self.buffer.read_exactly(3), b"abc")
+
+    def test_release_unused(self):
+        self.buffer.free_regions()
+        self.assertEqual(self.buffer.segments_held(), 1)
+        self.buffer.release_unused()
+        self.assertEqual(self.buffer.segments_held(), 0)
+        self.assertEqual(self.pool.get_stats()["segments_free"], 1)
+
+    def test_random_operations_match_a_plain_fifo(self):
+        rng = random.Random(2)
+        buffer = SegmentedBuffer(100, SegmentPool(7))
+        expected = bytearray()
+        for _ in range(2000):
+            if rng.random() < 0.5:
+                data = bytes(rng.randrange(256) for _ in range(rng.randint(0, 30)))
+                if len(data) <= buffer.bytes_free():
+                    buffer.write(data)
+                    expected += data
+            else:
+                n = rng.randint(0, 30)
+                if n <= len(expected):
+                    self.assertEqual(bytes(buffer.peek(n)), bytes(expected[:n]))
+                    buffer.discard(n)
+                    del expected[:n]
+                else:
+                    self.assertIsNone(buffer.read_exactly(n))
+            self.assertEqual(buffer.bytes_used(), len(expected))
+            self.assertEqual(b"".join(buffer.used_regions()), bytes(expected))
@@ -0,0 +1,268 @@
+"""Captures of the frames going in and out of a server, and replaying what clients
+sent in one against a server (Python or C++) to reproduce its load:
+
+    python server.py --capture traffic.capture
+    python capture.py traffic.capture                 # at the speed it was captured
+    python capture.py traffic.capture --speed 10      # ten times as fast
+    python capture.py traffic.capture --max-speed     # as fast as the server keeps up
+
+A capture is a file header followed by one record per frame, each a RECORD header
+and then the frame itself, header included. Frames received in batches or
+chunks are recorded as the frames they were unpacked into; frames sent are
+recorded as they were queued (so batches are recorded whole).
+"""
+import argparse
+import collections
+import mmap
+import selectors
+import struct
+import time
+
+import networking
+import transports
+
+MAGIC = b"MSGCAPT1"
+# magic, wall clock time the capture started
+FILE_HEADER = struct.Struct("!8sd")
+# seconds since the capture started, connection id, direction, transaction id,
+# frame length
+RECORD = struct.Struct("!dIBII")
+
+INBOUND = 0
+OUTBOUND = 1
+
+# how long to keep collecting replies once everything has been sent
+DEFAULT_DRAIN_SECS = 1
+
+Record = collections.namedtuple(
+    "Record", ["timestamp", "connection_id", "direction", "tid", "frame"]
+)
+
+
+class Recorder(object):
+    """Appends records to a capture file, for Messengers to call once they've been
+    passed to start_recording()"""
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, time.time()))
+        self.started_at = time.perf_counter()
+        self._next_connection_id = 1
+
+    def new_connection_id(self):
+        connection_id = self._next_connection_id
+        self._next_connection_id += 1
+        return connection_id
+
+    def record_inbound(self, connection_id, tid, frame):
+        self._record(connection_id, INBOUND, tid, [frame])
+
+    def record_outbound(self, connection_id, tid, pieces):
+        """pieces are a frame split up as Messenger queues it"""
+        self._record(connection_id, OUTBOUND, tid, pieces)
+
+    def _record(self, connection_id, direction, tid, pieces):
+        self.file.write(
+            RECORD.pack(
+                time.perf_counter() - self.started_at,
+                connection_id,
+                direction,
+                tid,
+                sum(len(piece) for piece in pieces),
+            )
+        )
+        for piece in pieces:
+            self.file.write(piece)
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader(object):
+    """Reads a capture by memory-mapping it. The frames in the records it yields are
+    views of the mapping, so they must be let go of before close()."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mapping) < FILE_HEADER.size:
+            self._mapping.close()
+            raise ValueError("{} is too short to be a capture".format(path))
+        magic, self.started_at = FILE_HEADER.unpack_from(self._mapping)
+        if magic != MAGIC:
+            self._mapping.close()
+            raise ValueError("{} isn't a capture".format(path))
+
+    def records(self):
+        view = memoryview(self._mapping)
+        try:
+            offset = FILE_HEADER.size
+            while len(view) - offset >= RECORD.size:
+                timestamp, connection_id, direction, tid, length = RECORD.unpack_from(
+                    view, offset
+                )
+                offset += RECORD.size
+                if len(view) - offset < length:
+                    # the recorder was stopped part way through writing this one
+                    break
+                yield Record(
+                    timestamp, connection_id, direction, tid, view[offset : offset + length]
+                )
+                offset += length
+        finally:
+            view.release()
+
+    def close(self):
+        self._mapping.close()
+
+
+class Replayer(object):
+    """Sends the frames clients sent in a capture to the server at url, each on a
+    connection of its own for each connection in the capture, and counts what comes
+    back. speed scales the time between frames; None sends them as fast as the
+    server takes them. Either way, a connection whose send queue is backlogged is
+    given time to drain before anything more is queued on it."""
+
+    def __init__(self, url, speed=1.0):
+        self.url = url
+        self.speed = speed
+        self.selector = selectors.DefaultSelector()
+        # connection id in the capture -> Messenger, or None once it's been lost
+        self.connections = {}
+        self.frames_sent = 0
+        self.frames_received = 0
+
+    def run(self, records, drain_secs=DEFAULT_DRAIN_SECS):
+        """Replays records (from CaptureReader.records()), returning a summary"""
+        started_at = time.perf_counter()
+        first_timestamp = None
+        for record in records:
+            if record.direction != INBOUND:
+                continue
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+            if self.speed is not None:
+                due_at = started_at + (record.timestamp - first_timestamp) / self.speed
+                self.poll_until(due_at)
+            self.wait_for_backlog(record.connection_id)
+            messenger = self.get_connection(record.connection_id)
+            if messenger is None:
+                continue
+            try:
+                messenger.queue_frame(record.frame)
+                messenger.send_messages()
+            except (networking.MessengerBufferFullError, networking.MessengerConnectionBroken):
+                self.drop_connection(record.connection_id)
+                continue
+            self.frames_sent += 1
+            self.poll(0)
+        sent_at = time.perf_counter()
+        self.poll_until(sent_at + drain_secs)
+
+        secs = sent_at - started_at
+        return {
+            "url": self.url,
+            "speed": self.speed,
+            "connections": len(self.connections),
+            "frames_sent": self.frames_sent,
+            "frames_received": self.frames_received,
+            "secs": secs,
+            "frames_sent_per_sec": self.frames_sent / secs if secs > 0 else None,
+        }
+
+    def get_connection(self, connection_id):
+        if connection_id not in self.connections:
+            messenger = networking.Messenger(transports.connect(self.url))
+            messenger.on_send_state_change = self.update_write_interest
+            self.selector.register(messenger.socket, selectors.EVENT_READ, connection_id)
+            self.connections[connection_id] = messenger
+        return self.connections[connection_id]
+
+    def update_write_interest(self, messenger, has_messages_to_send):
+        events = selectors.EVENT_READ
+        if has_messages_to_send:
+            events |= selectors.EVENT_WRITE
+        key = self.selector.get_key(messenger.socket)
+        self.selector.modify(messenger.socket, events, key.data)
+
+    def drop_connection(self, connection_id):
+        messenger = self.connections[connection_id]
+        self.connections[connection_id] = None
+        print("lost connection {} to the server".format(connection_id))
+        self.selector.unregister(messenger.socket)
+        messenger.socket.close()
+
+    def wait_for_backlog(self, connection_id):
+        """Reads and sends until the connection's send queue is no longer backlogged
+        (see networking.Messenger), so frames are never queued faster than the
+        server takes them"""
+        messenger = self.connections.get(connection_id)
+        while messenger is not None and messenger.send_backlogged:
+            self.poll(None)
+            messenger = self.connections[connection_id]
+
+    def poll_until(self, until):
+        while True:
+            remaining = until - time.perf_counter()
+            if remaining <= 0:
+                return
+            self.poll(remaining)
+
+    def poll(self, timeout):
+        if len(self.selector.get_map()) == 0:
+            if timeout > 0:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            messenger = self.connections[key.data]
+            try:
+                if events & selectors.EVENT_READ:
+                    # replies are only counted, so they needn't be decoded
+                    for _reply in messenger.read_frames():
+                        self.frames_received += 1
+                if events & selectors.EVENT_WRITE:
+                    messenger.send_messages()
+            except networking.MessengerConnectionBroken:
+                self.drop_connection(key.data)
+
+    def close(self):
+        for messenger in self.connections.values():
+            if messenger is not None:
+                self.selector.unregister(messenger.socket)
+                messenger.socket.close()
+        self.selector.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", help="a file written by server.py --capture")
+    parser.add_argument(
+        "--url",
+        default=transports.DEFAULT_URL,
+        help="the server's: tcp://host:port, unix:///path or shm:///path",
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="how many times faster than captured"
+    )
+    parser.add_argument(
+        "--max-speed", action="store_true", help="send as fast as the server takes it"
+    )
+    parser.add_argument(
+        "--drain",
+        type=float,
+        default=DEFAULT_DRAIN_SECS,
+        help="seconds to keep reading replies once everything has been sent",
+    )
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    reader = CaptureReader(args.capture)
+    replayer = Replayer(args.url, None if args.max_speed else args.speed)
+    try:
+        summary = replayer.run(reader.records(), args.drain)
+    finally:
+        replayer.close()
+        reader.close()
+    for name, value in summary.items():
+        print("{:20} {}".format(name, value))
@@ -0,0 +1,150 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+import capture
+import networking
+import server
+
+
+def ping(tid, padding=None):
+    message = {"cmd": "ping", "pingpong-counter": tid}
+    if padding is not None:
+        message["padding"] = padding
+    return networking.encode_frame(tid, message)
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "traffic.capture")
+
+    def read_records(self):
+        reader = capture.CaptureReader(self.path)
+        try:
+            return [
+                record._replace(frame=bytes(record.frame)) for record in reader.records()
+            ]
+        finally:
+            reader.close()
+
+    def test_round_trip(self):
+        recorder = capture.Recorder(self.path)
+        connection_id = recorder.new_connection_id()
+        recorder.record_inbound(connection_id, 1, ping(1))
+        header, body = networking.pack_frame(2, b"body", None)
+        recorder.record_outbound(recorder.new_connection_id(), 2, [header, body])
+        recorder.close()
+
+        records = self.read_records()
+        self.assertEqual(
+            [(r.connection_id, r.direction, r.tid, r.frame) for r in records],
+            [(1, capture.INBOUND, 1, ping(1)), (2, capture.OUTBOUND, 2, header + body)],
+        )
+        self.assertLessEqual(records[0].timestamp, records[1].timestamp)
+
+    def test_truncated_record_is_ignored(self):
+        recorder = capture.Recorder(self.path)
+        recorder.record_inbound(1, 1, ping(1))
+        recorder.record_inbound(1, 2, ping(2))
+        recorder.close()
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        self.assertEqual([r.tid for r in self.read_records()], [1])
+
+    def test_not_a_capture(self):
+        with open(self.path, "wb") as f:
+            f.write(b"x" * 100)
+        with self.assertRaises(ValueError):
+            capture.CaptureReader(self.path)
+
+    def test_messenger_records_frames_both_ways(self):
+        recorder = capture.Recorder(self.path)
+        sock, peer = socket.socketpair()
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        messenger = networking.Messenger(sock)
+        messenger.start_recording(recorder)
+        # a batch is recorded as the frames in it
+        peer.sendall(networking.encode_batch([ping(1), ping(2)]))
+        self.assertEqual([tid for tid, _ in messenger.read_messages()], [1, 2])
+        messenger.queue_message(3, {"cmd": "pong"})
+        recorder.close()
+
+        records = self.read_records()
+        self.assertEqual(
+            [(r.connection_id, r.direction, r.tid) for r in records],
+            [(1, capture.INBOUND, 1), (1, capture.INBOUND, 2), (1, capture.OUTBOUND, 3)],
+        )
+        self.assertEqual(records[1].frame, ping(2))
+        self.assertEqual(networking.decode_frame(records[2].frame), {"cmd": "pong"})
+
+
+class TestReplayer(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server(("127.0.0.1", 0), sends_time_broadcasts=False)
+        self.server.listen()
+        self.stopping = False
+        # held to stop the server reading for a while
+        self.server_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.stopping = True
+        self.thread.join()
+        self.server.server_socket.close()
+        for sock in list(self.server.known_clients):
+            self.server.remove_client(sock)
+
+    def serve(self):
+        while not self.stopping:
+            with self.server_lock:
+                self.server.poll(0.01)
+
+    def records(self, count=10, padding=None):
+        # two connections' pings, and the server's replies, which aren't replayed
+        for i in range(count):
+            frame = ping(i + 1, padding)
+            yield capture.Record(i * 0.01, i % 2 + 1, capture.INBOUND, i + 1, frame)
+            yield capture.Record(i * 0.01, i % 2 + 1, capture.OUTBOUND, i + 1, b"")
+
+    def test_replay_at_max_speed(self):
+        # far more than the send queue's high water mark, sent while the server
+        # isn't reading, so the replayer has to wait for it to catch up
+        padding = os.urandom(64 * 1024)
+        count = 20 * networking.DEFAULT_SEND_HIGH_WATER // len(padding)
+        self.server_lock.acquire()
+        threading.Timer(0.5, self.server_lock.release).start()
+        replayer = capture.Replayer(self.server.url, speed=None)
+        try:
+            summary = replayer.run(self.records(count, padding), drain_secs=0.5)
+        finally:
+            replayer.close()
+        self.assertEqual(summary["connections"], 2)
+        self.assertEqual(summary["frames_sent"], count)
+        self.assertEqual(summary["frames_received"], count)
+        # nothing was queued on a connection while it was backlogged
+        frame_size = len(ping(count, padding))
+        for messenger in replayer.connections.values():
+            self.assertLessEqual(
+                messenger.stats.send_queue_high_water,
+                networking.DEFAULT_SEND_HIGH_WATER + frame_size,
+            )
+
+    def test_replay_keeps_time_between_frames(self):
+        replayer = capture.Replayer(self.server.url, speed=2)
+        try:
+            summary = replayer.run(self.records(), drain_secs=0.1)
+        finally:
+            replayer.close()
+        # the last frame was captured 0.09s after the first
+        self.assertGreaterEqual(summary["secs"], 0.045)
+        self.assertEqual(summary["frames_received"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
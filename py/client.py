@@ -1,8 +1,25 @@
-import socket
-import time
+import argparse
+import itertools
+import json
 import select
 
+import handlers
 import networking
+import timers
+import tracing
+import transports
+
+
+CODEC_NEGOTIATION_TID = 1
+# servers that don't support negotiation might not reply at all
+CODEC_NEGOTIATION_TIMEOUT_SECS = 2
+# each pong is answered with the next ping this much later, to make output easier
+# to read
+PING_INTERVAL_SECS = 1
+# how long to wait for a pong before giving up on the server
+PING_TIMEOUT_SECS = 10
+# how often the latency breakdown of traced pings is printed
+TRACE_REPORT_INTERVAL_SECS = 10
 
 
 def build_ping_message(count):
@@ -10,27 +27,39 @@ def build_ping_message(count):
 
 
 class Client(object):
-    def run(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setblocking(False)
-        try:
-            s.connect(("localhost", 8000))
-        except BlockingIOError:
-            print("connection will complete async")
+    def __init__(self, url=transports.DEFAULT_URL, trace=False):
+        """url is the server's; see transports for the schemes. If trace is set,
+        pings are traced and where their round trips' time went is printed every
+        TRACE_REPORT_INTERVAL_SECS (see tracing)."""
+        self.url = url
+        self.handlers = handlers.HandlerRegistry()
+        self.handlers.register("pong", self.handle_pong)
+        self.handlers.register("time", self.handle_time)
+        self.timers = timers.TimerQueue()
+        # tid -> the timer that gives up on the ping with that tid
+        self.ping_timeouts = {}
+        self.timed_out = False
+        self.trace_stats = None
+        if trace:
+            self.trace_stats = tracing.TraceStats()
+            self.trace_ids = itertools.count(1)
+            self.timers.call_every(TRACE_REPORT_INTERVAL_SECS, self.print_trace_stats)
 
-        self.server = networking.Messenger(s)
-        self.server.queue_message(1, build_ping_message(count=0))
-        self.server.queue_message(2, build_ping_message(count=100))
-
-        while True:
-            time.sleep(1)  # a nice sleep to make output easier to read
-
-            timeout = 0.01  # in seconds
+    def run(self):
+        self.server = networking.Messenger(transports.connect(self.url))
+        # the pings start once the server has replied to this (or we give up waiting)
+        self.server.queue_message(CODEC_NEGOTIATION_TID, networking.build_codec_request())
+        self.negotiation_timer = self.timers.call_later(
+            CODEC_NEGOTIATION_TIMEOUT_SECS, self.handle_negotiation_timeout
+        )
+
+        while not self.timed_out:
+            # sleeps until the server sends something or the next timer is due
             ready_to_read, ready_to_write, in_error = select.select(
-                [self.server.socket],
+                [self.server.socket, self.handlers.wakeup_socket],
                 [self.server.socket] if self.server.has_messages_to_send() else [],
                 [self.server.socket],
-                timeout,
+                self.timers.timeout(),
             )
 
             if self.server.socket in in_error:
@@ -55,27 +84,92 @@ class Client(object):
                     print("Handling broken connection read error by exiting:", e)
                     return
 
-        self.server.queue_message(tid, message)
+            if self.handlers.wakeup_socket in ready_to_read:
+                for server, tid, reply in self.handlers.completed_replies():
+                    server.batch_message(tid, reply)
+
+            # run after reading, so a reply that's waiting is always seen first
+            self.timers.run_due()
+
+    def handle_negotiation_timeout(self):
+        print("No reply to codec negotiation; sticking with the default")
+        self.start_pinging()
+
+    def handle_codec_reply(self, message):
+        # servers that don't support negotiation reply without a cmd; they (and we)
+        # then just stick with the default codec. A reply after we stopped waiting
+        # still counts, as the server has switched codec regardless.
+        if message.get("cmd") == networking.CODEC_CMD:
+            self.server.set_codec(message["codec"])
+        print("Using codec {}".format(self.server.codec.name))
+        if self.negotiation_timer is not None:
+            self.start_pinging()
+
+    def start_pinging(self):
+        self.negotiation_timer.cancel()
+        self.negotiation_timer = None
+        self.send_ping(2, count=0)
+        self.send_ping(3, count=100)
+
+    def send_ping(self, tid, count):
+        trace = None
+        if self.trace_stats is not None:
+            trace = tracing.Trace(next(self.trace_ids))
+        # batched with any other pings we send before the next send_messages()
+        self.server.batch_message(tid, build_ping_message(count), trace=trace)
+        self.ping_timeouts[tid] = self.timers.call_later(
+            PING_TIMEOUT_SECS, self.handle_ping_timeout, tid
+        )
+
+    def handle_ping_timeout(self, tid):
+        print("No pong for ping with tid {} in {}s; exiting".format(tid, PING_TIMEOUT_SECS))
+        self.timed_out = True
+
+    def print_trace_stats(self):
+        print("ping latency (us):", json.dumps(self.trace_stats.summary(), sort_keys=True))
 
     def handle_message(self, tid, message):
+        if self.trace_stats is not None:
+            trace = self.server.received_traces.pop(tid, None)
+            if trace is not None:
+                self.trace_stats.add(str(message.get("cmd")), trace)
+        if tid == CODEC_NEGOTIATION_TID:
+            self.handle_codec_reply(message)
+            return
+        if self.handlers.dispatch(self.server, tid, message):
+            return
         if "cmd" not in message:
             print("unrecognized message, tid: {}  message: {}".format(tid, message))
-            return
-        cmd = message["cmd"]
-
-        if cmd == "pong":
-            count = message["pingpong-counter"]
-            print("Received ping pong #{}! Trying {} now.".format(count, count + 1))
-            self.server.queue_message(tid, build_ping_message(count + 1))
-        elif cmd == "time":
-            time = message["time"]
-            print("Received server time broadcast! Time on server is {}".format(time))
         elif tid == 0 and "success" in message:
             # draconity is telling us whether a command we issued succeeded
-            print("Received Draconity command result: success={}, cmd={}".format(message['success'], cmd))
+            print("Received Draconity command result: success={}, cmd={}".format(message['success'], message["cmd"]))
         else:
-            print("unrecognized message method:", method)
+            print("unrecognized message cmd:", message["cmd"])
+
+    def handle_pong(self, server, tid, message):
+        count = message["pingpong-counter"]
+        print("Received ping pong #{}! Trying {} next.".format(count, count + 1))
+        ping_timeout = self.ping_timeouts.pop(tid, None)
+        if ping_timeout is not None:
+            ping_timeout.cancel()
+        self.timers.call_later(PING_INTERVAL_SECS, self.send_ping, tid, count + 1)
+
+    def handle_time(self, server, tid, message):
+        time = message["time"]
+        print("Received server time broadcast! Time on server is {}".format(time))
 
 
 if __name__ == "__main__":
-    Client().run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--url",
+        default=transports.DEFAULT_URL,
+        help="the server's: tcp://host:port, unix:///path or shm:///path",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="trace pings and print where their round trips' time goes",
+    )
+    args = parser.parse_args()
+    Client(args.url, args.trace).run()
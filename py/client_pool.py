@@ -0,0 +1,238 @@
+"""A client that any number of threads can share: each Connection runs its socket
+on a background I/O thread, and request() can be called from any thread, returning
+a concurrent.futures.Future for the reply. Requests are told apart by transaction
+id, so any number can be in flight over one connection at once. A ConnectionPool
+spreads requests over several connections, picking whichever has the fewest
+requests in flight.
+
+    pool = client_pool.ConnectionPool("tcp://localhost:8000", size=4)
+    reply = pool.request({"cmd": "ping", "pingpong-counter": 1}).result(timeout=5)
+"""
+import collections
+import concurrent.futures
+import selectors
+import socket
+import threading
+
+import buffer_pool
+import networking
+import transports
+
+MAX_TRANSACTION_ID = 2 ** 32 - 1
+
+CODEC_NEGOTIATION_TIMEOUT_SECS = 2
+
+DEFAULT_POOL_SIZE = 4
+
+
+class Connection(object):
+    """One connection to the server, driven by its own I/O thread. on_broadcast,
+    if given, is called with each broadcast message on that thread."""
+
+    def __init__(self, url=transports.DEFAULT_URL, on_broadcast=None, codec_names=None):
+        """Connects and negotiates a codec (unless codec_names is []), as
+        async_networking.connect() does"""
+        self.url = url
+        self.on_broadcast = on_broadcast
+        # SegmentPools aren't thread-safe, so each I/O thread needs its own
+        self.buffer_pool = buffer_pool.SegmentPool()
+        self.messenger = networking.Messenger(transports.connect(url), pool=self.buffer_pool)
+        self.messenger.on_send_state_change = self._update_write_interest
+        self.closed = False
+        # guards everything below, which request() touches from other threads
+        self._lock = threading.Lock()
+        self._next_tid = 1
+        # tid -> Future for requests that haven't been answered
+        self._pending = {}
+        # (tid, message) for the I/O thread to send
+        self._outgoing = collections.deque()
+        self._codec_request_tid = None
+        self._wakeup_socket, self._wakeup_writer = socket.socketpair()
+        self._wakeup_socket.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.messenger.socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_socket, selectors.EVENT_READ)
+        self._thread = threading.Thread(
+            target=self._run, name="client-io-{}".format(url), daemon=True
+        )
+        self._thread.start()
+        if codec_names != []:
+            self.negotiate_codec(codec_names)
+
+    def request(self, message):
+        """Sends message, returning a Future for the reply with the same
+        transaction id. Safe to call from any thread."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self.closed:
+                raise networking.MessengerConnectionBroken("Connection is closed", None)
+            tid = self._allocate_tid()
+            self._pending[tid] = future
+            self._outgoing.append((tid, message))
+        self._wake()
+        return future
+
+    def negotiate_codec(self, codec_names=None, timeout=CODEC_NEGOTIATION_TIMEOUT_SECS):
+        """Agrees on the fastest codec that both ends support, carrying on with the
+        default if the server doesn't reply within timeout seconds. Call this before
+        making any other requests."""
+        request = networking.build_codec_request(codec_names)
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._codec_request_tid = self._allocate_tid()
+            self._pending[self._codec_request_tid] = future
+            self._outgoing.append((self._codec_request_tid, request))
+        self._wake()
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # a reply that turns up later still switches codec, as the server will
+            # have switched too
+            pass
+        return self.messenger.codec.name
+
+    def pending_count(self):
+        """How many requests are waiting for a reply"""
+        return len(self._pending)
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self._wake()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _allocate_tid(self):
+        # called with _lock held
+        while True:
+            tid = self._next_tid
+            self._next_tid = tid + 1 if tid < MAX_TRANSACTION_ID else 1
+            if tid not in self._pending:
+                return tid
+
+    def _wake(self):
+        try:
+            self._wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            # the I/O thread has plenty of wakeups waiting already
+            pass
+        except OSError:
+            # the I/O thread has shut down, failing any requests that were pending
+            pass
+
+    def _update_write_interest(self, messenger, has_messages_to_send):
+        events = selectors.EVENT_READ
+        if has_messages_to_send:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(messenger.socket, events)
+
+    def _run(self):
+        error = networking.MessengerConnectionBroken("Connection closed", None)
+        try:
+            while not self.closed:
+                for key, events in self._selector.select():
+                    if key.fileobj is self._wakeup_socket:
+                        self._queue_outgoing()
+                    else:
+                        if events & selectors.EVENT_READ:
+                            for tid, message in self.messenger.read_messages():
+                                self._handle_message(tid, message)
+                        if events & selectors.EVENT_WRITE:
+                            self.messenger.send_messages()
+                # everything queued in this pass goes out as one batch
+                self.messenger.flush_batch()
+                self.messenger.send_messages()
+        except (
+            networking.MessengerConnectionBroken,
+            networking.MessengerBufferFullError,
+            OSError,
+        ) as e:
+            error = e
+        finally:
+            self._shut_down(error)
+
+    def _queue_outgoing(self):
+        try:
+            while self._wakeup_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            outgoing = self._outgoing
+            self._outgoing = collections.deque()
+        for tid, message in outgoing:
+            self.messenger.batch_message(tid, message)
+
+    def _handle_message(self, tid, message):
+        if tid == networking.BROADCAST_TRANSACTION_ID:
+            if self.on_broadcast is not None:
+                self.on_broadcast(message)
+            return
+        if tid == self._codec_request_tid:
+            # switch before anything else in the same read gets decoded, since the
+            # server has already switched too
+            self._codec_request_tid = None
+            if message.get("cmd") == networking.CODEC_CMD:
+                self.messenger.set_codec(message["codec"])
+        with self._lock:
+            future = self._pending.pop(tid, None)
+        if future is None:
+            print("unexpected reply, tid: {}  message: {}".format(tid, message))
+            return
+        future.set_result(message)
+
+    def _shut_down(self, error):
+        with self._lock:
+            self.closed = True
+            pending = self._pending
+            self._pending = {}
+        for future in pending.values():
+            future.set_exception(error)
+        self._selector.close()
+        self.messenger.socket.close()
+        self._wakeup_socket.close()
+        self._wakeup_writer.close()
+
+
+class ConnectionPool(object):
+    """Up to size Connections to the same server, each request going to whichever
+    has the fewest requests in flight. Connections that are lost are replaced the
+    next time a request needs one."""
+
+    def __init__(self, url=transports.DEFAULT_URL, size=DEFAULT_POOL_SIZE, **connection_args):
+        """connection_args are passed on to each Connection"""
+        self.url = url
+        self.connection_args = connection_args
+        self._lock = threading.Lock()
+        self.connections = [self._connect() for _ in range(size)]
+        self.closed = False
+
+    def _connect(self):
+        return Connection(self.url, **self.connection_args)
+
+    def request(self, message):
+        """Like Connection.request(); safe to call from any thread"""
+        with self._lock:
+            if self.closed:
+                raise networking.MessengerConnectionBroken("Pool is closed", None)
+            for i, connection in enumerate(self.connections):
+                if connection.closed:
+                    self.connections[i] = self._connect()
+            connection = min(self.connections, key=lambda c: c.pending_count())
+        return connection.request(message)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            connections = self.connections
+        for connection in connections:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
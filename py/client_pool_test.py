@@ -0,0 +1,149 @@
+import concurrent.futures
+import os
+import threading
+import unittest
+
+import buffer_pool
+import client_pool
+import handlers
+import networking
+import server
+
+
+class TestConnections(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server(("127.0.0.1", 0), sends_time_broadcasts=False)
+        self.release = threading.Event()
+
+        @self.server.handler("slow", run_in=handlers.THREAD)
+        def slow(message):
+            self.release.wait(10)
+            return {"cmd": "slow"}
+
+        @self.server.handler("echo")
+        def echo(client, tid, message):
+            return {"cmd": "echo", "data": bytes(message["data"])}
+
+        @self.server.handler("hangup")
+        def hangup(client, tid, message):
+            self.server.clients_to_remove.add(client.socket)
+
+        self.server.listen()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.stopping = True
+        self.thread.join()
+        self.server.server_socket.close()
+        for sock in list(self.server.known_clients):
+            self.server.remove_client(sock)
+        self.server.handlers.close()
+
+    def serve(self):
+        while not self.stopping:
+            self.server.poll(0.01)
+
+    def connect(self, **kwargs):
+        connection = client_pool.Connection(self.server.url, **kwargs)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_requests_from_many_threads(self):
+        connection = self.connect()
+
+        def ping(count):
+            reply = connection.request({"cmd": "ping", "pingpong-counter": count})
+            return reply.result(10)["pingpong-counter"]
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            counters = list(executor.map(ping, range(200)))
+        self.assertEqual(counters, list(range(1, 201)))
+        self.assertEqual(connection.pending_count(), 0)
+
+    def test_negotiates_codec(self):
+        connection = self.connect()
+        self.assertEqual(
+            connection.messenger.codec.name,
+            networking.build_codec_reply(networking.build_codec_request())["codec"],
+        )
+        reply = connection.request({"cmd": "ping", "pingpong-counter": 1}).result(10)
+        self.assertEqual(reply["cmd"], "pong")
+
+    def test_broadcasts(self):
+        received = []
+        broadcast_received = threading.Event()
+
+        def on_broadcast(message):
+            received.append(dict(message))
+            broadcast_received.set()
+
+        connection = self.connect(on_broadcast=on_broadcast)
+        connection.request({"cmd": "broadcast", "value": 1}).result(10)
+        self.assertTrue(broadcast_received.wait(10))
+        self.assertEqual(received, [{"cmd": "broadcast", "value": 1}])
+
+    def test_lost_connection_fails_pending_requests(self):
+        connection = self.connect()
+        slow = connection.request({"cmd": "slow"})
+        connection.request({"cmd": "hangup"})
+        with self.assertRaises(networking.MessengerConnectionBroken):
+            slow.result(10)
+        self.assertTrue(connection.closed)
+        with self.assertRaises(networking.MessengerConnectionBroken):
+            connection.request({"cmd": "ping", "pingpong-counter": 1})
+
+    def test_close_fails_pending_requests(self):
+        connection = self.connect()
+        slow = connection.request({"cmd": "slow"})
+        connection.close()
+        with self.assertRaises(networking.MessengerConnectionBroken):
+            slow.result(10)
+
+    def test_pool_picks_least_loaded_connection(self):
+        pool = client_pool.ConnectionPool(self.server.url, size=2)
+        self.addCleanup(pool.close)
+        slow = pool.request({"cmd": "slow"})
+        first, second = pool.connections
+        self.assertEqual((first.pending_count(), second.pending_count()), (1, 0))
+        # doesn't wait behind the slow request
+        ping = pool.request({"cmd": "ping", "pingpong-counter": 1})
+        self.assertEqual(ping.result(10)["pingpong-counter"], 2)
+        self.assertFalse(slow.done())
+        self.release.set()
+        self.assertEqual(slow.result(10), {"cmd": "slow"})
+
+    def test_pool_under_concurrent_large_requests(self):
+        pool = client_pool.ConnectionPool(self.server.url, size=4)
+        self.addCleanup(pool.close)
+        # each connection's I/O thread draws its buffers from a pool of its own
+        pools = [connection.buffer_pool for connection in pool.connections]
+        self.assertEqual(len(set(map(id, pools))), 4)
+        self.assertNotIn(buffer_pool.DEFAULT_POOL, pools)
+
+        def echo(n):
+            # several segments each way
+            data = os.urandom(200 * 1024)
+            reply = pool.request({"cmd": "echo", "data": data}).result(10)
+            return reply["data"] == data
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            self.assertTrue(all(executor.map(echo, range(64))))
+        for connection in pool.connections:
+            self.assertFalse(connection.closed)
+            self.assertEqual(connection.pending_count(), 0)
+
+    def test_pool_replaces_lost_connections(self):
+        pool = client_pool.ConnectionPool(self.server.url, size=1)
+        self.addCleanup(pool.close)
+        lost = pool.connections[0]
+        lost.close()
+        reply = pool.request({"cmd": "ping", "pingpong-counter": 1}).result(10)
+        self.assertEqual(reply["pingpong-counter"], 2)
+        self.assertIsNot(pool.connections[0], lost)
+
+
+if __name__ == "__main__":
+    unittest.main()
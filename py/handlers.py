@@ -0,0 +1,142 @@
+import collections
+import collections.abc
+import concurrent.futures
+import socket
+import time
+import traceback
+
+# where a handler runs: on the event loop's own thread, on a thread pool (for
+# handlers that block, e.g. on I/O) or on a process pool (for CPU-heavy handlers)
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+RUN_MODES = (INLINE, THREAD, PROCESS)
+
+
+def _as_picklable(value):
+    """Received messages are read-only views; process pool handlers get a copy made
+    of plain dicts and lists"""
+    if isinstance(value, collections.abc.Mapping):
+        return {key: _as_picklable(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_as_picklable(item) for item in value]
+    return value
+
+
+class HandlerRegistry(object):
+    """Maps each cmd to the function that handles messages with it, and where that
+    function runs.
+
+    Inline handlers are called as handler(messenger, tid, message) and may use the
+    connection directly. Handlers on a pool are called as handler(message), away
+    from the event loop, so a slow one only delays its own reply. Process pool
+    handlers must be picklable, i.e. defined at the top level of a module.
+
+    Whatever an inline handler returns (other than None) is batched back to the
+    messenger it came from as the reply, with the same transaction id. Replies from
+    pools are handed to the event loop by completed_replies(), which it should call
+    whenever wakeup_socket is readable."""
+
+    def __init__(self, max_threads=None, max_processes=None):
+        self.handlers = {}
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        # the pools are only started once something needs them
+        self._thread_pool = None
+        self._process_pool = None
+        # (messenger, tid, cmd, started_at, future) for pooled handlers that have
+        # finished; appended to from the pools' threads
+        self._completed = collections.deque()
+        self.wakeup_socket, self._wakeup_writer = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+    def handler(self, cmd, run_in=INLINE):
+        """A decorator that registers the decorated function as cmd's handler"""
+
+        def register(function):
+            self.register(cmd, function, run_in)
+            return function
+
+        return register
+
+    def register(self, cmd, function, run_in=INLINE):
+        if run_in not in RUN_MODES:
+            raise ValueError("Unknown run mode {}".format(run_in))
+        self.handlers[cmd] = (function, run_in)
+
+    def dispatch(self, messenger, tid, message):
+        """Runs the handler for message's cmd, returning False if there isn't one.
+        The time it takes (until its reply is queued, for pooled handlers) is
+        recorded in messenger.stats."""
+        cmd = message.get("cmd")
+        if not isinstance(cmd, str) or cmd not in self.handlers:
+            return False
+        function, run_in = self.handlers[cmd]
+        started_at = time.perf_counter()
+        if run_in == INLINE:
+            reply = function(messenger, tid, message)
+            if reply is not None:
+                messenger.batch_message(tid, reply)
+            elif len(messenger.received_traces) > 0:
+                messenger.discard_trace(tid)
+            messenger.stats.record_handler(cmd, time.perf_counter() - started_at)
+            return True
+
+        if run_in == THREAD:
+            future = self._get_thread_pool().submit(function, message)
+        else:
+            future = self._get_process_pool().submit(function, _as_picklable(message))
+        future.add_done_callback(
+            lambda future: self._complete(messenger, tid, cmd, started_at, future)
+        )
+        return True
+
+    def _get_thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(self.max_threads)
+        return self._thread_pool
+
+    def _get_process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(self.max_processes)
+        return self._process_pool
+
+    def _complete(self, messenger, tid, cmd, started_at, future):
+        # runs on whichever thread finished the future
+        self._completed.append((messenger, tid, cmd, started_at, future))
+        try:
+            self._wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            # the event loop has plenty of wakeups waiting already
+            pass
+
+    def completed_replies(self):
+        """Yields (messenger, tid, reply) for each pooled handler that has finished
+        with a reply since the last call, for the event loop to queue (if the
+        messenger is still connected)"""
+        try:
+            while self.wakeup_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while len(self._completed) > 0:
+            messenger, tid, cmd, started_at, future = self._completed.popleft()
+            messenger.stats.record_handler(cmd, time.perf_counter() - started_at)
+            try:
+                reply = future.result()
+            except Exception:
+                print("Handler for {} failed:".format(cmd))
+                traceback.print_exc()
+                reply = None
+            if reply is not None:
+                yield messenger, tid, reply
+            elif len(messenger.received_traces) > 0:
+                messenger.discard_trace(tid)
+
+    def close(self):
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown()
+        self.wakeup_socket.close()
+        self._wakeup_writer.close()
@@ -0,0 +1,110 @@
+import select
+import socket
+import threading
+import unittest
+
+import handlers
+import networking
+import tracing
+
+
+def double(message):
+    # module level, so the process pool can unpickle it
+    return {"cmd": "doubled", "value": message["value"] * 2, "nested": message["nested"]}
+
+
+class TestHandlerRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = handlers.HandlerRegistry(max_threads=2, max_processes=1)
+        self.sock, peer = socket.socketpair()
+        self.messenger = networking.Messenger(self.sock)
+        self.peer = networking.Messenger(peer)
+
+    def tearDown(self):
+        self.registry.close()
+        self.sock.close()
+        self.peer.socket.close()
+
+    def wait_for_replies(self, count):
+        replies = []
+        while len(replies) < count:
+            readable, _, _ = select.select([self.registry.wakeup_socket], [], [], 10)
+            self.assertTrue(readable, "timed out waiting for handlers")
+            replies.extend(self.registry.completed_replies())
+        return replies
+
+    def test_inline_reply_is_batched(self):
+        @self.registry.handler("ping")
+        def ping(messenger, tid, message):
+            self.assertIs(messenger, self.messenger)
+            return {"cmd": "pong"}
+
+        self.assertTrue(self.registry.dispatch(self.messenger, 3, {"cmd": "ping"}))
+        self.messenger.send_messages()
+        self.assertEqual(list(self.peer.read_messages()), [(3, {"cmd": "pong"})])
+        self.assertEqual(self.messenger.stats.handlers["ping"][0], 1)
+
+    def test_unknown_cmd(self):
+        self.assertFalse(self.registry.dispatch(self.messenger, 1, {"cmd": "nope"}))
+        self.assertFalse(self.registry.dispatch(self.messenger, 1, {"cmd": ["ping"]}))
+        self.assertFalse(self.registry.dispatch(self.messenger, 1, {}))
+
+    def test_unknown_run_mode(self):
+        with self.assertRaises(ValueError):
+            self.registry.register("ping", double, run_in="gpu")
+
+    def test_thread_pool_handlers_run_concurrently(self):
+        release = threading.Event()
+
+        def slow(message):
+            release.wait(10)
+            return {"cmd": "slow"}
+
+        self.registry.register("slow", slow, handlers.THREAD)
+        self.registry.register("fast", lambda message: {"cmd": "fast"}, handlers.THREAD)
+
+        self.registry.dispatch(self.messenger, 1, {"cmd": "slow"})
+        self.registry.dispatch(self.messenger, 2, {"cmd": "fast"})
+        self.assertEqual(self.wait_for_replies(1), [(self.messenger, 2, {"cmd": "fast"})])
+        release.set()
+        self.assertEqual(self.wait_for_replies(1), [(self.messenger, 1, {"cmd": "slow"})])
+        self.assertEqual(self.messenger.stats.handlers["slow"][0], 1)
+
+    def test_process_pool_gets_a_plain_copy_of_received_messages(self):
+        self.registry.register("double", double, handlers.PROCESS)
+        nested = {"a": [1, {"b": 2}]}
+        self.peer.queue_message(1, {"cmd": "double", "value": 21, "nested": nested})
+        self.peer.send_messages()
+        # a view of the received BSON, which can't be pickled as it is
+        (tid, message), = self.messenger.read_messages()
+        self.registry.dispatch(self.messenger, tid, message)
+        self.assertEqual(
+            self.wait_for_replies(1),
+            [(self.messenger, 1, {"cmd": "doubled", "value": 42, "nested": nested})],
+        )
+
+    def test_failed_handlers_do_not_reply(self):
+        def fail(message):
+            raise RuntimeError("oops")
+
+        self.registry.register("fail", fail, handlers.THREAD)
+        self.registry.register("ok", lambda message: {"cmd": "ok"}, handlers.THREAD)
+        self.registry.dispatch(self.messenger, 1, {"cmd": "fail"})
+        self.registry.dispatch(self.messenger, 2, {"cmd": "ok"})
+        self.assertEqual(self.wait_for_replies(1), [(self.messenger, 2, {"cmd": "ok"})])
+
+    def test_requests_without_replies_drop_their_traces(self):
+        def fail(message):
+            raise RuntimeError("oops")
+
+        self.registry.register("fail", fail, handlers.THREAD)
+        self.registry.register("quiet", lambda messenger, tid, message: None)
+        self.registry.register("ok", lambda message: {"cmd": "ok"}, handlers.THREAD)
+        for tid in (1, 2, 3):
+            self.messenger.received_traces[tid] = tracing.Trace(tid)
+        self.registry.dispatch(self.messenger, 1, {"cmd": "fail"})
+        self.registry.dispatch(self.messenger, 2, {"cmd": "quiet"})
+        self.registry.dispatch(self.messenger, 3, {"cmd": "ok"})
+        self.assertEqual(self.wait_for_replies(1), [(self.messenger, 3, {"cmd": "ok"})])
+        # the reply to 3 hasn't been queued yet, so its trace is still wanted
+        self.assertEqual(list(self.messenger.received_traces), [3])
@@ -0,0 +1,97 @@
+import collections
+import collections.abc
+import datetime
+import json
+
+import bson
+
+from bson_view import BsonView
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# encode(message) returns bytes; decode(frame) takes bytes or a memoryview and returns
+# a mapping (a read-only BsonView for BSON, a dict otherwise)
+Codec = collections.namedtuple("Codec", ["name", "encode", "decode"])
+
+DEFAULT_CODEC_NAME = "bson"
+
+# registered codecs, fastest first; see register_codec()
+CODECS = collections.OrderedDict()
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError("Unknown codec {}".format(name))
+    return CODECS[name]
+
+
+def choose_codec(offered_names):
+    """Returns the name of the first offered codec that is available here, falling
+    back to the default codec (which everyone must support)"""
+    for name in offered_names:
+        if name in CODECS:
+            return name
+    return DEFAULT_CODEC_NAME
+
+
+def _as_bytes(frame):
+    return frame.tobytes() if isinstance(frame, memoryview) else frame
+
+
+def _as_plain_value(value):
+    """Lets messages that contain received (read-only view) messages be encoded"""
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    raise TypeError("Can't encode {!r}".format(value))
+
+
+def _encode_bson(message):
+    if isinstance(message, BsonView):
+        # received messages can be sent on as they are
+        return message.raw()
+    return bson.dumps(message, on_unknown=_as_plain_value)
+
+
+def _decode_bson(frame):
+    # the view has to outlive the read buffer the frame is in, so this is the only
+    # point where a received body gets copied; fields are decoded when accessed
+    return BsonView(_as_bytes(frame))
+
+
+def _encode_json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return _as_plain_value(value)
+
+
+def _encode_json(message):
+    return json.dumps(
+        message, separators=(",", ":"), default=_encode_json_value
+    ).encode("utf-8")
+
+
+def _decode_json(frame):
+    return json.loads(_as_bytes(frame))
+
+
+if msgpack is not None:
+    register_codec(
+        Codec(
+            "msgpack",
+            lambda message: msgpack.packb(
+                message, use_bin_type=True, datetime=True, default=_as_plain_value
+            ),
+            lambda frame: msgpack.unpackb(frame, raw=False, timestamp=3),
+        )
+    )
+# JSON is much faster than the pure-Python bson package, but datetimes arrive as
+# ISO 8601 strings and binary values aren't supported
+register_codec(Codec("json", _encode_json, _decode_json))
+register_codec(Codec("bson", _encode_bson, _decode_bson))
@@ -0,0 +1,317 @@
+"""Microbenchmarks for the hot paths every byte goes through: the read and send
+buffers, frame parsing and message encoding. Results are saved per commit so that
+runs can be compared:
+
+    python microbenchmarks.py                   # saves microbenchmark-results/<commit>.json
+    python microbenchmarks.py --compare microbenchmark-results/abc1234.json
+"""
+import argparse
+import collections
+import io
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import timeit
+
+import networking
+from buffer_pool import SegmentedBuffer
+from ring_buffer import RingBuffer
+
+RESULTS_DIR = "microbenchmark-results"
+
+BUFFER_CAPACITY = 2 ** 20
+CHUNK_SIZES = (16, 256, 4096, 65536)
+# the largest pieces a stream of frames is split into before parsing; each is
+# split at random points up to this size, like reads from a socket
+SPLIT_SIZES = (7, 100, 1500, 65536)
+STREAM_FRAMES = 1000
+
+
+class DequeBuffer(object):
+    """A FIFO of bytes kept as a deque of the chunks written, for comparison"""
+
+    def __init__(self, size):
+        self.size = size
+        self.chunks = collections.deque()
+        self.num_bytes_used = 0
+
+    def bytes_used(self):
+        return self.num_bytes_used
+
+    def write(self, bs):
+        if len(bs) > self.size - self.num_bytes_used:
+            raise ValueError("Can't fit {} bytes into buffer".format(len(bs)))
+        self.chunks.append(bytes(bs))
+        self.num_bytes_used += len(bs)
+
+    def read(self):
+        if self.num_bytes_used == 0:
+            return None
+        chunk = self.chunks.popleft()
+        self.num_bytes_used -= len(chunk)
+        return chunk
+
+    def read_exactly(self, desired_bytes):
+        if self.num_bytes_used < desired_bytes:
+            return None
+        parts = []
+        remaining = desired_bytes
+        while remaining > 0:
+            chunk = self.chunks.popleft()
+            if len(chunk) > remaining:
+                self.chunks.appendleft(chunk[remaining:])
+                chunk = chunk[:remaining]
+            parts.append(chunk)
+            remaining -= len(chunk)
+        self.num_bytes_used -= desired_bytes
+        return b"".join(parts)
+
+
+class BytesIOBuffer(object):
+    """A FIFO of bytes kept in an io.BytesIO that is compacted once it's been read
+    halfway through, for comparison"""
+
+    def __init__(self, size):
+        self.size = size
+        self.stream = io.BytesIO()
+        self.read_offset = 0
+        self.write_offset = 0
+
+    def bytes_used(self):
+        return self.write_offset - self.read_offset
+
+    def write(self, bs):
+        if len(bs) > self.size - self.bytes_used():
+            raise ValueError("Can't fit {} bytes into buffer".format(len(bs)))
+        self.stream.seek(self.write_offset)
+        self.write_offset += self.stream.write(bs)
+
+    def read(self):
+        if self.bytes_used() == 0:
+            return None
+        return self.read_exactly(self.bytes_used())
+
+    def read_exactly(self, desired_bytes):
+        if self.bytes_used() < desired_bytes:
+            return None
+        self.stream.seek(self.read_offset)
+        data = self.stream.read(desired_bytes)
+        self.read_offset += desired_bytes
+        if self.read_offset > self.size // 2:
+            rest = self.stream.read(self.bytes_used())
+            self.stream = io.BytesIO()
+            self.stream.write(rest)
+            self.read_offset = 0
+            self.write_offset = len(rest)
+        return data
+
+
+BUFFER_DESIGNS = collections.OrderedDict(
+    [
+        ("ring", RingBuffer),
+        ("segmented", SegmentedBuffer),
+        ("deque", DequeBuffer),
+        ("bytesio", BytesIOBuffer),
+    ]
+)
+
+
+def buffer_benchmarks():
+    for chunk_size in CHUNK_SIZES:
+        chunk = os.urandom(chunk_size)
+        for design, buffer_class in BUFFER_DESIGNS.items():
+            # the ring buffer is measured with each chunk at the start of the buffer,
+            # and with it wrapping around the end
+            starts = [("", None)]
+            if design == "ring":
+                starts = [("", 0), ("-wrapped", BUFFER_CAPACITY - chunk_size // 2)]
+            for suffix, start in starts:
+                for read_name in ("read", "read_exactly"):
+                    yield (
+                        "buffer-{}{}-write-{}-{}".format(design, suffix, read_name, chunk_size),
+                        write_then_read(buffer_class, chunk, read_name, start),
+                    )
+
+
+def write_then_read(buffer_class, chunk, read_name, start=None):
+    def setup():
+        buffer = buffer_class(BUFFER_CAPACITY)
+        read = getattr(buffer, read_name)
+
+        def run():
+            if start is not None:
+                # the buffer is empty again after each run, so this is safe
+                buffer.start = start
+            buffer.write(chunk)
+            if read_name == "read":
+                # a wrapped chunk comes back in two reads
+                while read() is not None:
+                    pass
+            else:
+                read(len(chunk))
+
+        return run
+
+    return setup
+
+
+def frame_stream(num_frames):
+    return b"".join(
+        networking.encode_frame(i + 1, {"cmd": "ping", "pingpong-counter": i})
+        for i in range(num_frames)
+    )
+
+
+def split_randomly(data, max_size, seed=0):
+    rng = random.Random(seed)
+    pieces = []
+    offset = 0
+    while offset < len(data):
+        size = rng.randint(1, max_size)
+        pieces.append(data[offset : offset + size])
+        offset += size
+    return pieces
+
+
+def parse_benchmarks():
+    stream = frame_stream(STREAM_FRAMES)
+    for split_size in SPLIT_SIZES:
+        pieces = split_randomly(stream, split_size)
+        for parse_name in ("try_parse", "try_parse_frame", "parse_frames"):
+            yield (
+                "parse-{}-split-{}-per-{}-frames".format(parse_name, split_size, STREAM_FRAMES),
+                parse_pieces(pieces, parse_name),
+            )
+
+
+def parse_pieces(pieces, parse_name):
+    def setup():
+        buffer = RingBuffer(BUFFER_CAPACITY)
+        reader = networking.MessageReader()
+        parse = getattr(reader, parse_name)
+
+        def run():
+            for piece in pieces:
+                buffer.write(piece)
+                if parse_name == "parse_frames":
+                    # decoded too, to compare with try_parse as Messenger uses it
+                    frames = parse(buffer)
+                    while len(frames) > 0:
+                        reader.decode(frames.popleft()[1])
+                else:
+                    while parse(buffer) is not None:
+                        pass
+
+        return run
+
+    return setup
+
+
+def queue_benchmarks():
+    messages = [
+        ("ping", {"cmd": "ping", "pingpong-counter": 1}),
+        ("words", {"cmd": "words", "words": ["word{}".format(i) for i in range(500)]}),
+    ]
+    for codec_name in networking.message_codecs.CODECS:
+        for message_name, message in messages:
+            yield (
+                "queue_message-{}-{}".format(codec_name, message_name),
+                queue_message(codec_name, message),
+            )
+
+
+def queue_message(codec_name, message):
+    def setup():
+        sock, peer = socket.socketpair()
+        messenger = networking.Messenger(sock)
+        messenger.set_codec(codec_name)
+        send_buffer = messenger._send_buffer
+
+        def run():
+            messenger.queue_message(1, message)
+            # drop it rather than send it, so only the encoding and queuing count
+            send_buffer.discard(send_buffer.bytes_used())
+
+        run.close = lambda: (sock.close(), peer.close())
+        return run
+
+    return setup
+
+
+def all_benchmarks():
+    for benchmarks in (buffer_benchmarks, parse_benchmarks, queue_benchmarks):
+        yield from benchmarks()
+
+
+def time_benchmark(setup, repeat=5, quick=False):
+    """Returns the fastest time for a single run, in nanoseconds"""
+    run = setup()
+    try:
+        timer = timeit.Timer(run)
+        if quick:
+            return timer.timeit(1) * 1e9
+        number, _time_taken = timer.autorange()
+        return min(timer.repeat(repeat, number)) / number * 1e9
+    finally:
+        if hasattr(run, "close"):
+            run.close()
+
+
+def run_benchmarks(name_filter="", quick=False):
+    results = collections.OrderedDict()
+    for name, setup in all_benchmarks():
+        if name_filter in name:
+            results[name] = time_benchmark(setup, quick=quick)
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_comparison(results, baseline):
+    print("{:60} {:>12} {:>12} {:>7}".format("benchmark", "baseline ns", "ns", "ratio"))
+    for name, ns in results.items():
+        if name in baseline:
+            print(
+                "{:60} {:12.0f} {:12.0f} {:7.2f}".format(
+                    name, baseline[name], ns, ns / baseline[name]
+                )
+            )
+        else:
+            print("{:60} {:>12} {:12.0f}".format(name, "-", ns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this")
+    parser.add_argument("--compare", help="a previous results file to compare against")
+    parser.add_argument("--output", help="defaults to {}/<commit>.json".format(RESULTS_DIR))
+    args = parser.parse_args()
+
+    commit = current_commit()
+    results = run_benchmarks(args.filter)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f)["results"])
+    else:
+        for name, ns in results.items():
+            print("{:60} {:12.0f} ns".format(name, ns))
+
+    output = args.output or os.path.join(RESULTS_DIR, "{}.json".format(commit))
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {"commit": commit, "python": platform.python_version(), "results": results},
+            f,
+            indent=2,
+        )
+    print("results saved to", output)
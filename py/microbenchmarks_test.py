@@ -0,0 +1,48 @@
+import random
+import unittest
+
+import microbenchmarks
+
+
+class TestBufferDesigns(unittest.TestCase):
+    def test_designs_agree_with_ring_buffer(self):
+        # the alternatives are only worth comparing if they behave the same
+        rng = random.Random(1)
+        operations = []
+        for _ in range(500):
+            if rng.random() < 0.5:
+                operations.append(("write", bytes(rng.randrange(256) for _ in range(rng.randint(1, 40)))))
+            else:
+                operations.append(("read_exactly", rng.randint(0, 40)))
+
+        outputs = {}
+        for design, buffer_class in microbenchmarks.BUFFER_DESIGNS.items():
+            buffer = buffer_class(100)
+            output = []
+            for name, argument in operations:
+                if name == "write":
+                    try:
+                        buffer.write(argument)
+                    except ValueError:
+                        output.append("full")
+                else:
+                    read = buffer.read_exactly(argument)
+                    output.append(None if read is None else bytes(read))
+                output.append(buffer.bytes_used())
+            outputs[design] = output
+
+        self.assertEqual(outputs["deque"], outputs["ring"])
+        self.assertEqual(outputs["bytesio"], outputs["ring"])
+
+
+class TestMicrobenchmarks(unittest.TestCase):
+    def test_split_randomly(self):
+        data = bytes(range(256)) * 10
+        pieces = microbenchmarks.split_randomly(data, 7)
+        self.assertEqual(b"".join(pieces), data)
+        self.assertLessEqual(max(len(p) for p in pieces), 7)
+
+    def test_every_benchmark_runs(self):
+        results = microbenchmarks.run_benchmarks(quick=True)
+        self.assertEqual(list(results), [name for name, _setup in microbenchmarks.all_benchmarks()])
+        self.assertTrue(all(ns > 0 for ns in results.values()))
@@ -1,38 +1,366 @@
+import collections
+import socket
 import struct
+import time
+import zlib
 
-import bson
-
-from ring_buffer import RingBuffer
+import buffer_pool
+import message_codecs
+import tracing
 
 MSG_HEADER_FMT = "!II"  # transaction_id, data_length
 
+MSG_HEADER = struct.Struct(MSG_HEADER_FMT)
+
+MSG_HEADER_SIZE = MSG_HEADER.size
+
+# The top bit of data_length marks a zlib-compressed body, the next one a chunk (see
+# below) and the next a trace extension before the body (see tracing); the rest is
+# the body's length, extension included
+COMPRESSED_FLAG = 0x80000000
+CHUNK_FLAG = 0x40000000
+TRACE_FLAG = tracing.TRACE_FLAG
+LENGTH_MASK = 0x1FFFFFFF
+
+# frames with any of these set can't just be handed out as they're read
+SPECIAL_FRAME_FLAGS = CHUNK_FLAG | TRACE_FLAG
+
+# A frame bigger than this is sent as a series of chunk frames, each with the same
+# transaction id and a piece of the whole frame (header included) as its body, so
+# that it doesn't hold up smaller frames queued after it: they can go out between
+# its chunks. Chunks of frames with different transaction ids can be interleaved,
+# but only one frame per transaction id is sent in chunks at a time.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Large frames are sent in order of priority (highest first), taking turns with
+# others of the same priority. Small frames don't wait for them either way.
+DEFAULT_PRIORITY = 0
+
+# bodies bigger than this are compressed unless told otherwise; small messages are
+# latency-critical and wouldn't shrink much anyway
+DEFAULT_COMPRESSION_THRESHOLD = 16 * 1024
+
+# compressed bodies that would inflate to more than this are refused
+MAX_DECOMPRESSED_SIZE = 64 * 2 ** 20
+
+# how far a connection's read and send buffers may grow; they only hold memory for
+# data in flight, so this mostly limits the largest message that can be received
+DEFAULT_MAX_BUFFER_SIZE = 64 * 2 ** 20
+
+# a send queue holding more than this is backlogged (the other end isn't keeping up)
+# until it drains to the low water mark; see Messenger.on_send_backlog_change
+DEFAULT_SEND_HIGH_WATER = 2 ** 20
+DEFAULT_SEND_LOW_WATER = 256 * 1024
+
 BROADCAST_TRANSACTION_ID = 0
 
+# A frame with this transaction id is a batch: its body is a sequence of ordinary
+# frames (which can't be batches themselves), read as if they'd been sent one by one
+BATCH_TRANSACTION_ID = 2 ** 32 - 1
+
+# batches are sent once they reach this size (or when flushed)
+MAX_BATCH_SIZE = 64 * 1024
+
+# Set to print everything Messengers send and receive. It's checked before any
+# message is formatted, so leaving it off costs nothing.
+DEBUG = False
+
+# Windows has no sendmsg(), so there we fall back to sending one region at a time
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+TCP_CORK_SUPPORTED = hasattr(socket, "TCP_CORK")
+
+
+# Sent by the client (in the default codec) to agree on a codec for the rest of the
+# connection; nothing else should be sent until the reply arrives
+CODEC_CMD = "codec"
+
+
+def build_codec_request(codec_names=None):
+    """codec_names is in order of preference, defaulting to fastest first"""
+    if codec_names is None:
+        codec_names = list(message_codecs.CODECS)
+    return {"cmd": CODEC_CMD, "codecs": codec_names}
+
+
+def build_codec_reply(codec_request, allowed_codec_names=None):
+    offered = codec_request.get("codecs", [])
+    if allowed_codec_names is not None:
+        offered = [name for name in offered if name in allowed_codec_names]
+    return {"cmd": CODEC_CMD, "codec": message_codecs.choose_codec(offered)}
+
+
+def pack_frame(tid, data, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, trace=None):
+    """Returns (header, body) for an encoded message, compressing it if it's bigger
+    than compression_threshold (None to never compress) and that makes it smaller.
+    If trace (a tracing.Trace) is given, its extension follows the header."""
+    flags = 0
+    if compression_threshold is not None and len(data) > compression_threshold:
+        compressed = zlib.compress(data, 1)
+        if len(compressed) < len(data):
+            data = compressed
+            flags = COMPRESSED_FLAG
+    if trace is not None:
+        header = struct.pack(
+            MSG_HEADER_FMT,
+            tid,
+            (tracing.TRACE_EXTENSION_SIZE + len(data)) | flags | TRACE_FLAG,
+        )
+        return header + trace.pack(), data
+    return struct.pack(MSG_HEADER_FMT, tid, len(data) | flags), data
+
+
+def unpack_data_length(data_length):
+    """Splits a header's data_length into (body length, whether it's compressed)"""
+    return data_length & LENGTH_MASK, bool(data_length & COMPRESSED_FLAG)
+
+
+def encode_chunk(tid, piece):
+    """Returns the header of a chunk frame carrying piece of a larger frame"""
+    return struct.pack(MSG_HEADER_FMT, tid, len(piece) | CHUNK_FLAG)
+
+
+def read_trace(frame):
+    """Returns the tracing.Trace in a frame's trace extension, or None if it has none"""
+    if not tracing.is_traced(frame):
+        return None
+    return tracing.Trace.unpack_from(frame, MSG_HEADER_SIZE)
+
+
+def decompress_body(body):
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(body, MAX_DECOMPRESSED_SIZE)
+    except zlib.error as e:
+        raise ValueError("Invalid compressed body: {}".format(e))
+    if len(decompressor.unconsumed_tail) > 0:
+        raise ValueError("Compressed body is too large")
+    if not decompressor.eof:
+        raise ValueError("Compressed body is truncated")
+    return data
+
+
+def encode_frame(
+    tid, message, codec=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, trace=None
+):
+    """Encodes a message along with its header, so the same bytes can be queued on
+    many Messengers with queue_frame()"""
+    codec = codec or message_codecs.get_codec(message_codecs.DEFAULT_CODEC_NAME)
+    header, body = pack_frame(tid, codec.encode(message), compression_threshold, trace)
+    return header + body
+
+
+def decode_frame(frame, codec=None):
+    """The reverse of encode_frame(), returning just the message"""
+    codec = codec or message_codecs.get_codec(message_codecs.DEFAULT_CODEC_NAME)
+    _tid, data_length = MSG_HEADER.unpack_from(frame)
+    body = memoryview(frame)[MSG_HEADER_SIZE:]
+    if data_length & TRACE_FLAG:
+        body = body[tracing.TRACE_EXTENSION_SIZE :]
+    if unpack_data_length(data_length)[1]:
+        body = decompress_body(body)
+    return codec.decode(body)
+
+
+def encode_batch(frames):
+    """Wraps encoded frames (see encode_frame()) in a single batch frame"""
+    length = sum(len(frame) for frame in frames)
+    return b"".join([struct.pack(MSG_HEADER_FMT, BATCH_TRANSACTION_ID, length)] + frames)
+
+
+def split_batch(body):
+    """Yields (transaction_id, data_length, offset, length) for each frame in a
+    batch's body, where offset and length are those of the frame's header and body
+    together"""
+    offset = 0
+    while offset < len(body):
+        if len(body) - offset < MSG_HEADER_SIZE:
+            raise ValueError("Truncated frame header in batch")
+        tid, data_length = MSG_HEADER.unpack_from(body, offset)
+        length = unpack_data_length(data_length)[0]
+        if (
+            tid == BATCH_TRANSACTION_ID
+            or data_length & CHUNK_FLAG
+            or len(body) - offset < MSG_HEADER_SIZE + length
+        ):
+            raise ValueError("Invalid frame in batch")
+        yield tid, data_length, offset, MSG_HEADER_SIZE + length
+        offset += MSG_HEADER_SIZE + length
+
 
 class MessageReader(object):
-    def __init__(self):
-        self.tid = None
-        self.len = None
-        self.msg = None
+    def __init__(self, codec=None):
+        self.codec = codec or message_codecs.get_codec(message_codecs.DEFAULT_CODEC_NAME)
+        # (transaction_id, frame) for frames from the last batch (or frame
+        # reassembled from chunks) not yet returned; they're decoded as they're
+        # returned in case the codec changes part way
+        self._batched_frames = collections.deque()
+        # transaction_id -> what's arrived so far of a frame being sent in chunks
+        self._partial_frames = {}
+        # at least how many of _batched_frames carry a trace (see tracing); it only
+        # goes back to 0 once they've all been taken, but while it's 0 readers
+        # needn't look for traces
+        self.traced_frames = 0
 
-    def try_parse(self, ring_buffer):
-        header_size = struct.calcsize(MSG_HEADER_FMT)
-        if self.tid is None and ring_buffer.bytes_used() >= header_size:
-            self.tid, self.len = struct.unpack(
-                MSG_HEADER_FMT, ring_buffer.read_exactly(header_size)
-            )
+    def decode(self, frame):
+        return decode_frame(frame, self.codec)
+
+    def parse_frames(self, ring_buffer):
+        """Consumes every complete frame in ring_buffer in one pass, with batches
+        unpacked and chunks reassembled, and returns the deque of (transaction_id,
+        frame) waiting to be handled for the caller to pop them from; any it leaves
+        are still there next time (and for try_parse()). Each contiguous run of
+        complete frames is copied out of the buffer once, and the frames are views
+        of that copy. Anything incomplete is left in the buffer for the next call."""
+        if len(self._batched_frames) == 0:
+            self.traced_frames = 0
+        while True:
+            regions = ring_buffer.used_regions()
+            if len(regions) == 0:
+                break
+            consumed = self._scan_frames(regions[0])
+            if consumed > 0:
+                ring_buffer.discard(consumed)
+            if len(regions) == 1:
+                # what's left is the start of a frame that hasn't all arrived
+                break
+            # the next frame runs on into the next region
+            header = self._peek_complete_header(ring_buffer)
+            if header is None:
+                break
+            self._take_frame(ring_buffer, header[1])
+        return self._batched_frames
+
+    def _scan_frames(self, region):
+        """Adds the complete frames at the start of region, returning how many bytes
+        they take up"""
+        unpack_header = MSG_HEADER.unpack_from
+        region_length = len(region)
+        headers = []
+        offset = 0
+        while region_length - offset >= MSG_HEADER_SIZE:
+            tid, data_length = unpack_header(region, offset)
+            frame_end = offset + MSG_HEADER_SIZE + (data_length & LENGTH_MASK)
+            if frame_end > region_length:
+                break
+            headers.append((tid, data_length, offset, frame_end))
+            offset = frame_end
+        if offset == 0:
+            return 0
+
+        data = memoryview(bytes(region[:offset]))
+        append = self._batched_frames.append
+        for tid, data_length, frame_start, frame_end in headers:
+            if data_length & SPECIAL_FRAME_FLAGS or tid == BATCH_TRANSACTION_ID:
+                self._add_frame(data[frame_start:frame_end])
+            else:
+                append((tid, data[frame_start:frame_end]))
+        return offset
+
+    def _add_frame(self, frame):
+        """Queues a whole frame, header included, unpacking it if it's a batch or
+        reassembling it if it's a chunk"""
+        tid, data_length = MSG_HEADER.unpack_from(frame)
+        if data_length & CHUNK_FLAG:
+            self._add_chunk(tid, frame[MSG_HEADER_SIZE:])
+        elif tid == BATCH_TRANSACTION_ID:
+            self._queue_batch(frame, data_length)
         else:
+            self._queue_frame(tid, data_length, frame)
+
+    def _queue_frame(self, tid, data_length, frame):
+        if data_length & TRACE_FLAG:
+            self.traced_frames += 1
+        self._batched_frames.append((tid, frame))
+
+    def try_parse(self, ring_buffer):
+        """Returns (transaction_id, message) for the next message in ring_buffer, or
+        None if it doesn't hold a complete message yet. Nothing is consumed from the
+        buffer until the whole message (header and body) is available. Batches are
+        unpacked, returning each message in them in turn."""
+        if len(self._batched_frames) > 0:
+            tid, frame = self._batched_frames.popleft()
+            return tid, self.decode(frame)
+
+        header = self._peek_complete_header(ring_buffer)
+        if header is None:
+            return None
+        tid, length, compressed, chunk, traced = header
+        if chunk or traced or tid == BATCH_TRANSACTION_ID:
+            self._take_frame(ring_buffer, length)
+            return self.try_parse(ring_buffer)
+
+        ring_buffer.discard(MSG_HEADER_SIZE)
+        body = ring_buffer.peek(length)
+        if compressed:
+            body = decompress_body(body)
+        message = self.codec.decode(body)
+        ring_buffer.discard(length)
+        return tid, message
+
+    def try_parse_frame(self, ring_buffer):
+        """Like try_parse(), but returns (transaction_id, frame) where frame is the
+        undecoded bytes of the whole message, header included"""
+        if len(self._batched_frames) > 0:
+            return self._batched_frames.popleft()
+
+        header = self._peek_complete_header(ring_buffer)
+        if header is None:
+            return None
+        self._take_frame(ring_buffer, header[1])
+        return self.try_parse_frame(ring_buffer)
+
+    def _take_frame(self, ring_buffer, length):
+        # the frames are handed out after the buffer moves on, so they need a copy
+        frame = memoryview(bytes(ring_buffer.peek(MSG_HEADER_SIZE + length)))
+        ring_buffer.discard(MSG_HEADER_SIZE + length)
+        self._add_frame(frame)
+
+    def _peek_complete_header(self, ring_buffer):
+        """Returns (transaction_id, body length, whether the body is compressed,
+        whether it's a chunk, whether it's traced) if the next message is complete"""
+        header = ring_buffer.peek(MSG_HEADER_SIZE)
+        if header is None:
+            return None
+        tid, data_length = MSG_HEADER.unpack_from(header)
+        length, compressed = unpack_data_length(data_length)
+        if ring_buffer.bytes_used() < MSG_HEADER_SIZE + length:
+            return None
+        return (
+            tid,
+            length,
+            compressed,
+            bool(data_length & CHUNK_FLAG),
+            bool(data_length & TRACE_FLAG),
+        )
+
+    def _queue_batch(self, frame, data_length):
+        body = frame[MSG_HEADER_SIZE:]
+        if unpack_data_length(data_length)[1]:
+            body = memoryview(decompress_body(body))
+        for tid, frame_data_length, offset, frame_length in split_batch(body):
+            self._queue_frame(tid, frame_data_length, body[offset : offset + frame_length])
+
+    def _add_chunk(self, tid, piece):
+        partial = self._partial_frames.setdefault(tid, bytearray())
+        partial += piece
+        if len(partial) < MSG_HEADER_SIZE:
             return
-        if self.msg is None and ring_buffer.bytes_used() >= self.len:
-            self.msg = bson.loads(ring_buffer.read_exactly(self.len))
-        else:
+
+        frame_tid, data_length = MSG_HEADER.unpack_from(partial)
+        frame_length = MSG_HEADER_SIZE + unpack_data_length(data_length)[0]
+        if frame_tid != tid or data_length & CHUNK_FLAG or frame_length > MAX_DECOMPRESSED_SIZE:
+            raise ValueError("Invalid frame in chunks")
+        if len(partial) < frame_length:
             return
+        if len(partial) > frame_length:
+            raise ValueError("Chunks run past the end of their frame")
 
-        r = (self.tid, self.msg)
-        self.tid = None
-        self.len = None
-        self.msg = None
-        return r
+        del self._partial_frames[tid]
+        frame = memoryview(bytes(partial))
+        if tid == BATCH_TRANSACTION_ID:
+            self._queue_batch(frame, data_length)
+        else:
+            self._queue_frame(tid, data_length, frame)
 
 
 class MessengerConnectionBroken(Exception):
@@ -47,74 +375,518 @@ class MessengerBufferFullError(Exception):
         self.socket = socket
 
 
+class MessengerStats(object):
+    """Counters for one connection (or, added together, for many). Times are in
+    seconds; handler times are recorded by whatever handles the messages."""
+
+    COUNTERS = (
+        "bytes_in",
+        "bytes_out",
+        "frames_in",
+        "frames_out",
+        "recv_calls",
+        "send_calls",
+        "decode_secs",
+        "encode_secs",
+        "chunks_out",
+        "send_backlogs",
+        "frames_conflated",
+    )
+    HIGH_WATER_MARKS = ("read_buffer_high_water", "send_queue_high_water")
+
+    __slots__ = COUNTERS + HIGH_WATER_MARKS + ("handlers",)
+
+    def __init__(self):
+        for name in self.COUNTERS + self.HIGH_WATER_MARKS:
+            setattr(self, name, 0)
+        # cmd -> [calls, total seconds, slowest call in seconds]
+        self.handlers = {}
+
+    def record_handler(self, cmd, secs):
+        handler = self.handlers.get(cmd)
+        if handler is None:
+            self.handlers[cmd] = [1, secs, secs]
+        else:
+            handler[0] += 1
+            handler[1] += secs
+            if secs > handler[2]:
+                handler[2] = secs
+
+    def add(self, other):
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in self.HIGH_WATER_MARKS:
+            setattr(self, name, max(getattr(self, name), getattr(other, name)))
+        for cmd, (calls, total_secs, max_secs) in other.handlers.items():
+            handler = self.handlers.setdefault(cmd, [0, 0, 0])
+            handler[0] += calls
+            handler[1] += total_secs
+            handler[2] = max(handler[2], max_secs)
+
+    def as_dict(self):
+        stats = {name: getattr(self, name) for name in self.COUNTERS + self.HIGH_WATER_MARKS}
+        stats["handlers"] = {
+            cmd: {"calls": calls, "total_secs": total_secs, "max_secs": max_secs}
+            for cmd, (calls, total_secs, max_secs) in self.handlers.items()
+        }
+        return stats
+
+
+def is_tcp_socket(sock):
+    return sock.family in (socket.AF_INET, socket.AF_INET6) and (
+        sock.type == socket.SOCK_STREAM
+    )
+
+
+def set_tcp_nodelay(sock, enabled):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+
+
+def set_tcp_cork(sock, enabled):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+
+
 class Messenger(object):
-    def __init__(self, socket):
+    def __init__(
+        self,
+        socket,
+        tcp_nodelay=True,
+        tcp_cork=False,
+        compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,
+        max_buffer_size=DEFAULT_MAX_BUFFER_SIZE,
+        pool=None,
+        send_high_water=DEFAULT_SEND_HIGH_WATER,
+        send_low_water=DEFAULT_SEND_LOW_WATER,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+    ):
+        """tcp_nodelay disables Nagle's algorithm so replies go out immediately;
+        tcp_cork (Linux only) holds back partial packets while a batch of queued
+        messages is being sent. Both are ignored for non-TCP sockets. Messages
+        bigger than compression_threshold bytes once encoded are compressed (None
+        turns compression off); compressed messages are always accepted.
+
+        The read and send buffers each grow up to max_buffer_size bytes, using
+        segments from pool (default: buffer_pool.DEFAULT_POOL) that are handed
+        back as soon as they've been read or sent. Queuing more than fits in the
+        send buffer raises MessengerBufferFullError; well before that, the send
+        queue is backlogged once it holds more than send_high_water bytes, until
+        it drains to send_low_water (see on_send_backlog_change).
+
+        Frames bigger than chunk_size bytes are sent in chunks (see
+        DEFAULT_CHUNK_SIZE), so smaller frames can go out before they're done; None
+        sends every frame whole."""
+        # reads drain the socket until it would block, so it must be non-blocking
+        socket.setblocking(False)
         self.socket = socket
-        self._read_buffer = RingBuffer(2 ** 20)
-        self._send_buffer = RingBuffer(2 ** 20)
-        self._parser = MessageReader()
+        self.tcp_cork = False
+        if is_tcp_socket(socket):
+            set_tcp_nodelay(socket, tcp_nodelay)
+            self.tcp_cork = tcp_cork and TCP_CORK_SUPPORTED
+        self._read_buffer = buffer_pool.SegmentedBuffer(max_buffer_size, pool)
+        self._send_buffer = buffer_pool.SegmentedBuffer(max_buffer_size, pool)
+        self.compression_threshold = compression_threshold
+        self.codec = message_codecs.get_codec(message_codecs.DEFAULT_CODEC_NAME)
+        self._parser = MessageReader(self.codec)
+        # encoded frames waiting to go out together as one batch; see batch_message()
+        self._batch = []
+        self._batch_size = 0
+        self.chunk_size = chunk_size
+        # cmd -> priority of large messages with that cmd that are queued without one
+        self.cmd_priorities = {}
+        # transaction_id -> deque of (priority, frame) for frames being sent in
+        # chunks, along with anything queued after them with the same transaction id
+        self._chunked_frames = collections.OrderedDict()
+        self._chunked_bytes = 0
+        # called as on_send_state_change(messenger, has_messages_to_send) when the
+        # send buffer goes from empty to non-empty or back again, so that event
+        # loops only need to watch for writability while there's something to send
+        self.on_send_state_change = None
+        self.send_high_water = send_high_water
+        self.send_low_water = send_low_water
+        self.send_backlogged = False
+        # called as on_send_backlog_change(messenger, backlogged) when the send queue
+        # goes over the high water mark, and when it's drained to the low water mark
+        self.on_send_backlog_change = None
+        # conflate_key -> frame, for frames held back while backlogged; see queue_frame()
+        self._conflated_frames = collections.OrderedDict()
+        self.stats = MessengerStats()
+        self._peer_name = None
+        # see start_recording()
+        self.recorder = None
+        self.connection_id = None
+        # transaction_id -> tracing.Trace of the last traced frame received with that
+        # transaction id, stamped with when it was read
+        self.received_traces = {}
+        # set by servers, so that the replies to traced requests carry their traces
+        # back with the server's timings filled in (see tracing)
+        self.echoes_traces = False
+
+    def start_recording(self, recorder):
+        """Has recorder (a capture.Recorder) record every frame received and queued
+        from now on, under a connection id of its choosing"""
+        self.recorder = recorder
+        self.connection_id = recorder.new_connection_id()
+
+    def set_codec(self, name):
+        """Switches the codec used for messages queued and read from now on"""
+        self.codec = message_codecs.get_codec(name)
+        self._parser.codec = self.codec
+
+    def peer_name(self):
+        """The address of the other end, or the socket's file descriptor if it has
+        none (e.g. it isn't connected yet, or has gone away)"""
+        if self._peer_name is None:
+            try:
+                peer = self.socket.getpeername()
+            except OSError:
+                return "fd {}".format(self.socket.fileno())
+            if isinstance(peer, tuple):
+                peer = "{}:{}".format(*peer[:2])
+            self._peer_name = peer or "fd {}".format(self.socket.fileno())
+        return self._peer_name
+
+    def get_stats(self):
+        stats = self.stats.as_dict()
+        stats["peer"] = self.peer_name()
+        stats["codec"] = self.codec.name
+        stats["send_queue_bytes"] = self.send_queue_bytes()
+        stats["send_backlogged"] = self.send_backlogged
+        return stats
 
     def debug(self, s):
-        print("Messenger{}: {}".format(self.socket.getpeername(), s))
+        print("Messenger({}): {}".format(self.peer_name(), s))
 
     def read_messages(self):
         """Call this you when know there is readable data for this socket;
         it will yield a tuple in the format of (transaction_id, message object)
         for each message that has been received."""
-        bytes_read = self.socket.recv(2048)
-        if len(bytes_read) == 0:
-            raise MessengerConnectionBroken("Socket connection broken", self.socket)
-        self.debug("read {} bytes".format(len(bytes_read)))
+        return self._read(decode=True)
 
-        try:
-            self._read_buffer.write(bytes_read)
-        except ValueError:
-            raise MessengerBufferFullError(
-                "Failed to read message because read buffer is full", self.socket
-            )
+    def read_frames(self):
+        """Like read_messages(), but yields (transaction_id, frame) with each message
+        left encoded, e.g. to forward it with queue_frame()"""
+        return self._read(decode=False)
 
+    def _read(self, decode):
+        parser = self._parser
+        stats = self.stats
         while True:
-            parsed = self._parser.try_parse(self._read_buffer)
-            if parsed is None:
+            connection_open = self._fill_read_buffer()
+            buffer_was_full = self._read_buffer.bytes_free() == 0
+
+            read_at = time.perf_counter()
+            # every frame that has arrived is parsed in one go; they wait in the
+            # parser (in case we're not iterated to the end) and are only decoded
+            # as they're yielded, in case the codec changes part way
+            frames = self._parse(parser.parse_frames, self._read_buffer)
+            stats.decode_secs += time.perf_counter() - read_at
+
+            while len(frames) > 0:
+                tid, message = frames.popleft()
+                stats.frames_in += 1
+                if self.recorder is not None:
+                    self.recorder.record_inbound(self.connection_id, tid, message)
+                if parser.traced_frames > 0 and tracing.is_traced(message):
+                    parser.traced_frames -= 1
+                    self._receive_trace(tid, message, read_at)
+                if decode:
+                    started_at = time.perf_counter()
+                    message = self._parse(parser.decode, message)
+                    stats.decode_secs += time.perf_counter() - started_at
+                if DEBUG:
+                    self.debug(
+                        "received message; tid: {}  message: {}".format(tid, message)
+                    )
+                yield tid, message
+
+            if not connection_open:
+                raise MessengerConnectionBroken("Socket connection broken", self.socket)
+            if not buffer_was_full:
                 return
-            else:
-                (tid, message) = parsed
-                self.debug(
-                    "received message; tid: {}  message: {}".format(tid, message)
+            if self._read_buffer.bytes_free() == 0:
+                # not even part of a frame could be taken out of it
+                raise MessengerBufferFullError(
+                    "Failed to read message because read buffer is full", self.socket
                 )
-                yield tid, message
+            # the buffer filled up before the socket was drained but we've made room
+            # since, so go around again for the rest
+
+    def _receive_trace(self, tid, frame, read_at):
+        trace = read_trace(frame)
+        trace.received_at = read_at
+        # it's decoded as soon as we return
+        trace.decode_started_us = trace.since_received_us()
+        self.received_traces[tid] = trace
 
-    def queue_message(self, tid, message):
-        """An API for queuing messages for sending later"""
-        self.debug("queuing message; tid: {}  message: {}".format(tid, message))
-        data = bson.dumps(message)
-        header = struct.pack(MSG_HEADER_FMT, tid, len(data))
+    def trace_dispatched(self, tid):
+        """Records that the request with tid, if it was traced, has been handed to
+        its handler; servers call this just before they do"""
+        trace = self.received_traces.get(tid)
+        if trace is not None:
+            trace.dispatched_us = trace.since_received_us()
+
+    def discard_trace(self, tid):
+        """Forgets the trace of the request with tid, if it was traced; servers call
+        this for requests that won't get a reply, which would otherwise keep it"""
+        self.received_traces.pop(tid, None)
+
+    def _reply_trace(self, tid):
+        """The trace to send back with the reply to the request with tid, if that
+        was traced (and this end echoes traces)"""
+        if not self.echoes_traces:
+            return None
+        trace = self.received_traces.pop(tid, None)
+        if trace is not None:
+            trace.enqueued_us = trace.since_received_us()
+        return trace
+
+    def _parse(self, parse, data):
         try:
-            self._send_buffer.write(header)
-            self._send_buffer.write(data)
-        except ValueError:
-            MessengerBufferFullError(
+            return parse(data)
+        except ValueError as e:
+            # there's no telling where the next frame starts
+            raise MessengerConnectionBroken(
+                "Received a malformed message: {}".format(e), self.socket
+            )
+
+    def _fill_read_buffer(self):
+        """Receives directly into the read buffer's free space until the socket has
+        no more data for us or the buffer is full. Returns False if the connection
+        was closed by the other end."""
+        bytes_read_total = 0
+        try:
+            while True:
+                regions = self._read_buffer.free_regions()
+                if len(regions) == 0:
+                    break
+                self.stats.recv_calls += 1
+                bytes_read = self.socket.recv_into(regions[0])
+                if bytes_read == 0:
+                    return False
+                self._read_buffer.commit_write(bytes_read)
+                bytes_read_total += bytes_read
+        except BlockingIOError:
+            pass
+        finally:
+            # a read that found nothing mustn't leave a segment tied up
+            self._read_buffer.release_unused()
+            self.stats.bytes_in += bytes_read_total
+            used = self._read_buffer.bytes_used()
+            if used > self.stats.read_buffer_high_water:
+                self.stats.read_buffer_high_water = used
+            if DEBUG and bytes_read_total > 0:
+                self.debug("read {} bytes".format(bytes_read_total))
+        return True
+
+    def queue_message(self, tid, message, priority=None, trace=None):
+        """An API for queuing messages for sending later. priority only matters if
+        the message is big enough to be sent in chunks (see DEFAULT_CHUNK_SIZE); it
+        defaults to the one in cmd_priorities for the message's cmd.
+
+        If trace (a tracing.Trace) is given, the message is sent with it, and the
+        reply's trace (if the server supports tracing) turns up in received_traces.
+        Otherwise a reply to a traced request carries that request's trace back, if
+        echoes_traces is set."""
+        if DEBUG:
+            self.debug("queuing message; tid: {}  message: {}".format(tid, message))
+        self.flush_batch()
+        if trace is None and len(self.received_traces) > 0:
+            trace = self._reply_trace(tid)
+        started_at = time.perf_counter()
+        header, body = pack_frame(
+            tid, self.codec.encode(message), self.compression_threshold, trace
+        )
+        self.stats.encode_secs += time.perf_counter() - started_at
+        self._queue_bytes(header, body, priority=self._priority_of(message, priority))
+        self.stats.frames_out += 1
+
+    def _priority_of(self, message, priority):
+        if priority is None:
+            priority = self.cmd_priorities.get(message.get("cmd"), DEFAULT_PRIORITY)
+        return priority
+
+    def queue_frame(self, frame, conflate_key=None, priority=DEFAULT_PRIORITY):
+        """Queues an already encoded frame (see encode_frame()) for sending later;
+        it must have been encoded with this Messenger's codec.
+
+        If conflate_key is given and the send queue is backlogged, the frame is held
+        back until the queue drains instead, replacing any held frame with the same
+        key, so that a slow reader only gets the latest of a series of updates. Held
+        frames go out after everything queued before they were released.
+
+        priority is as for queue_message()."""
+        if DEBUG:
+            self.debug("queuing frame of {} bytes".format(len(frame)))
+        if conflate_key is not None and self.send_backlogged:
+            if conflate_key in self._conflated_frames:
+                del self._conflated_frames[conflate_key]
+                self.stats.frames_conflated += 1
+            self._conflated_frames[conflate_key] = frame
+            return
+        self.flush_batch()
+        self._queue_bytes(frame, priority=priority)
+        self.stats.frames_out += 1
+
+    def batch_message(self, tid, message, priority=None, trace=None):
+        """Like queue_message(), but adds the message to the current batch, which is
+        sent as a single frame by flush_batch(). Call that at the end of each loop
+        tick; anything else queued (and send_messages()) flushes the batch first, so
+        messages go out in the order they were queued (apart from large ones sent in
+        chunks, which smaller ones with other transaction ids can overtake)."""
+        if DEBUG:
+            self.debug("batching message; tid: {}  message: {}".format(tid, message))
+        if trace is None and len(self.received_traces) > 0:
+            trace = self._reply_trace(tid)
+        started_at = time.perf_counter()
+        frame = encode_frame(tid, message, self.codec, self.compression_threshold, trace)
+        self.stats.encode_secs += time.perf_counter() - started_at
+        if self.chunk_size is not None and len(frame) > self.chunk_size:
+            # it would be sent on its own anyway
+            self.flush_batch()
+            self._queue_bytes(frame, priority=self._priority_of(message, priority))
+            self.stats.frames_out += 1
+            return
+        if self._batch_size + len(frame) > MAX_BATCH_SIZE:
+            self.flush_batch()
+        self._batch.append(frame)
+        self._batch_size += len(frame)
+        self.stats.frames_out += 1
+
+    def flush_batch(self):
+        """Queues the current batch for sending. A batch of one message is queued as
+        an ordinary frame."""
+        if len(self._batch) == 0:
+            return
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+        if len(batch) == 1:
+            self._queue_bytes(batch[0])
+        else:
+            self._queue_bytes(encode_batch(batch))
+
+    def _queue_bytes(self, *chunks, priority=DEFAULT_PRIORITY):
+        """Queues a frame given as one or more pieces, the first holding its header"""
+        # check up front so that a full buffer never ends up with half a message
+        size = sum(len(c) for c in chunks)
+        if size > self._send_buffer.bytes_free() - self._chunked_bytes:
+            raise MessengerBufferFullError(
                 "Failed to enqueue message because send buffer is full", self.socket
             )
+        was_empty = self.send_queue_bytes() == 0
+        tid = struct.unpack_from(MSG_HEADER_FMT, chunks[0])[0]
+        if tid in self._chunked_frames or (
+            self.chunk_size is not None and size > self.chunk_size
+        ):
+            # this joins without copying if there's just the one piece
+            frame = memoryview(b"".join(chunks))
+            self._chunked_frames.setdefault(tid, collections.deque()).append(
+                (priority, frame)
+            )
+            self._chunked_bytes += size
+        else:
+            for chunk in chunks:
+                self._send_buffer.write(chunk)
+        if self.recorder is not None:
+            self.recorder.record_outbound(self.connection_id, tid, chunks)
+        used = self.send_queue_bytes()
+        if used > self.stats.send_queue_high_water:
+            self.stats.send_queue_high_water = used
+        if was_empty and self.on_send_state_change is not None:
+            self.on_send_state_change(self, True)
+        if not self.send_backlogged and used > self.send_high_water:
+            self.send_backlogged = True
+            self.stats.send_backlogs += 1
+            if self.on_send_backlog_change is not None:
+                self.on_send_backlog_change(self, True)
+
+    def _end_backlog(self):
+        self.send_backlogged = False
+        if self.on_send_backlog_change is not None:
+            self.on_send_backlog_change(self, False)
+        # these can be enough to backlog the queue again, which is reported as usual
+        conflated_frames = self._conflated_frames
+        self._conflated_frames = collections.OrderedDict()
+        for frame in conflated_frames.values():
+            self._queue_bytes(frame)
+            self.stats.frames_out += 1
+
+    def _queue_chunks(self):
+        """Moves chunks of large frames into the send buffer (highest priority first,
+        taking turns between equals) until it holds about a chunk's worth, so that
+        anything queued after this only waits for that much"""
+        chunked_frames = self._chunked_frames
+        while (
+            len(chunked_frames) > 0 and self._send_buffer.bytes_used() < self.chunk_size
+        ):
+            tid = max(chunked_frames, key=lambda t: chunked_frames[t][0][0])
+            frames = chunked_frames[tid]
+            priority, frame = frames[0]
+            piece = frame[: self.chunk_size]
+            if MSG_HEADER_SIZE + len(piece) > self._send_buffer.bytes_free():
+                break
+            self._send_buffer.write(encode_chunk(tid, piece))
+            self._send_buffer.write(piece)
+            self._chunked_bytes -= len(piece)
+            self.stats.chunks_out += 1
+            if len(piece) < len(frame):
+                frames[0] = (priority, frame[len(piece) :])
+            else:
+                frames.popleft()
+            if len(frames) == 0:
+                del chunked_frames[tid]
+            else:
+                chunked_frames.move_to_end(tid)
+
+    def send_queue_bytes(self):
+        """How many bytes are queued to be sent"""
+        return self._send_buffer.bytes_used() + self._chunked_bytes
 
     def has_messages_to_send(self):
         """Returns true if a message was previously queued but has not yet been sent"""
-        return self._send_buffer.bytes_used() > 0
+        return (
+            self.send_queue_bytes() > 0
+            or len(self._batch) > 0
+            or len(self._conflated_frames) > 0
+        )
 
     def send_messages(self):
-        """Call this to actually send messages previous queued"""
-        while True:
-            to_send = self._send_buffer.read()
-            if to_send is None:
-                break
-            self.debug("sending {} bytes".format(len(to_send)))
+        """Call this to actually send messages previous queued. Everything queued is
+        handed to the socket in a single vectored send where possible; whatever the
+        socket can't take right now stays queued for the next call."""
+        self.flush_batch()
+        if self.send_queue_bytes() == 0:
+            return
+        if self.tcp_cork:
+            set_tcp_cork(self.socket, True)
+        try:
+            while True:
+                self._queue_chunks()
+                regions = self._send_buffer.used_regions()
+                if len(regions) == 0:
+                    break
 
-            message_length = len(to_send)
-            bytes_sent_total = 0
-            while bytes_sent_total < message_length:
-                sent = self.socket.send(to_send[bytes_sent_total:])
+                self.stats.send_calls += 1
+                try:
+                    if HAS_SENDMSG:
+                        sent = self.socket.sendmsg(regions)
+                    else:
+                        sent = self.socket.send(regions[0])
+                except BlockingIOError:
+                    break
                 if sent == 0:
                     raise MessengerConnectionBroken(
                         "error sending, probably socket connection broke", self.socket
                     )
-                bytes_sent_total += sent
+                if DEBUG:
+                    self.debug("sent {} bytes".format(sent))
+                self.stats.bytes_out += sent
+                self._send_buffer.discard(sent)
+        finally:
+            if self.tcp_cork:
+                set_tcp_cork(self.socket, False)
+
+        if self.send_backlogged and self.send_queue_bytes() <= self.send_low_water:
+            self._end_backlog()
+        if self.send_queue_bytes() == 0 and self.on_send_state_change is not None:
+            self.on_send_state_change(self, False)
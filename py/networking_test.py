@@ -0,0 +1,595 @@
+import os
+import unittest
+import socket
+import struct
+import zlib
+from unittest import mock
+
+import bson
+
+import message_codecs
+import networking
+import tracing
+from buffer_pool import SegmentedBuffer, SegmentPool
+
+
+def frame(tid, message):
+    data = bson.dumps(message)
+    return struct.pack(networking.MSG_HEADER_FMT, tid, len(data)) + data
+
+
+def small_buffer(max_size):
+    # tiny segments, so that frames are split across them
+    return SegmentedBuffer(max_size, SegmentPool(16))
+
+
+class TestCodecNegotiation(unittest.TestCase):
+    def test_choose_first_available_codec(self):
+        self.assertEqual(message_codecs.choose_codec(["unknown", "json", "bson"]), "json")
+
+    def test_choose_codec_falls_back_to_bson(self):
+        self.assertEqual(message_codecs.choose_codec(["unknown"]), "bson")
+        self.assertEqual(message_codecs.choose_codec([]), "bson")
+
+    def test_codec_reply_respects_allowed_codecs(self):
+        request = networking.build_codec_request(["json", "bson"])
+        self.assertEqual(
+            networking.build_codec_reply(request, allowed_codec_names=["bson"]),
+            {"cmd": networking.CODEC_CMD, "codec": "bson"},
+        )
+        self.assertEqual(
+            networking.build_codec_reply(request),
+            {"cmd": networking.CODEC_CMD, "codec": "json"},
+        )
+
+    def test_codec_reply_to_request_without_codecs(self):
+        self.assertEqual(
+            networking.build_codec_reply({"cmd": networking.CODEC_CMD}),
+            {"cmd": networking.CODEC_CMD, "codec": "bson"},
+        )
+
+
+class TestMessageReader(unittest.TestCase):
+    def stream(self):
+        frames = [frame(i, {"cmd": "ping", "i": i}) for i in range(1, 6)]
+        big = networking.encode_frame(6, {"data": "x" * 100}, compression_threshold=None)
+        chunks = [
+            networking.encode_chunk(6, big[i : i + 30]) + big[i : i + 30]
+            for i in range(0, len(big), 30)
+        ]
+        stream = frames[0] + networking.encode_batch(frames[1:3]) + chunks[0]
+        stream += frames[3] + b"".join(chunks[1:]) + frames[4]
+        expected = [(1, frames[0]), (2, frames[1]), (3, frames[2]), (4, frames[3])]
+        expected += [(6, big), (5, frames[4])]
+        return stream, expected
+
+    def test_parse_frames_in_one_pass(self):
+        stream, expected = self.stream()
+        buffer = small_buffer(1024)
+        buffer.write(stream)
+        frames = networking.MessageReader().parse_frames(buffer)
+        self.assertEqual([(tid, bytes(frame)) for tid, frame in frames], expected)
+        self.assertEqual(buffer.bytes_used(), 0)
+
+    def test_parse_frames_resumes_partial_frames(self):
+        stream, expected = self.stream()
+        for split_size in (1, 3, 7, 8, 13, 50):
+            reader = networking.MessageReader()
+            buffer = small_buffer(1024)
+            parsed = []
+            for offset in range(0, len(stream), split_size):
+                buffer.write(stream[offset : offset + split_size])
+                frames = reader.parse_frames(buffer)
+                parsed.extend((tid, bytes(frame)) for tid, frame in frames)
+                frames.clear()
+            self.assertEqual(parsed, expected, "split every {} bytes".format(split_size))
+            self.assertEqual(buffer.bytes_used(), 0)
+
+    def test_frames_left_in_parser_are_read_next_time(self):
+        sock, peer = socket.socketpair()
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        messenger = networking.Messenger(sock)
+        peer.sendall(frame(1, {"i": 1}) + frame(2, {"i": 2}))
+        self.assertEqual(next(messenger.read_messages()), (1, {"i": 1}))
+        self.assertEqual(list(messenger.read_messages()), [(2, {"i": 2})])
+
+    def test_try_parse_traced_frame(self):
+        traced = networking.encode_frame(1, {"i": 1}, trace=tracing.Trace(7))
+        buffer = small_buffer(1024)
+        buffer.write(traced + frame(2, {"i": 2}))
+        reader = networking.MessageReader()
+        self.assertEqual(reader.try_parse(buffer), (1, {"i": 1}))
+        self.assertEqual(reader.try_parse(buffer), (2, {"i": 2}))
+
+
+class TestMessenger(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.messenger = networking.Messenger(self.sock)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_read_single_message(self):
+        self.peer.sendall(frame(1, {"cmd": "ping"}))
+        self.assertEqual(list(self.messenger.read_messages()), [(1, {"cmd": "ping"})])
+
+    def test_read_many_messages_at_once(self):
+        self.peer.sendall(b"".join(frame(i, {"n": i}) for i in range(10)))
+        self.assertEqual(
+            list(self.messenger.read_messages()), [(i, {"n": i}) for i in range(10)]
+        )
+
+    def test_read_message_split_inside_header(self):
+        data = frame(5, {"cmd": "ping"})
+        self.peer.sendall(data[:3])
+        self.assertEqual(list(self.messenger.read_messages()), [])
+        self.peer.sendall(data[3:10])
+        self.assertEqual(list(self.messenger.read_messages()), [])
+        self.peer.sendall(data[10:])
+        self.assertEqual(list(self.messenger.read_messages()), [(5, {"cmd": "ping"})])
+
+    def test_read_more_than_fits_in_buffer(self):
+        # each frame is 8 + 12 bytes, so the buffer must be drained and refilled
+        # (and frames will span segments) while reading
+        self.messenger._read_buffer = small_buffer(50)
+        self.peer.sendall(b"".join(frame(i, {"n": i}) for i in range(20)))
+        self.assertEqual(
+            list(self.messenger.read_messages()), [(i, {"n": i}) for i in range(20)]
+        )
+
+    def test_read_message_larger_than_buffer(self):
+        self.messenger._read_buffer = small_buffer(16)
+        self.peer.sendall(frame(1, {"data": "x" * 32}))
+        with self.assertRaises(networking.MessengerBufferFullError):
+            list(self.messenger.read_messages())
+
+    def test_read_after_close_yields_then_raises(self):
+        self.peer.sendall(frame(1, {"cmd": "ping"}))
+        self.peer.close()
+        received = []
+        with self.assertRaises(networking.MessengerConnectionBroken):
+            for parsed in self.messenger.read_messages():
+                received.append(parsed)
+        self.assertEqual(received, [(1, {"cmd": "ping"})])
+
+    def test_send_queued_messages(self):
+        for i in range(10):
+            self.messenger.queue_message(i, {"n": i})
+        self.assertTrue(self.messenger.has_messages_to_send())
+        self.messenger.send_messages()
+        self.assertFalse(self.messenger.has_messages_to_send())
+        self.assertEqual(
+            self.peer.recv(4096), b"".join(frame(i, {"n": i}) for i in range(10))
+        )
+
+    def test_send_messages_spanning_segments(self):
+        self.messenger._send_buffer = small_buffer(50)
+        self.messenger.queue_message(1, {"n": 1})
+        self.messenger.queue_message(2, {"n": 2})
+        self.assertEqual(len(self.messenger._send_buffer.used_regions()), 3)
+        self.messenger.send_messages()
+        self.assertEqual(
+            self.peer.recv(4096), b"".join(frame(i, {"n": i}) for i in range(1, 3))
+        )
+
+    def test_send_never_queues_partial_message(self):
+        self.messenger._send_buffer = small_buffer(30)
+        self.messenger.queue_message(1, {"n": 1})
+        with self.assertRaises(networking.MessengerBufferFullError):
+            self.messenger.queue_message(2, {"n": 2})
+        self.assertEqual(self.messenger._send_buffer.bytes_used(), 20)
+
+    def test_send_keeps_what_socket_cannot_take(self):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.messenger.compression_threshold = None
+        self.messenger.chunk_size = None
+        big = {"data": "x" * 100000}
+        self.messenger.queue_message(1, big)
+        self.messenger.send_messages()
+        self.assertTrue(self.messenger.has_messages_to_send())
+
+        received = bytearray()
+        expected = frame(1, big)
+        while len(received) < len(expected):
+            self.messenger.send_messages()
+            received.extend(self.peer.recv(65536))
+        self.assertEqual(bytes(received), expected)
+
+    def test_send_state_change_callbacks(self):
+        changes = []
+        self.messenger.on_send_state_change = lambda m, pending: changes.append(pending)
+        self.messenger.queue_message(1, {"n": 1})
+        self.messenger.queue_message(2, {"n": 2})
+        self.assertEqual(changes, [True])
+        self.messenger.send_messages()
+        self.assertEqual(changes, [True, False])
+        self.messenger.send_messages()
+        self.assertEqual(changes, [True, False])
+
+    def test_send_backlog_callbacks(self):
+        changes = []
+        self.messenger.on_send_backlog_change = lambda m, backlogged: changes.append(backlogged)
+        self.messenger.send_high_water = 50
+        self.messenger.send_low_water = 0
+        # each of these is 20 bytes
+        for i in range(2):
+            self.messenger.queue_message(i, {"n": i})
+        self.assertEqual(changes, [])
+        self.messenger.queue_message(2, {"n": 2})
+        self.assertTrue(self.messenger.send_backlogged)
+        self.assertEqual(changes, [True])
+        self.messenger.send_messages()
+        self.assertFalse(self.messenger.send_backlogged)
+        self.assertEqual(changes, [True, False])
+        self.assertEqual(self.messenger.get_stats()["send_backlogs"], 1)
+
+    def test_conflate_frames_while_backlogged(self):
+        self.messenger.send_high_water = 10
+        self.messenger.send_low_water = 0
+        first = networking.encode_frame(0, {"cmd": "time", "n": 1})
+        self.messenger.queue_frame(first, "time")
+        self.assertTrue(self.messenger.send_backlogged)
+        # held back, and only the latest of each key is kept
+        for n in range(2, 5):
+            self.messenger.queue_frame(networking.encode_frame(0, {"cmd": "time", "n": n}), "time")
+        self.messenger.queue_frame(networking.encode_frame(0, {"cmd": "other"}), "other")
+        self.messenger.queue_message(1, {"cmd": "reply"})
+
+        peer = networking.Messenger(self.peer)
+        self.messenger.send_messages()
+        # the held frames are queued once the backlog clears
+        self.messenger.send_messages()
+        self.assertEqual(
+            list(peer.read_messages()),
+            [
+                (0, {"cmd": "time", "n": 1}),
+                (1, {"cmd": "reply"}),
+                (0, {"cmd": "time", "n": 4}),
+                (0, {"cmd": "other"}),
+            ],
+        )
+        self.assertEqual(self.messenger.stats.frames_conflated, 2)
+
+    def test_queue_frame(self):
+        encoded = networking.encode_frame(0, {"cmd": "time"})
+        self.assertEqual(encoded, frame(0, {"cmd": "time"}))
+        self.messenger.queue_frame(encoded)
+        self.messenger.queue_frame(encoded)
+        self.messenger.send_messages()
+        self.assertEqual(self.peer.recv(4096), encoded * 2)
+
+    def test_batch_messages(self):
+        peer = networking.Messenger(self.peer)
+        for i in range(10):
+            self.messenger.batch_message(i + 1, {"n": i})
+        self.assertTrue(self.messenger.has_messages_to_send())
+        self.messenger.send_messages()
+
+        expected_body = b"".join(frame(i + 1, {"n": i}) for i in range(10))
+        received = self.peer.recv(4096)
+        self.assertEqual(
+            struct.unpack_from(networking.MSG_HEADER_FMT, received),
+            (networking.BATCH_TRANSACTION_ID, len(expected_body)),
+        )
+        self.assertEqual(received[networking.MSG_HEADER_SIZE :], expected_body)
+
+        self.sock.sendall(received)
+        self.assertEqual(
+            list(peer.read_messages()), [(i + 1, {"n": i}) for i in range(10)]
+        )
+        self.sock.sendall(received)
+        self.assertEqual(
+            list(peer.read_frames()), [(i + 1, frame(i + 1, {"n": i})) for i in range(10)]
+        )
+
+    def test_batch_of_one_is_an_ordinary_frame(self):
+        self.messenger.batch_message(1, {"n": 1})
+        self.messenger.flush_batch()
+        self.messenger.send_messages()
+        self.assertEqual(self.peer.recv(4096), frame(1, {"n": 1}))
+
+    def test_queued_messages_stay_in_order_with_batches(self):
+        self.messenger.batch_message(1, {"n": 1})
+        self.messenger.batch_message(2, {"n": 2})
+        self.messenger.queue_message(3, {"n": 3})
+        self.messenger.send_messages()
+        self.assertEqual(
+            self.peer.recv(4096),
+            networking.encode_batch([frame(1, {"n": 1}), frame(2, {"n": 2})])
+            + frame(3, {"n": 3}),
+        )
+
+    def test_large_batches_are_split(self):
+        data = "x" * (networking.MAX_BATCH_SIZE // 3)
+        self.messenger.compression_threshold = None
+        peer = networking.Messenger(self.peer)
+        for i in range(5):
+            self.messenger.batch_message(i, {"data": data})
+        self.messenger.send_messages()
+        received = []
+        while len(received) < 5:
+            received.extend(peer.read_messages())
+        self.assertEqual(received, [(i, {"data": data}) for i in range(5)])
+
+    def test_read_malformed_batch(self):
+        # claims to hold a 100 byte frame, but there's only the header
+        inner = struct.pack(networking.MSG_HEADER_FMT, 1, 100)
+        self.peer.sendall(networking.encode_batch([inner]))
+        with self.assertRaises(networking.MessengerConnectionBroken):
+            list(self.messenger.read_messages())
+
+    def chunking_peer(self):
+        """A Messenger on the other end that chunks frames bigger than 100 bytes"""
+        return networking.Messenger(self.peer, compression_threshold=None, chunk_size=100)
+
+    def test_large_messages_are_sent_in_chunks(self):
+        peer = self.chunking_peer()
+        big = {"data": "x" * 1000}
+        peer.queue_message(1, big)
+        peer.send_messages()
+
+        header = self.sock.recv(networking.MSG_HEADER_SIZE, socket.MSG_PEEK)
+        tid, data_length = struct.unpack(networking.MSG_HEADER_FMT, header)
+        self.assertEqual((tid, data_length), (1, 100 | networking.CHUNK_FLAG))
+        self.assertEqual(list(self.messenger.read_messages()), [(1, big)])
+        self.assertEqual(peer.stats.chunks_out, 11)
+        self.assertEqual(peer.stats.frames_out, 1)
+
+    def test_small_messages_overtake_large_ones(self):
+        peer = self.chunking_peer()
+        peer.queue_message(1, {"data": "x" * 1000})
+        peer.queue_message(2, {"cmd": "pong"})
+        # one with the same tid as a frame being chunked has to wait for it
+        peer.queue_message(1, {"cmd": "after"})
+        peer.send_messages()
+        self.assertEqual(
+            [tid for tid, _message in self.messenger.read_messages()], [2, 1, 1]
+        )
+
+    def test_chunked_frames_take_turns_by_priority(self):
+        peer = self.chunking_peer()
+        peer.cmd_priorities["result"] = 1
+        peer.queue_message(1, {"cmd": "upload", "data": "x" * 1000})
+        peer.queue_message(2, {"cmd": "upload", "data": "y" * 1000})
+        peer.queue_message(3, {"cmd": "result", "data": "z" * 1000})
+        peer.queue_message(4, {"cmd": "upload", "data": "z" * 1000}, priority=1)
+        peer.send_messages()
+        # the higher priority ones finish first; the others alternate, so 1 finishes
+        # one chunk before 2
+        self.assertEqual(
+            [tid for tid, _message in self.messenger.read_messages()], [3, 4, 1, 2]
+        )
+
+    def test_read_chunked_frames_undecoded(self):
+        peer = self.chunking_peer()
+        encoded = networking.encode_frame(0, {"cmd": "time", "data": "x" * 1000}, None, None)
+        peer.queue_frame(encoded)
+        peer.batch_message(1, {"n": 1})
+        peer.batch_message(2, {"n": 2})
+        peer.send_messages()
+        self.assertEqual(
+            [(tid, bytes(f)) for tid, f in self.messenger.read_frames()],
+            [(1, frame(1, {"n": 1})), (2, frame(2, {"n": 2})), (0, encoded)],
+        )
+
+    def test_read_chunked_batch(self):
+        peer = networking.Messenger(self.peer, compression_threshold=None, chunk_size=30)
+        peer.batch_message(1, {"n": 1})
+        peer.batch_message(2, {"n": 2})
+        peer.send_messages()
+        self.assertEqual(peer.stats.chunks_out, 2)
+        self.assertEqual(list(self.messenger.read_messages()), [(1, {"n": 1}), (2, {"n": 2})])
+
+    def test_read_malformed_chunks(self):
+        # a chunk holding the start of a frame with another transaction id
+        inner = frame(2, {"n": 1})
+        self.peer.sendall(networking.encode_chunk(1, inner) + inner)
+        with self.assertRaises(networking.MessengerConnectionBroken):
+            list(self.messenger.read_messages())
+
+    def test_large_messages_are_compressed(self):
+        peer = networking.Messenger(self.peer)
+        big = {"words": ["word{}".format(i) for i in range(10000)]}
+        self.messenger.queue_message(1, big)
+        self.messenger.queue_message(2, {"n": 2})
+        self.messenger.send_messages()
+
+        header = self.peer.recv(networking.MSG_HEADER_SIZE, socket.MSG_PEEK)
+        tid, data_length = struct.unpack(networking.MSG_HEADER_FMT, header)
+        length, compressed = networking.unpack_data_length(data_length)
+        self.assertTrue(compressed)
+        self.assertLess(length, len(bson.dumps(big)) / 2)
+        self.assertEqual(list(peer.read_messages()), [(1, big), (2, {"n": 2})])
+
+    def test_compression_threshold(self):
+        data = bson.dumps({"data": "x" * 100})
+        self.assertEqual(networking.pack_frame(1, data, None)[1], data)
+        self.assertEqual(networking.pack_frame(1, data, len(data))[1], data)
+        header, body = networking.pack_frame(1, data, len(data) - 1)
+        self.assertLess(len(body), len(data))
+        self.assertEqual(
+            networking.decode_frame(header + body), {"data": "x" * 100}
+        )
+
+    def test_incompressible_messages_are_sent_as_they_are(self):
+        data = bson.dumps({"data": os.urandom(1024)})
+        self.assertEqual(networking.pack_frame(1, data, 0)[1], data)
+
+    def test_compressed_batches_and_frames_in_batches(self):
+        big = {"data": "x" * 1000}
+        inner = networking.encode_frame(2, big, compression_threshold=0)
+        _tid, data_length = struct.unpack_from(networking.MSG_HEADER_FMT, inner)
+        self.assertTrue(networking.unpack_data_length(data_length)[1])
+        body = zlib.compress(frame(1, {"n": 1}) + inner)
+        self.peer.sendall(
+            struct.pack(
+                networking.MSG_HEADER_FMT,
+                networking.BATCH_TRANSACTION_ID,
+                len(body) | networking.COMPRESSED_FLAG,
+            )
+            + body
+        )
+        self.assertEqual(list(self.messenger.read_messages()), [(1, {"n": 1}), (2, big)])
+
+    def test_read_traced_messages(self):
+        peer = networking.Messenger(self.peer)
+        big = {"data": "x" * 1000}
+        peer.compression_threshold = 0
+        peer.queue_message(1, big, trace=tracing.Trace(10))
+        peer.batch_message(2, {"n": 2}, trace=tracing.Trace(20))
+        peer.batch_message(3, {"n": 3})
+        peer.send_messages()
+
+        self.assertEqual(
+            list(self.messenger.read_messages()), [(1, big), (2, {"n": 2}), (3, {"n": 3})]
+        )
+        traces = self.messenger.received_traces
+        self.assertEqual(sorted(traces), [1, 2])
+        self.assertEqual([traces[1].trace_id, traces[2].trace_id], [10, 20])
+        self.assertIsNotNone(traces[1].received_at)
+        # a traced frame can still be forwarded as it is
+        self.assertTrue(tracing.is_traced(networking.encode_frame(1, {}, trace=traces[1])))
+
+    def test_replies_carry_traces_back(self):
+        peer = networking.Messenger(self.peer)
+        trace = tracing.Trace(99)
+        peer.queue_message(1, {"cmd": "ping"}, trace=trace)
+        peer.queue_message(2, {"cmd": "ping"}, trace=tracing.Trace(100))
+        peer.send_messages()
+        list(self.messenger.read_messages())
+
+        self.messenger.echoes_traces = True
+        self.messenger.trace_dispatched(1)
+        self.messenger.batch_message(1, {"cmd": "pong"})
+        self.messenger.batch_message(3, {"cmd": "untraced"})
+        self.messenger.send_messages()
+        self.assertEqual(
+            list(peer.read_messages()), [(1, {"cmd": "pong"}), (3, {"cmd": "untraced"})]
+        )
+        reply_trace = peer.received_traces[1]
+        self.assertEqual((reply_trace.trace_id, reply_trace.sent_at_us), (99, trace.sent_at_us))
+        self.assertLessEqual(reply_trace.decode_started_us, reply_trace.dispatched_us)
+        self.assertLessEqual(reply_trace.dispatched_us, reply_trace.enqueued_us)
+        self.assertEqual(sorted(peer.received_traces), [1])
+        # the unanswered one is still waiting for its reply
+        self.assertEqual(sorted(self.messenger.received_traces), [2])
+
+    def test_replies_arent_traced_unless_echoing(self):
+        peer = networking.Messenger(self.peer)
+        peer.queue_message(1, {"cmd": "ping"}, trace=tracing.Trace(1))
+        peer.send_messages()
+        list(self.messenger.read_messages())
+        self.messenger.queue_message(1, {"cmd": "pong"})
+        self.messenger.send_messages()
+        self.assertEqual(self.peer.recv(4096), frame(1, {"cmd": "pong"}))
+
+    def test_read_corrupt_compressed_message(self):
+        self.peer.sendall(
+            struct.pack(networking.MSG_HEADER_FMT, 1, 4 | networking.COMPRESSED_FLAG)
+            + b"junk"
+        )
+        with self.assertRaises(networking.MessengerConnectionBroken):
+            list(self.messenger.read_messages())
+
+    def test_read_compressed_message_too_large(self):
+        body = zlib.compress(bytes(1025))
+        self.peer.sendall(
+            struct.pack(networking.MSG_HEADER_FMT, 1, len(body) | networking.COMPRESSED_FLAG)
+            + body
+        )
+        with mock.patch.object(networking, "MAX_DECOMPRESSED_SIZE", 1024):
+            with self.assertRaises(networking.MessengerConnectionBroken):
+                list(self.messenger.read_messages())
+
+    def test_buffers_hold_no_memory_when_idle(self):
+        pool = SegmentPool(16)
+        messenger = networking.Messenger(self.sock, pool=pool)
+        peer = networking.Messenger(self.peer, pool=pool)
+        messenger.queue_message(1, {"data": "x" * 100})
+        self.assertGreater(messenger._send_buffer.segments_held(), 1)
+        messenger.send_messages()
+        self.assertEqual(messenger._send_buffer.segments_held(), 0)
+
+        self.assertEqual(list(peer.read_messages()), [(1, {"data": "x" * 100})])
+        self.assertEqual(list(peer.read_messages()), [])
+        self.assertEqual(peer._read_buffer.segments_held(), 0)
+        self.assertEqual(pool.get_stats()["segments_free"], pool.allocated)
+
+    def test_read_message_larger_than_a_segment(self):
+        big = {"data": os.urandom(3 * 2 ** 20)}
+        self.messenger.compression_threshold = None
+        peer = networking.Messenger(self.peer)
+        self.messenger.queue_message(1, big)
+        received = []
+        while len(received) == 0:
+            self.messenger.send_messages()
+            received.extend(peer.read_messages())
+        self.assertEqual(received, [(1, big)])
+
+    def test_stats(self):
+        peer = networking.Messenger(self.peer)
+        self.messenger.queue_message(1, {"n": 1})
+        self.messenger.batch_message(2, {"n": 2})
+        self.messenger.batch_message(3, {"n": 3})
+        self.messenger.send_messages()
+        self.assertEqual(len(list(peer.read_messages())), 3)
+
+        sent = self.messenger.get_stats()
+        received = peer.get_stats()
+        self.assertEqual(sent["frames_out"], 3)
+        self.assertEqual(received["frames_in"], 3)
+        self.assertEqual(sent["bytes_out"], received["bytes_in"])
+        self.assertEqual(sent["send_calls"], 1)
+        self.assertEqual(sent["send_queue_high_water"], sent["bytes_out"])
+        self.assertEqual(sent["send_queue_bytes"], 0)
+        self.assertEqual(received["read_buffer_high_water"], received["bytes_in"])
+        self.assertGreater(sent["encode_secs"], 0)
+        self.assertGreater(received["decode_secs"], 0)
+
+    def test_stats_add_up(self):
+        totals = networking.MessengerStats()
+        for secs in (0.5, 1.5):
+            stats = networking.MessengerStats()
+            stats.frames_in = 2
+            stats.read_buffer_high_water = secs * 10
+            stats.record_handler("ping", secs)
+            stats.record_handler("ping", secs)
+            totals.add(stats)
+        self.assertEqual(totals.frames_in, 4)
+        self.assertEqual(totals.read_buffer_high_water, 15)
+        self.assertEqual(
+            totals.as_dict()["handlers"],
+            {"ping": {"calls": 4, "total_secs": 4.0, "max_secs": 1.5}},
+        )
+
+    def test_peer_name_before_connecting(self):
+        # getpeername() fails until a connection completes
+        sock = socket.socket()
+        try:
+            messenger = networking.Messenger(sock)
+            self.assertEqual(messenger.peer_name(), "fd {}".format(sock.fileno()))
+        finally:
+            sock.close()
+
+    def assert_codec_round_trips(self, codec_name):
+        peer = networking.Messenger(self.peer)
+        self.messenger.set_codec(codec_name)
+        peer.set_codec(codec_name)
+        message = {"cmd": "ping", "pingpong-counter": 1, "words": ["a", "b"]}
+        self.messenger.queue_message(7, message)
+        self.messenger.send_messages()
+        self.assertEqual(list(peer.read_messages()), [(7, message)])
+
+    def test_set_codec_json(self):
+        self.assert_codec_round_trips("json")
+
+    @unittest.skipIf(message_codecs.msgpack is None, "msgpack is not installed")
+    def test_set_codec_msgpack(self):
+        self.assert_codec_round_trips("msgpack")
+
+    def test_set_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            self.messenger.set_codec("unknown")
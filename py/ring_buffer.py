@@ -21,6 +21,42 @@ class RingBuffer(object):
     def bytes_free(self):
         return self.bytes_total() - self.bytes_used()
 
+    def free_regions(self):
+        """Returns memoryviews over the unused space of the buffer in the order it
+        will be filled; there are two of them when the free space wraps around."""
+        size = len(self.buffer)
+        if self.num_bytes_used == size:
+            return []
+
+        view = memoryview(self.buffer)
+        end = self.start + self.num_bytes_used
+        if end < size:
+            regions = [view[end:size], view[0:self.start]]
+        else:
+            regions = [view[end - size:self.start]]
+        return [r for r in regions if len(r) > 0]
+
+    def used_regions(self):
+        """Returns memoryviews over the used space of the buffer in the order it
+        will be read; there are two of them when the used space wraps around."""
+        if self.num_bytes_used == 0:
+            return []
+
+        view = memoryview(self.buffer)
+        end = self.start + self.num_bytes_used
+        if end <= len(self.buffer):
+            return [view[self.start:end]]
+        return [view[self.start:], view[0:end - len(self.buffer)]]
+
+    def commit_write(self, num_bytes):
+        """Marks bytes written directly into the views from free_regions() as used"""
+        if num_bytes > self.bytes_free():
+            message = "Can't commit {} bytes into buffer ({} used, {} free of total {})".format(
+                num_bytes, self.bytes_used(), self.bytes_free(), self.bytes_total()
+            )
+            raise ValueError(message)
+        self.num_bytes_used += num_bytes
+
     def write(self, bs):
         if len(bs) > self.bytes_free():
             message = "Can't fit {} bytes into buffer ({} used, {} free of total {})".format(
@@ -98,3 +134,35 @@ class RingBuffer(object):
 
         self.num_bytes_used -= len(read_bytes)
         return read_bytes
+
+    def peek(self, desired_bytes):
+        """Returns the next desired_bytes bytes without consuming them, or None if
+        there aren't that many. This is a memoryview into the buffer (no copy) unless
+        the bytes wrap around the end of the buffer."""
+        if desired_bytes < 0:
+            raise ValueError("desired bytes of {} is less than 0".format(desired_bytes))
+        elif self.bytes_used() < desired_bytes:
+            return None
+
+        offset_end = self.start + desired_bytes
+        if offset_end <= len(self.buffer):
+            return memoryview(self.buffer)[self.start:offset_end]
+        wrapped_end = offset_end - len(self.buffer)
+        return self.buffer[self.start:] + self.buffer[:wrapped_end]
+
+    def discard(self, num_bytes):
+        """Consumes num_bytes bytes without returning them (e.g. after a peek())"""
+        if num_bytes < 0 or num_bytes > self.bytes_used():
+            raise ValueError(
+                "Can't discard {} bytes from buffer ({} used)".format(
+                    num_bytes, self.bytes_used()
+                )
+            )
+        if num_bytes == 0:
+            return
+        self.num_bytes_used -= num_bytes
+        if self.num_bytes_used == 0:
+            # rewind so the next write gets the largest possible contiguous region
+            self.start = 0
+        else:
+            self.start = (self.start + num_bytes) % len(self.buffer)
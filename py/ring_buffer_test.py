@@ -140,6 +140,84 @@ class TestRingBuffer(unittest.TestCase):
         b.write(b"defg")
         self.assertEqual(b.read_exactly(4), b"defg")
 
+    def test_free_regions_empty(self):
+        b = RingBuffer(4)
+        self.assertEqual([bytes(r) for r in b.free_regions()], [bytes(4)])
+
+    def test_free_regions_full(self):
+        b = RingBuffer(4)
+        b.write(b"abcd")
+        self.assertEqual(b.free_regions(), [])
+
+    def test_free_regions_wrapping(self):
+        b = RingBuffer(6)
+        b.write(b"abcd")
+        self.assertEqual(b.read_exactly(2), b"ab")
+        self.assertEqual([len(r) for r in b.free_regions()], [2, 2])
+
+        b.write(b"ef")
+        self.assertEqual([len(r) for r in b.free_regions()], [2])
+
+    def test_writing_into_free_regions(self):
+        b = RingBuffer(6)
+        b.write(b"abcd")
+        self.assertEqual(b.read_exactly(3), b"abc")
+
+        first, second = b.free_regions()
+        first[:] = b"ef"
+        second[:2] = b"gh"
+        b.commit_write(4)
+        self.assertEqual(b.read_exactly(5), b"defgh")
+
+    def test_used_regions(self):
+        b = RingBuffer(4)
+        self.assertEqual(b.used_regions(), [])
+        b.write(b"abcd")
+        self.assertEqual([bytes(r) for r in b.used_regions()], [b"abcd"])
+
+    def test_used_regions_wrapping(self):
+        b = RingBuffer(4)
+        b.write(b"abc")
+        self.assertEqual(b.read_exactly(2), b"ab")
+        b.write(b"de")
+        self.assertEqual([bytes(r) for r in b.used_regions()], [b"cd", b"e"])
+
+    def test_commit_write_respects_bytes_free(self):
+        b = RingBuffer(4)
+        b.write(b"ab")
+        with self.assertRaises(ValueError):
+            b.commit_write(3)
+
+    def test_peek_does_not_consume(self):
+        b = RingBuffer(4)
+        b.write(b"abc")
+        self.assertEqual(b.peek(2), b"ab")
+        self.assertIsInstance(b.peek(2), memoryview)
+        self.assertEqual(b.bytes_used(), 3)
+        self.assertEqual(b.peek(4), None)
+
+    def test_peek_wrapping(self):
+        b = RingBuffer(4)
+        b.write(b"abc")
+        self.assertEqual(b.read_exactly(3), b"abc")
+        b.write(b"efg")
+        self.assertEqual(b.peek(3), b"efg")
+        self.assertEqual(b.read_exactly(3), b"efg")
+
+    def test_discard(self):
+        b = RingBuffer(4)
+        b.write(b"abc")
+        b.discard(2)
+        self.assertEqual(b.read(), b"c")
+        with self.assertRaises(ValueError):
+            b.discard(1)
+
+    def test_discard_everything_rewinds(self):
+        b = RingBuffer(4)
+        b.write(b"abc")
+        b.discard(3)
+        self.assertEqual([len(r) for r in b.free_regions()], [4])
+
     def test_random_operations(self):
         """A quicktest-lite test to verify various operations work as intended"""
         debug_this = False
@@ -1,14 +1,49 @@
-import select
-import socket
+import argparse
 import datetime
+import json
+import os
+import selectors
+import socket
+import time
+import traceback
 
+import buffer_pool
+import capture
+import handlers
+import message_codecs
 import networking
+import timers
+import topics
+import transports
 
 BROADCAST_INTERVAL_SECS = 5
 
+DEFAULT_HOST_AND_PORT = ("localhost", 8000)
+
+# How many connections the OS holds for us until we accept them (capped by the
+# OS's own limit, somaxconn on Linux). It needs to be large enough for every client
+# reconnecting at once after a restart, or connections beyond it are refused (or
+# their SYNs dropped, so they wait for a retry).
+DEFAULT_LISTEN_BACKLOG = 1024
+
+# the most connections accepted per poll, so that established clients get a turn
+# between batches during a reconnect storm
+ACCEPT_BATCH_SIZE = 64
 
-def calc_next_broadcast_time():
-    return datetime.datetime.now() + datetime.timedelta(0, BROADCAST_INTERVAL_SECS)
+# max_accept_rate is enforced over intervals this long
+ACCEPT_RATE_INTERVAL_SECS = 0.1
+
+# how long to stop accepting for when we're out of file descriptors
+ACCEPT_ERROR_BACKOFF_SECS = 0.1
+
+# What to do about a client whose send queue is backlogged because it isn't reading
+# what it's sent:
+#   pause: stop reading its requests until it catches up
+#   conflate: hold back its broadcasts until it catches up, keeping only the latest
+#     of each cmd
+#   disconnect: drop it
+# Whatever the policy, a client is dropped once its send buffer is full.
+SLOW_CONSUMER_POLICIES = ("pause", "conflate", "disconnect")
 
 
 def build_time_message():
@@ -20,68 +55,392 @@ def build_time_message():
 
 
 class Server(object):
-    def __init__(self):
+    def __init__(
+        self,
+        host_and_port=DEFAULT_HOST_AND_PORT,
+        reuse_port=False,
+        hub_socket=None,
+        sends_time_broadcasts=True,
+        allowed_codec_names=None,
+        stats_interval_secs=None,
+        slow_consumer_policy="pause",
+        send_high_water=networking.DEFAULT_SEND_HIGH_WATER,
+        send_low_water=networking.DEFAULT_SEND_LOW_WATER,
+        max_handler_threads=None,
+        max_handler_processes=None,
+        url=None,
+        recorder=None,
+        listen_backlog=DEFAULT_LISTEN_BACKLOG,
+        max_connections=None,
+        max_accept_rate=None,
+    ):
+        """Listens on url if given (see transports for the schemes), otherwise over
+        TCP on host_and_port. reuse_port lets several worker processes listen on
+        the same port, and hub_socket connects this worker to a BroadcastHub that
+        relays broadcasts between workers (see serve_workers()). allowed_codec_names
+        limits which codecs clients may negotiate (default: any registered codec).
+        If stats_interval_secs is given, get_stats() is printed that often.
+        slow_consumer_policy (one of SLOW_CONSUMER_POLICIES) is applied to clients
+        while more than send_high_water bytes are queued for them, until that
+        drains to send_low_water.
+
+        Each cmd is handled by a function registered with handler(); the pools
+        that handlers can run on have up to max_handler_threads threads and
+        max_handler_processes processes (by default, as many as
+        concurrent.futures picks).
+
+        If recorder (a capture.Recorder) is given, every client's traffic is
+        recorded with it.
+
+        listen_backlog is how many connections can wait to be accepted. Once
+        max_connections clients are connected, new connections are closed as
+        soon as they're accepted, and no more than max_accept_rate connections
+        are accepted per second (the rest wait in the backlog)."""
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError("Unknown slow consumer policy {}".format(slow_consumer_policy))
+        self.host_and_port = host_and_port
+        self.url = url or transports.tcp_url(host_and_port)
+        self.listen_backlog = listen_backlog
+        self.max_connections = max_connections
+        self.accepts_per_interval = None
+        if max_accept_rate is not None:
+            self.accepts_per_interval = max(
+                int(max_accept_rate * ACCEPT_RATE_INTERVAL_SECS), 1
+            )
+        self.accept_interval_started_at = 0
+        self.accepts_this_interval = 0
+        # false while accepting is paused, when the listening socket isn't watched
+        self.accepting = False
+        self.connections_accepted = 0
+        self.connections_rejected = 0
+        self.accept_pauses = 0
+        self.allowed_codec_names = allowed_codec_names
+        self.reuse_port = reuse_port
         self.known_clients = {}
-        self.next_broadcast_at = calc_next_broadcast_time()
+        # which clients each broadcast goes to
+        self.topics = topics.TopicIndex()
+        self.recorder = recorder
+        self.slow_consumer_policy = slow_consumer_policy
+        self.send_high_water = send_high_water
+        self.send_low_water = send_low_water
+        # clients to drop at the end of this poll; they can't be removed while
+        # known_clients is being iterated over
+        self.clients_to_remove = set()
+        self.started_at = time.monotonic()
+        # what clients that have since gone away added to the totals
+        self.removed_client_stats = networking.MessengerStats()
+        self.stats_interval_secs = stats_interval_secs
+        # poll() waits no longer than until the next of these is due
+        self.timers = timers.TimerQueue()
+        self.time_broadcast_timer = None
+        if sends_time_broadcasts:
+            self.time_broadcast_timer = self.timers.call_every(
+                BROADCAST_INTERVAL_SECS, self.publish_time
+            )
+        if stats_interval_secs is not None:
+            self.timers.call_every(stats_interval_secs, self.print_stats)
+        self.selector = selectors.DefaultSelector()
+        self.server_socket = None
+        self.handlers = handlers.HandlerRegistry(max_handler_threads, max_handler_processes)
+        self.selector.register(self.handlers.wakeup_socket, selectors.EVENT_READ)
+        self.handler("ping")(self.handle_ping)
+        self.handler("broadcast")(self.handle_broadcast)
+        self.handler("stats")(self.handle_stats)
+        self.handler(networking.CODEC_CMD)(self.handle_codec)
+        self.handler("subscribe")(self.handle_subscribe)
+        self.handler("unsubscribe")(self.handle_unsubscribe)
+        self.hub = None
+        if hub_socket is not None:
+            self.hub = networking.Messenger(hub_socket)
+            self.hub.on_send_state_change = self.update_write_interest
+            self.selector.register(hub_socket, selectors.EVENT_READ, self.hub)
 
     def serve(self):
-        host_and_port = ("localhost", 8000)
-        connection_backlog_limit = 5
-
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setblocking(False)
-        server_socket.bind(host_and_port)
-        server_socket.listen(connection_backlog_limit)
-        print("server listening on", host_and_port)
-
-        while True:
-            timeout = 0.01  # in seconds
-            sockets_needing_writes = [
-                s for s, c in self.known_clients.items() if c.has_messages_to_send()
-            ]
-            if len(sockets_needing_writes) > 0:
-                print("{} sockets need writes".format(len(sockets_needing_writes)))
-            ready_to_read, ready_to_write, in_error = select.select(
-                [server_socket] + list(self.known_clients.keys()),
-                sockets_needing_writes,
-                self.known_clients,
-                timeout,
-            )
+        self.listen()
+        try:
+            while True:
+                self.poll()
+        finally:
+            if self.recorder is not None:
+                # so that a capture ended with Ctrl-C isn't missing its last records
+                self.recorder.close()
+
+    def listen(self):
+        server_socket = transports.listen(self.url, self.listen_backlog, self.reuse_port)
+        if server_socket.family != socket.AF_UNIX:
+            # the port is only known now if we asked for any free one
+            self.host_and_port = server_socket.getsockname()[:2]
+            self.url = transports.tcp_url(self.host_and_port)
+        print("server listening on", self.url)
+        self.server_socket = server_socket
+        self.resume_accepting()
 
-            for sock in in_error:
-                self.handle_errored_socket(sock)
+    def poll(self, timeout=None):
+        """Handles whatever socket activity there is, waiting up to timeout seconds
+        (or forever if None) for some, but never past the next timer that's due
+        (see self.timers)"""
+        for key, events in self.selector.select(self.timers.timeout(timeout)):
+            sock = key.fileobj
+            if sock == self.server_socket:
+                self.accept_clients()
+                continue
+            elif self.hub is not None and sock == self.hub.socket:
+                self.handle_hub_events(events)
+                continue
+            elif sock == self.handlers.wakeup_socket:
+                self.handle_completed_handlers()
+                continue
 
-            for sock in ready_to_write:
+            if events & selectors.EVENT_WRITE:
                 self.handle_writable_socket(sock)
+            if events & selectors.EVENT_READ:
+                self.handle_readable_socket(sock)
+        self.remove_slow_clients()
+
+        if self.timers.run_due() > 0:
+            # in case a timer queued more than a slow client could take
+            self.remove_slow_clients()
+
+    def publish_time(self):
+        self.publish(build_time_message())
 
-            for sock in ready_to_read:
-                if sock == server_socket:
-                    (client_socket, address) = server_socket.accept()
-                    print("Accepting connection from {}".format(address))
-                    self.known_clients[client_socket] = networking.Messenger(
-                        client_socket
-                    )
-                    self.handle_readable_socket(client_socket)
+    def print_stats(self):
+        print("stats:", json.dumps(self.get_stats(), sort_keys=True))
+
+    def handler(self, cmd, run_in=handlers.INLINE):
+        """A decorator that makes the decorated function the handler for cmd, run
+        where run_in (one of handlers.RUN_MODES) says; see handlers.HandlerRegistry
+        for how it's called and how its reply is sent.
+
+            @server.handler("transcribe", run_in=handlers.PROCESS)
+            def transcribe(message):
+                return {"cmd": "transcribed", "text": recognize(message["audio"])}
+        """
+        return self.handlers.handler(cmd, run_in)
+
+    def handle_completed_handlers(self):
+        for client, tid, reply in self.handlers.completed_replies():
+            if self.known_clients.get(client.socket) is not client:
+                # it's gone away while its message was being handled
+                continue
+            try:
+                client.queue_message(tid, reply)
+            except networking.MessengerBufferFullError as e:
+                print("Handling full send buffer by removing client:", e)
+                self.remove_client(client.socket)
+
+    def get_stats(self):
+        """Counters for each connected client, and totals that include clients that
+        have disconnected (see networking.MessengerStats). With several workers,
+        this only covers the worker it's called in."""
+        totals = networking.MessengerStats()
+        totals.add(self.removed_client_stats)
+        clients = []
+        for client in self.known_clients.values():
+            totals.add(client.stats)
+            clients.append(client.get_stats())
+        stats = {
+            "uptime_secs": time.monotonic() - self.started_at,
+            "pid": os.getpid(),
+            "clients": clients,
+            "listener": {
+                "accepted": self.connections_accepted,
+                "rejected": self.connections_rejected,
+                "pauses": self.accept_pauses,
+                "accepting": self.accepting,
+            },
+            "totals": totals.as_dict(),
+            "buffer_pool": buffer_pool.DEFAULT_POOL.get_stats(),
+        }
+        if self.hub is not None:
+            stats["hub"] = self.hub.get_stats()
+        return stats
+
+    def publish(self, message):
+        """Sends message to every connected client subscribed to its topic (see
+        topics), including those connected to other worker processes. The message
+        is only encoded once per codec in use; the default codec's frame is shared
+        with the hub."""
+        frames_by_codec = {}
+        if self.hub is not None:
+            frame = networking.encode_frame(networking.BROADCAST_TRANSACTION_ID, message)
+            frames_by_codec[message_codecs.DEFAULT_CODEC_NAME] = frame
+            try:
+                self.hub.queue_frame(frame)
+            except networking.MessengerBufferFullError as e:
+                print("Dropping broadcast for other workers:", e)
+        self.publish_locally(frames_by_codec, message)
+
+    def publish_locally(self, frames_by_codec, message=None):
+        """Sends a broadcast to this worker's clients that are subscribed to its
+        topic. frames_by_codec maps codec names to already encoded frames; frames
+        for any other codecs are encoded from message (decoded from the default
+        codec's frame if not given) and added to frames_by_codec."""
+        if message is None:
+            # only what's needed to find the topic is actually decoded
+            message = networking.decode_frame(frames_by_codec[message_codecs.DEFAULT_CODEC_NAME])
+        topic = topics.topic_of(message)
+        recipients = self.topics.subscribers(topic)
+        if len(recipients) > 0:
+            print(
+                "Sending {} broadcast to {} of {} connected clients".format(
+                    topic, len(recipients), len(self.known_clients)
+                )
+            )
+        full_clients = []
+        for client in recipients:
+            # a backlogged client's broadcasts are conflated by topic
+            conflate = client.send_backlogged and self.slow_consumer_policy == "conflate"
+            frame = frames_by_codec.get(client.codec.name)
+            if frame is None:
+                frame = networking.encode_frame(
+                    networking.BROADCAST_TRANSACTION_ID, message, client.codec
+                )
+                frames_by_codec[client.codec.name] = frame
+            try:
+                client.queue_frame(frame, topic if conflate else None)
+            except networking.MessengerBufferFullError as e:
+                print("Handling full send buffer by removing client:", e)
+                full_clients.append(client.socket)
+        for sock in full_clients:
+            self.remove_client(sock)
+
+    def handle_hub_events(self, events):
+        """Broadcasts that came from other workers only go to this worker's clients;
+        the hub has already sent them to every other worker. They arrive in the
+        default codec, so clients using that get the frame exactly as it was sent."""
+        try:
+            if events & selectors.EVENT_WRITE:
+                self.hub.send_messages()
+            if events & selectors.EVENT_READ:
+                for _tid, frame in self.hub.read_frames():
+                    self.publish_locally({message_codecs.DEFAULT_CODEC_NAME: frame})
+        except (networking.MessengerConnectionBroken, OSError) as e:
+            # the launcher has gone away, so this worker should too
+            raise SystemExit("Lost connection to broadcast hub: {}".format(e))
+
+    def accept_clients(self):
+        """Accepts connections until there are none waiting, up to ACCEPT_BATCH_SIZE
+        at a time. New clients aren't read from until the next poll says they have
+        something to read, so a reconnect storm doesn't hold up everyone else."""
+        for _ in range(ACCEPT_BATCH_SIZE):
+            if self.accepts_per_interval is not None and not self.take_accept_token():
+                return
+            at_capacity = (
+                self.max_connections is not None
+                and len(self.known_clients) >= self.max_connections
+            )
+            try:
+                if at_capacity:
+                    # closed before the shared memory handshake, if there'd be one
+                    client_socket, address = self.server_socket.accept()
                 else:
-                    self.handle_readable_socket(sock)
-
-            if datetime.datetime.now() > self.next_broadcast_at:
-                self.next_broadcast_at = calc_next_broadcast_time()
-                if len(self.known_clients) > 0:
-                    print(
-                        "Sending server time broadcast to all {} connected clients".format(
-                            len(self.known_clients)
-                        )
-                    )
-                    for client in self.known_clients.values():
-                        client.queue_message(
-                            networking.BROADCAST_TRANSACTION_ID, build_time_message()
-                        )
-
-    def handle_errored_socket(self, sock):
-        print("socket in error", socket.getpeername())
+                    client_socket, address = transports.accept(self.url, self.server_socket)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # e.g. out of file descriptors: the connection stays waiting, so
+                # stop watching for it for a bit rather than spin on it
+                print("Failed to accept connection:", e)
+                self.pause_accepting(ACCEPT_ERROR_BACKOFF_SECS)
+                return
+            if at_capacity:
+                self.connections_rejected += 1
+                print("Rejecting connection from {}: too many clients".format(address))
+                client_socket.close()
+                continue
+            self.connections_accepted += 1
+            print("Accepting connection from {}".format(address))
+            self.add_client(client_socket)
+
+    def take_accept_token(self):
+        """Returns whether max_accept_rate allows accepting another connection now,
+        pausing accepting until the next interval if not"""
+        now = time.monotonic()
+        if now - self.accept_interval_started_at >= ACCEPT_RATE_INTERVAL_SECS:
+            self.accept_interval_started_at = now
+            self.accepts_this_interval = 0
+        if self.accepts_this_interval >= self.accepts_per_interval:
+            self.pause_accepting(
+                self.accept_interval_started_at + ACCEPT_RATE_INTERVAL_SECS - now
+            )
+            return False
+        self.accepts_this_interval += 1
+        return True
+
+    def pause_accepting(self, secs):
+        """Stops watching the listening socket for secs seconds; connections wait in
+        its backlog meanwhile"""
+        if not self.accepting:
+            return
+        self.accepting = False
+        self.accept_pauses += 1
+        self.selector.unregister(self.server_socket)
+        self.timers.call_later(secs, self.resume_accepting)
+
+    def resume_accepting(self):
+        if self.accepting or self.server_socket is None:
+            return
+        self.accepting = True
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+    def add_client(self, client_socket):
+        client = networking.Messenger(
+            client_socket,
+            send_high_water=self.send_high_water,
+            send_low_water=self.send_low_water,
+        )
+        client.on_send_state_change = self.update_write_interest
+        client.on_send_backlog_change = self.handle_send_backlog_change
+        # replies to traced requests say how long we took over them
+        client.echoes_traces = True
+        if self.recorder is not None:
+            client.start_recording(self.recorder)
+        self.known_clients[client_socket] = client
+        self.topics.add(client)
+        self.selector.register(client_socket, selectors.EVENT_READ, client)
+        return client
+
+    def update_write_interest(self, client, has_messages_to_send):
+        events = selectors.EVENT_READ
+        if (
+            client.send_backlogged
+            and self.slow_consumer_policy == "pause"
+            and client is not self.hub
+        ):
+            # a backlogged client always has something to send, so this never
+            # leaves it with no events
+            events = 0
+        if has_messages_to_send:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(client.socket, events, client)
+
+    def handle_send_backlog_change(self, client, backlogged):
+        if backlogged:
+            print(
+                "Client {} is not keeping up; applying slow consumer policy: {}".format(
+                    client.peer_name(), self.slow_consumer_policy
+                )
+            )
+        else:
+            print("Client {} has caught up".format(client.peer_name()))
+        if self.slow_consumer_policy == "pause":
+            self.update_write_interest(client, client.has_messages_to_send())
+        elif self.slow_consumer_policy == "disconnect" and backlogged:
+            self.clients_to_remove.add(client.socket)
+
+    def remove_slow_clients(self):
+        for sock in self.clients_to_remove:
+            self.remove_client(sock)
+        self.clients_to_remove.clear()
+
+    def remove_client(self, sock):
         if sock in self.known_clients:
-            del self.known_clients[sock]
+            client = self.known_clients.pop(sock)
+            self.removed_client_stats.add(client.stats)
+            self.topics.remove(client)
+            self.selector.unregister(sock)
+        sock.close()
 
     def handle_writable_socket(self, sock):
         if sock not in self.known_clients:
@@ -91,7 +450,10 @@ class Server(object):
             self.known_clients[sock].send_messages()
         except networking.MessengerConnectionBroken as e:
             print("Handling broken connection send error by removing client:", e)
-            del self.known_clients[sock]
+            self.remove_client(sock)
+        except OSError as e:
+            print("Handling socket send error by removing client:", e)
+            self.remove_client(sock)
 
     def handle_readable_socket(self, sock):
         if sock not in self.known_clients:
@@ -101,28 +463,252 @@ class Server(object):
         try:
             for tid, message in client.read_messages():
                 self.handle_message(client, tid, message)
+            # the replies to everything that arrived in this read go out as one frame
+            client.flush_batch()
         except networking.MessengerBufferFullError as e:
             print("Handling full buffer read error by removing client:", e)
-            sock.close()
-            del self.known_clients[sock]
+            self.remove_client(sock)
         except networking.MessengerConnectionBroken as e:
             print("Handling broken connection read error by removing client:", e)
-            del self.known_clients[sock]
+            self.remove_client(sock)
+        except OSError as e:
+            print("Handling socket read error by removing client:", e)
+            self.remove_client(sock)
 
     def handle_message(self, client, tid, message):
+        if len(client.received_traces) > 0:
+            client.trace_dispatched(tid)
+        if self.handlers.dispatch(client, tid, message):
+            return
         if "cmd" not in message:
             print("unrecognized message, tid: {}  message: {}".format(tid, message))
-            return
-        cmd = message["cmd"]
+        else:
+            print("unrecognized message cmd:", message["cmd"])
+        # counted under "None" if there's no usable cmd
+        client.stats.record_handler(str(message.get("cmd")), 0)
+        if len(client.received_traces) > 0:
+            client.discard_trace(tid)
+
+    def handle_ping(self, client, tid, message):
+        return {"cmd": "pong", "pingpong-counter": message["pingpong-counter"] + 1}
+
+    def handle_broadcast(self, client, tid, message):
+        # sends the message on to every client, this one included
+        self.publish(message)
+        return {"cmd": "broadcast", "success": True}
+
+    def handle_subscribe(self, client, tid, message):
+        return self.update_subscriptions(client, message, self.topics.subscribe)
 
-        if cmd == "ping":
-            client.queue_message(tid, {
-                "cmd": "pong",
-                "pingpong-counter": message["pingpong-counter"] + 1
-            })
+    def handle_unsubscribe(self, client, tid, message):
+        return self.update_subscriptions(client, message, self.topics.unsubscribe)
+
+    def update_subscriptions(self, client, message, update):
+        """Handles {"cmd": "subscribe" or "unsubscribe", "topics": [pattern, ...]},
+        replying with every pattern the client is now subscribed to"""
+        patterns = message.get("topics")
+        if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+            return {
+                "cmd": message["cmd"],
+                "success": False,
+                "error": "topics must be a list of strings",
+            }
+        for pattern in patterns:
+            update(client, pattern)
+        return {
+            "cmd": message["cmd"],
+            "success": True,
+            "topics": self.topics.patterns_of(client),
+        }
+
+    def handle_stats(self, client, tid, message):
+        return {"cmd": "stats", "stats": self.get_stats()}
+
+    def handle_codec(self, client, tid, message):
+        # the reply goes out in the old codec; everything after uses the new one
+        reply = networking.build_codec_reply(message, self.allowed_codec_names)
+        client.queue_message(tid, reply)
+        client.set_codec(reply["codec"])
+
+
+class BroadcastHub(object):
+    """Runs in the launcher process and relays each broadcast it receives from one
+    worker to every other worker, so every client gets it exactly once. Frames are
+    forwarded without being decoded. on_worker_lost(sock) is called when a worker's
+    connection goes away."""
+
+    def __init__(self, worker_sockets, on_worker_lost=None):
+        self.selector = selectors.DefaultSelector()
+        self.on_worker_lost = on_worker_lost
+        self.workers = {}
+        for sock in worker_sockets:
+            worker = networking.Messenger(sock)
+            worker.on_send_state_change = self.update_write_interest
+            self.workers[sock] = worker
+            self.selector.register(sock, selectors.EVENT_READ, worker)
+
+    def update_write_interest(self, worker, has_messages_to_send):
+        events = selectors.EVENT_READ
+        if has_messages_to_send:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(worker.socket, events, worker)
+
+    def serve(self):
+        while len(self.workers) > 0:
+            self.poll()
+
+    def poll(self, timeout=None):
+        for key, events in self.selector.select(timeout):
+            worker = key.data
+            if worker.socket not in self.workers:
+                continue
+            try:
+                if events & selectors.EVENT_WRITE:
+                    worker.send_messages()
+                if events & selectors.EVENT_READ:
+                    for _tid, frame in worker.read_frames():
+                        self.relay(worker, frame)
+            except (networking.MessengerConnectionBroken, OSError) as e:
+                print("Worker connection lost:", e)
+                del self.workers[worker.socket]
+                self.selector.unregister(worker.socket)
+                worker.socket.close()
+                if self.on_worker_lost is not None:
+                    self.on_worker_lost(worker.socket)
+
+    def relay(self, sender, frame):
+        for worker in self.workers.values():
+            if worker is not sender:
+                try:
+                    worker.queue_frame(frame)
+                except networking.MessengerBufferFullError as e:
+                    print("Dropping broadcast for stalled worker:", e)
+
+
+def serve_workers(
+    num_workers,
+    host_and_port=DEFAULT_HOST_AND_PORT,
+    stats_interval_secs=None,
+    slow_consumer_policy="pause",
+    listen_backlog=DEFAULT_LISTEN_BACKLOG,
+    max_connections=None,
+    max_accept_rate=None,
+):
+    """Forks num_workers server processes that share the listening port (Linux's
+    SO_REUSEPORT spreads new connections between them), then relays broadcasts
+    between them until they've all exited. Only the first worker sends the
+    periodic time broadcast; each worker reports its own stats, and has its own
+    max_connections and max_accept_rate."""
+    pids_by_hub_socket = {}
+    for worker_num in range(num_workers):
+        hub_end, worker_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            hub_end.close()
+            for sock in pids_by_hub_socket:
+                sock.close()
+            try:
+                Server(
+                    host_and_port,
+                    reuse_port=True,
+                    hub_socket=worker_end,
+                    sends_time_broadcasts=worker_num == 0,
+                    stats_interval_secs=stats_interval_secs,
+                    slow_consumer_policy=slow_consumer_policy,
+                    listen_backlog=listen_backlog,
+                    max_connections=max_connections,
+                    max_accept_rate=max_accept_rate,
+                ).serve()
+            except BaseException:
+                # os._exit() skips the interpreter's own reporting, so do it here
+                traceback.print_exc()
+            finally:
+                os._exit(1)
+        worker_end.close()
+        pids_by_hub_socket[hub_end] = pid
+        print("started worker {} with pid {}".format(worker_num, pid))
+
+    def reap_worker(hub_socket):
+        pid = pids_by_hub_socket.pop(hub_socket)
+        _pid, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            print("worker with pid {} killed by signal {}".format(pid, os.WTERMSIG(status)))
         else:
-            print("unrecognized message cmd:", cmd)
+            print("worker with pid {} exited with code {}".format(pid, os.WEXITSTATUS(status)))
+
+    BroadcastHub(list(pids_by_hub_socket), reap_worker).serve()
 
 
 if __name__ == "__main__":
-    Server().serve()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--url",
+        default=transports.DEFAULT_URL,
+        help="where to listen: tcp://host:port, unix:///path or shm:///path",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of server processes to run (more than 1 needs SO_REUSEPORT)",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        help="print connection and command stats every this many seconds",
+    )
+    parser.add_argument(
+        "--slow-consumer-policy",
+        choices=SLOW_CONSUMER_POLICIES,
+        default="pause",
+        help="what to do about clients that aren't reading what they're sent",
+    )
+    parser.add_argument(
+        "--listen-backlog",
+        type=int,
+        default=DEFAULT_LISTEN_BACKLOG,
+        help="how many connections can wait to be accepted",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        help="close new connections straight away once this many clients are connected",
+    )
+    parser.add_argument(
+        "--max-accept-rate",
+        type=float,
+        help="accept at most this many connections per second (the rest wait)",
+    )
+    parser.add_argument(
+        "--capture", help="record every client's traffic to this file, to replay with capture.py"
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="print every message sent and received"
+    )
+    args = parser.parse_args()
+    networking.DEBUG = args.debug
+    if args.workers > 1:
+        scheme, host_and_port = transports.parse_url(args.url)
+        if scheme != "tcp":
+            parser.error("--workers needs a tcp:// URL")
+        if args.capture is not None:
+            parser.error("--capture only works with one worker")
+        serve_workers(
+            args.workers,
+            host_and_port,
+            stats_interval_secs=args.stats_interval,
+            slow_consumer_policy=args.slow_consumer_policy,
+            listen_backlog=args.listen_backlog,
+            max_connections=args.max_connections,
+            max_accept_rate=args.max_accept_rate,
+        )
+    else:
+        Server(
+            url=args.url,
+            recorder=None if args.capture is None else capture.Recorder(args.capture),
+            stats_interval_secs=args.stats_interval,
+            slow_consumer_policy=args.slow_consumer_policy,
+            listen_backlog=args.listen_backlog,
+            max_connections=args.max_connections,
+            max_accept_rate=args.max_accept_rate,
+        ).serve()
@@ -0,0 +1,365 @@
+import unittest
+import selectors
+import socket
+import struct
+import threading
+from unittest import mock
+
+import handlers
+import networking
+import server
+import tracing
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server()
+        self.client_end, peer = socket.socketpair()
+        self.client = self.server.add_client(self.client_end)
+        self.peer = networking.Messenger(peer)
+
+    def tearDown(self):
+        self.client_end.close()
+        self.peer.socket.close()
+
+    def test_codec_reply_sent_in_old_codec(self):
+        request = networking.build_codec_request(["json"])
+        self.server.handle_message(self.client, 1, request)
+        self.server.handle_message(
+            self.client, 2, {"cmd": "ping", "pingpong-counter": 1}
+        )
+        self.client.send_messages()
+
+        # the reply is BSON, and everything after it JSON
+        self.assertEqual(self.client.codec.name, "json")
+        self.assertEqual(
+            next(self.peer.read_messages()),
+            (1, {"cmd": networking.CODEC_CMD, "codec": "json"}),
+        )
+        self.peer.set_codec("json")
+        self.assertEqual(
+            list(self.peer.read_messages()),
+            [(2, {"cmd": "pong", "pingpong-counter": 2})],
+        )
+
+    def test_replies_to_a_read_are_batched(self):
+        for i in range(3):
+            self.peer.queue_message(i + 1, {"cmd": "ping", "pingpong-counter": i})
+        self.peer.send_messages()
+        self.server.handle_readable_socket(self.client_end)
+        self.client.send_messages()
+
+        header = self.peer.socket.recv(networking.MSG_HEADER_SIZE)
+        self.assertEqual(
+            struct.unpack(networking.MSG_HEADER_FMT, header)[0],
+            networking.BATCH_TRANSACTION_ID,
+        )
+        self.assertEqual(
+            list(self.peer.read_messages()),
+            [(i + 1, {"cmd": "pong", "pingpong-counter": i + 1}) for i in range(3)],
+        )
+
+    def test_traced_requests_get_timings_back(self):
+        ping = {"cmd": "ping", "pingpong-counter": 1}
+        self.peer.batch_message(1, ping, trace=tracing.Trace(5))
+        self.peer.batch_message(2, {"cmd": "ping", "pingpong-counter": 2})
+        self.peer.send_messages()
+        self.server.handle_readable_socket(self.client_end)
+        self.client.send_messages()
+
+        self.assertEqual([tid for tid, _ in self.peer.read_messages()], [1, 2])
+        trace = self.peer.received_traces.pop(1)
+        self.assertEqual(trace.trace_id, 5)
+        self.assertGreater(trace.enqueued_us, 0)
+        self.assertLessEqual(trace.dispatched_us, trace.enqueued_us)
+        self.assertEqual(self.peer.received_traces, {})
+        self.assertEqual(self.client.received_traces, {})
+
+    def test_unrecognized_traced_requests_drop_their_traces(self):
+        self.peer.batch_message(1, {"cmd": "nope"}, trace=tracing.Trace(5))
+        self.peer.batch_message(2, {"no": "cmd"}, trace=tracing.Trace(6))
+        self.peer.send_messages()
+        self.server.handle_readable_socket(self.client_end)
+        self.assertEqual(self.client.received_traces, {})
+
+    def test_stats_command(self):
+        self.peer.queue_message(1, {"cmd": "ping", "pingpong-counter": 1})
+        self.peer.queue_message(2, {"cmd": "stats"})
+        self.peer.send_messages()
+        self.server.handle_readable_socket(self.client_end)
+        self.client.send_messages()
+
+        replies = dict(self.peer.read_messages())
+        stats = replies[2]["stats"]
+        self.assertEqual(len(stats["clients"]), 1)
+        self.assertEqual(stats["clients"][0]["frames_in"], 2)
+        self.assertEqual(stats["totals"]["handlers"]["ping"]["calls"], 1)
+
+    def test_stats_include_removed_clients(self):
+        self.peer.queue_message(1, {"cmd": "ping", "pingpong-counter": 1})
+        self.peer.send_messages()
+        self.server.handle_readable_socket(self.client_end)
+        self.server.remove_client(self.client_end)
+
+        stats = self.server.get_stats()
+        self.assertEqual(stats["clients"], [])
+        self.assertEqual(stats["totals"]["frames_in"], 1)
+        self.assertEqual(stats["totals"]["handlers"]["ping"]["calls"], 1)
+
+    def test_pooled_handlers_do_not_hold_up_other_messages(self):
+        release = threading.Event()
+
+        @self.server.handler("slow", run_in=handlers.THREAD)
+        def slow(message):
+            release.wait(10)
+            return {"cmd": "slow", "done": True}
+
+        self.peer.queue_message(1, {"cmd": "slow"})
+        self.peer.queue_message(2, {"cmd": "ping", "pingpong-counter": 1})
+        self.peer.send_messages()
+        self.server.handle_readable_socket(self.client_end)
+        self.client.send_messages()
+        self.assertEqual(
+            list(self.peer.read_messages()), [(2, {"cmd": "pong", "pingpong-counter": 2})]
+        )
+
+        release.set()
+        self.server.poll(10)
+        self.client.send_messages()
+        self.assertEqual(list(self.peer.read_messages()), [(1, {"cmd": "slow", "done": True})])
+
+    def backlogged_client(self, policy):
+        slow_server = server.Server(
+            slow_consumer_policy=policy, send_high_water=100, send_low_water=0
+        )
+        client = slow_server.add_client(self.client_end)
+        slow_server.publish({"cmd": "big", "data": "x" * 200})
+        self.assertTrue(client.send_backlogged)
+        return slow_server, client
+
+    def test_pause_stops_reading_from_slow_client(self):
+        slow_server, client = self.backlogged_client("pause")
+        key = slow_server.selector.get_key(self.client_end)
+        self.assertEqual(key.events, selectors.EVENT_WRITE)
+        client.send_messages()
+        key = slow_server.selector.get_key(self.client_end)
+        self.assertEqual(key.events, selectors.EVENT_READ)
+
+    def test_conflate_broadcasts_to_slow_client(self):
+        slow_server, client = self.backlogged_client("conflate")
+        for n in range(3):
+            slow_server.publish({"cmd": "time", "n": n})
+        slow_server.publish({"cmd": "other"})
+        client.send_messages()
+        client.send_messages()
+        self.assertEqual(
+            [m.get("cmd") for _tid, m in self.peer.read_messages()], ["big", "time", "other"]
+        )
+        self.assertEqual(client.stats.frames_conflated, 2)
+
+    def test_disconnect_slow_client(self):
+        slow_server, _client = self.backlogged_client("disconnect")
+        self.assertIn(self.client_end, slow_server.known_clients)
+        slow_server.remove_slow_clients()
+        self.assertEqual(slow_server.known_clients, {})
+
+    def test_unknown_slow_consumer_policy(self):
+        with self.assertRaises(ValueError):
+            server.Server(slow_consumer_policy="ignore")
+
+    def test_broadcasts_only_reach_subscribers(self):
+        other_end, other_peer = socket.socketpair()
+        self.addCleanup(other_end.close)
+        self.addCleanup(other_peer.close)
+        other = self.server.add_client(other_end)
+        self.server.handle_message(self.client, 1, {"cmd": "subscribe", "topics": ["news.*"]})
+        self.server.handle_message(other, 1, {"cmd": "unsubscribe", "topics": ["*"]})
+        self.client.flush_batch()
+        self.client.send_messages()
+        self.assertEqual(
+            list(self.peer.read_messages()),
+            [(1, {"cmd": "subscribe", "success": True, "topics": ["news.*"]})],
+        )
+
+        self.server.publish({"cmd": "time"})
+        self.server.publish({"cmd": "news.sport"})
+        self.assertEqual(other.send_queue_bytes(), 0)
+        self.client.send_messages()
+        self.assertEqual(
+            [m["cmd"] for _tid, m in self.peer.read_messages()], ["news.sport"]
+        )
+
+    def test_bad_subscription(self):
+        self.server.handle_message(self.client, 1, {"cmd": "subscribe", "topics": "time"})
+        self.client.flush_batch()
+        self.client.send_messages()
+        (_tid, reply), = self.peer.read_messages()
+        self.assertFalse(reply["success"])
+
+    def test_removed_clients_are_unsubscribed(self):
+        self.server.handle_message(self.client, 1, {"cmd": "subscribe", "topics": ["time"]})
+        self.server.remove_client(self.client_end)
+        self.assertEqual(self.server.topics.subscribers("time"), set())
+
+    def test_codec_limited_to_allowed_codecs(self):
+        self.server.allowed_codec_names = ["bson"]
+        self.server.handle_message(
+            self.client, 1, networking.build_codec_request(["json", "bson"])
+        )
+        self.assertEqual(self.client.codec.name, "bson")
+
+
+class TestBroadcastHub(unittest.TestCase):
+    def setUp(self):
+        self.sockets = []
+        hub_ends = []
+        self.servers = []
+        for _ in range(3):
+            hub_end, worker_end = self.socketpair()
+            hub_ends.append(hub_end)
+            self.servers.append(
+                server.Server(hub_socket=worker_end, sends_time_broadcasts=False)
+            )
+        self.hub = server.BroadcastHub(hub_ends)
+
+        # two clients per worker; we read what they're sent from the other end
+        self.clients = []
+        self.client_peers = []
+        for worker in self.servers:
+            for _ in range(2):
+                client_end, peer = self.socketpair()
+                self.clients.append(worker.add_client(client_end))
+                self.client_peers.append(networking.Messenger(peer))
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def socketpair(self):
+        pair = socket.socketpair()
+        self.sockets.extend(pair)
+        return pair
+
+    def deliver(self):
+        for worker in self.servers:
+            worker.handle_hub_events(selectors.EVENT_WRITE)
+        # once to read from the workers, once more to write to them
+        self.hub.poll(0)
+        self.hub.poll(0)
+        for worker in self.servers:
+            worker.handle_hub_events(selectors.EVENT_READ)
+            for client in worker.known_clients.values():
+                client.send_messages()
+
+    def received(self):
+        return [list(peer.read_messages()) for peer in self.client_peers]
+
+    def test_no_time_broadcasts(self):
+        self.assertIsNone(self.servers[0].time_broadcast_timer)
+
+    def test_publish_reaches_every_client_once(self):
+        self.servers[1].publish({"cmd": "test"})
+        self.deliver()
+        self.assertEqual(self.received(), [[(0, {"cmd": "test"})]] * 6)
+        # and nothing came back to the worker that sent it
+        self.deliver()
+        self.assertEqual(self.received(), [[]] * 6)
+
+    def test_publish_from_every_worker(self):
+        for n, worker in enumerate(self.servers):
+            worker.publish({"n": n})
+        self.deliver()
+        for messages in self.received():
+            self.assertEqual(sorted(m["n"] for _tid, m in messages), [0, 1, 2])
+
+    def test_relayed_frames_are_not_reencoded(self):
+        self.servers[0].publish({"cmd": "test", "value": 1.5})
+        self.servers[0].handle_hub_events(selectors.EVENT_WRITE)
+        self.hub.poll(0)
+        self.hub.poll(0)
+        expected = networking.encode_frame(0, {"cmd": "test", "value": 1.5})
+        self.assertEqual(list(self.servers[2].hub.read_frames()), [(0, expected)])
+
+    def test_relayed_broadcasts_match_local_ones(self):
+        self.servers[0].publish(server.build_time_message())
+        self.deliver()
+        received = self.received()
+        for messages in received[1:]:
+            self.assertEqual(messages, received[0])
+
+    def test_relayed_broadcasts_reencoded_for_other_codecs(self):
+        self.clients[2].set_codec("json")
+        self.client_peers[2].set_codec("json")
+        self.servers[0].publish({"cmd": "test"})
+        self.deliver()
+        received = self.received()
+        self.assertEqual(received[2], [(0, {"cmd": "test"})])
+        self.assertEqual(received[3], [(0, {"cmd": "test"})])
+
+    def test_publish_encodes_once_per_codec(self):
+        self.clients[0].set_codec("json")
+        self.clients[1].set_codec("json")
+        with mock.patch.object(
+            networking, "encode_frame", wraps=networking.encode_frame
+        ) as encode_frame:
+            self.servers[0].publish({"cmd": "test"})
+        # once in the default codec (shared with the hub), once for the JSON clients
+        self.assertEqual(encode_frame.call_count, 2)
+
+
+class TestAdmission(unittest.TestCase):
+    def listen(self, **kwargs):
+        self.server = server.Server(("127.0.0.1", 0), sends_time_broadcasts=False, **kwargs)
+        self.server.listen()
+        self.addCleanup(self.close)
+
+    def close(self):
+        self.server.server_socket.close()
+        for sock in list(self.server.known_clients):
+            self.server.remove_client(sock)
+
+    def connect(self, count):
+        sockets = [socket.create_connection(self.server.host_and_port) for _ in range(count)]
+        for sock in sockets:
+            self.addCleanup(sock.close)
+        return sockets
+
+    def test_accepts_everything_waiting(self):
+        self.listen()
+        self.connect(10)
+        self.server.poll(1)
+        self.assertEqual(len(self.server.known_clients), 10)
+        self.assertEqual(self.server.get_stats()["listener"]["accepted"], 10)
+
+    def test_accepts_in_batches(self):
+        self.listen()
+        self.connect(5)
+        with mock.patch.object(server, "ACCEPT_BATCH_SIZE", 2):
+            self.server.poll(1)
+            self.assertEqual(len(self.server.known_clients), 2)
+            self.server.poll(1)
+            self.assertEqual(len(self.server.known_clients), 4)
+
+    def test_rejects_connections_over_the_limit(self):
+        self.listen(max_connections=2)
+        sockets = self.connect(4)
+        self.server.poll(1)
+        self.assertEqual(len(self.server.known_clients), 2)
+        self.assertEqual(self.server.get_stats()["listener"]["rejected"], 2)
+        # the rejected ones were closed straight away
+        for sock in sockets[2:]:
+            self.assertEqual(sock.recv(1), b"")
+
+    def test_accept_rate_limit(self):
+        # one connection per interval
+        self.listen(max_accept_rate=1 / server.ACCEPT_RATE_INTERVAL_SECS)
+        self.connect(3)
+        self.server.poll(1)
+        self.assertEqual(len(self.server.known_clients), 1)
+        self.assertFalse(self.server.accepting)
+        # the rest wait in the backlog until the next interval
+        self.server.poll(1)
+        self.assertTrue(self.server.accepting)
+        self.server.poll(1)
+        self.assertEqual(len(self.server.known_clients), 2)
+        self.assertGreaterEqual(self.server.get_stats()["listener"]["pauses"], 1)
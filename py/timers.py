@@ -0,0 +1,102 @@
+"""Timers for an event loop: call_later() and call_every() schedule functions on the
+monotonic clock, timeout() says how long the loop can wait in select() before the
+next one is due, and run_due() runs whatever is due once select() returns.
+
+    timers = TimerQueue()
+    timers.call_every(5, publish_time)
+    while True:
+        selector.select(timers.timeout())
+        ...
+        timers.run_due()
+
+Deadlines are kept in a heap, so the nearest is always at hand. With no timers
+nothing reads the clock, and a loop with no other reason to wake sleeps until the
+next deadline rather than polling for it."""
+import heapq
+import itertools
+import time
+
+
+class Timer(object):
+    """A scheduled call, which cancel() stops (along with any repeats)"""
+
+    def __init__(self, deadline, interval, function, args):
+        self.deadline = deadline
+        # seconds between calls, or None if it's only called once
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerQueue(object):
+    def __init__(self, clock=time.monotonic):
+        """clock returns the time in seconds; tests can pass a fake one"""
+        self.clock = clock
+        # (deadline, sequence number, Timer); cancelled timers stay here until
+        # they reach the front, and timers due at the same time run in the order
+        # they were scheduled
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def call_later(self, delay, function, *args):
+        """Calls function(*args) once, delay seconds from now"""
+        return self._schedule(Timer(self.clock() + delay, None, function, args))
+
+    def call_every(self, interval, function, *args):
+        """Calls function(*args) every interval seconds, starting interval seconds
+        from now. Each call is due interval after the last one was due, not after it
+        ran, so a late call doesn't push back the ones after it; calls that were
+        missed altogether (e.g. while the process was stopped) are skipped."""
+        if interval <= 0:
+            raise ValueError("Timer interval must be positive, not {}".format(interval))
+        return self._schedule(Timer(self.clock() + interval, interval, function, args))
+
+    def timeout(self, limit=None):
+        """Seconds until the next timer is due (0 if one already is), but no more
+        than limit; None (wait forever) if there's no limit and no timers"""
+        self._drop_cancelled()
+        if len(self._heap) == 0:
+            return limit
+        until_due = max(self._heap[0][0] - self.clock(), 0)
+        return until_due if limit is None else min(limit, until_due)
+
+    def run_due(self):
+        """Runs every timer that's due, returning how many ran. Timers scheduled by
+        these calls wait for the next run_due(), even if they're already due."""
+        self._drop_cancelled()
+        if len(self._heap) == 0:
+            return 0
+        now = self.clock()
+        due = []
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        for timer in due:
+            if timer.interval is not None:
+                timer.deadline += timer.interval
+                if timer.deadline <= now:
+                    missed = (now - timer.deadline) // timer.interval + 1
+                    timer.deadline += missed * timer.interval
+                self._schedule(timer)
+        ran = 0
+        for timer in due:
+            # an earlier one may have cancelled it
+            if not timer.cancelled:
+                timer.function(*timer.args)
+                ran += 1
+        return ran
+
+    def __len__(self):
+        """How many timers are scheduled"""
+        return sum(1 for _, _, timer in self._heap if not timer.cancelled)
+
+    def _schedule(self, timer):
+        heapq.heappush(self._heap, (timer.deadline, next(self._sequence), timer))
+        return timer
+
+    def _drop_cancelled(self):
+        while len(self._heap) > 0 and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
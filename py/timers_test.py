@@ -0,0 +1,102 @@
+import unittest
+
+import timers
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerQueue(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.timers = timers.TimerQueue(self.clock)
+        self.calls = []
+
+    def record(self, name):
+        self.calls.append((self.clock.now, name))
+
+    def test_no_timers(self):
+        self.assertIsNone(self.timers.timeout())
+        self.assertEqual(self.timers.timeout(0.5), 0.5)
+        self.assertEqual(self.timers.run_due(), 0)
+
+    def test_call_later(self):
+        self.timers.call_later(2, self.record, "b")
+        self.timers.call_later(1, self.record, "a")
+        self.assertEqual(self.timers.timeout(), 1)
+        self.assertEqual(self.timers.timeout(0.25), 0.25)
+        self.assertEqual(self.timers.run_due(), 0)
+        self.clock.now += 1.5
+        self.assertEqual(self.timers.timeout(), 0)
+        self.assertEqual(self.timers.run_due(), 1)
+        self.clock.now += 1
+        self.assertEqual(self.timers.run_due(), 1)
+        self.assertEqual(self.calls, [(101.5, "a"), (102.5, "b")])
+        self.assertEqual(len(self.timers), 0)
+        self.assertIsNone(self.timers.timeout())
+
+    def test_same_deadline_runs_in_order_scheduled(self):
+        for name in "abc":
+            self.timers.call_later(1, self.record, name)
+        self.clock.now += 1
+        self.timers.run_due()
+        self.assertEqual([name for _, name in self.calls], ["a", "b", "c"])
+
+    def test_call_every_doesnt_drift(self):
+        self.timers.call_every(1, self.record, "tick")
+        for late in (0.25, 0.5, 0.1):
+            self.clock.now = self.timers.timeout() + self.clock.now + late
+            self.timers.run_due()
+        # each was due a second after the last was due, however late it ran
+        self.assertEqual([when for when, _ in self.calls], [101.25, 102.5, 103.1])
+
+    def test_call_every_skips_missed_calls(self):
+        self.timers.call_every(1, self.record, "tick")
+        self.clock.now += 3.5
+        self.assertEqual(self.timers.run_due(), 1)
+        self.assertEqual(self.timers.timeout(), 0.5)
+
+    def test_call_every_rejects_bad_interval(self):
+        with self.assertRaises(ValueError):
+            self.timers.call_every(0, self.record, "tick")
+
+    def test_cancel(self):
+        timer = self.timers.call_later(1, self.record, "cancelled")
+        ticker = self.timers.call_every(2, self.record, "tick")
+        self.timers.call_later(3, self.record, "kept")
+        timer.cancel()
+        self.assertEqual(len(self.timers), 2)
+        self.assertEqual(self.timers.timeout(), 2)
+        self.clock.now += 2
+        self.timers.run_due()
+        ticker.cancel()
+        self.clock.now += 2
+        self.timers.run_due()
+        self.assertEqual(self.calls, [(102, "tick"), (104, "kept")])
+        self.assertIsNone(self.timers.timeout())
+
+    def test_timer_can_cancel_another_due_at_the_same_time(self):
+        later = []
+        self.timers.call_later(1, lambda: later[0].cancel())
+        later.append(self.timers.call_later(1, self.record, "cancelled"))
+        self.clock.now += 1
+        self.assertEqual(self.timers.run_due(), 1)
+        self.assertEqual(self.calls, [])
+
+    def test_timers_scheduled_while_running_wait_for_next_run(self):
+        self.timers.call_later(1, lambda: self.timers.call_later(0, self.record, "next"))
+        self.clock.now += 1
+        self.assertEqual(self.timers.run_due(), 1)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.timers.timeout(), 0)
+        self.timers.run_due()
+        self.assertEqual(self.calls, [(101, "next")])
+
+
+if __name__ == "__main__":
+    unittest.main()
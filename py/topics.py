@@ -0,0 +1,85 @@
+"""Which clients want which broadcasts. A broadcast's topic is its cmd, and clients
+subscribe to patterns: a topic itself, or one ending in WILDCARD that matches
+every topic starting with what comes before it ("news.*" matches "news.sport",
+and "*" matches everything).
+
+Clients that have never subscribed get every broadcast, as they did before
+subscriptions existed; once a client subscribes, it only gets what it subscribed
+to (and nothing at all if it then unsubscribes from everything)."""
+
+WILDCARD = "*"
+
+
+def topic_of(message):
+    return str(message.get("cmd"))
+
+
+class TopicIndex(object):
+    """Maps topics to their subscribers, so that a broadcast only has to look at
+    the connections that want it: one dict lookup for the exact topic and one per
+    prefix of it for wildcard patterns, however many subscribers there are"""
+
+    def __init__(self):
+        # subscribers that have never subscribed, so get everything
+        self._receives_all = set()
+        # topic -> subscribers to exactly that topic
+        self._by_topic = {}
+        # prefix -> subscribers to prefix + WILDCARD
+        self._by_prefix = {}
+        # subscriber -> the patterns it's subscribed to, once it's subscribed
+        self._patterns = {}
+
+    def add(self, subscriber):
+        """Adds a subscriber that gets everything until it subscribes to something"""
+        self._receives_all.add(subscriber)
+
+    def subscribe(self, subscriber, pattern):
+        self._receives_all.discard(subscriber)
+        patterns = self._patterns.setdefault(subscriber, set())
+        if pattern in patterns:
+            return
+        patterns.add(pattern)
+        index, key = self._index_for(pattern)
+        index.setdefault(key, set()).add(subscriber)
+
+    def unsubscribe(self, subscriber, pattern):
+        """Stops sending subscriber broadcasts for pattern; unsubscribing from
+        something it never subscribed to still stops it getting everything"""
+        self._receives_all.discard(subscriber)
+        patterns = self._patterns.setdefault(subscriber, set())
+        if pattern not in patterns:
+            return
+        patterns.remove(pattern)
+        index, key = self._index_for(pattern)
+        subscribers = index[key]
+        subscribers.remove(subscriber)
+        if len(subscribers) == 0:
+            del index[key]
+
+    def remove(self, subscriber):
+        """Forgets subscriber altogether, e.g. once it's disconnected"""
+        self._receives_all.discard(subscriber)
+        for pattern in list(self._patterns.get(subscriber, ())):
+            self.unsubscribe(subscriber, pattern)
+        self._patterns.pop(subscriber, None)
+
+    def patterns_of(self, subscriber):
+        return sorted(self._patterns.get(subscriber, ()))
+
+    def subscribers(self, topic):
+        """Returns the set of subscribers that want broadcasts with topic"""
+        subscribers = set(self._receives_all)
+        exact = self._by_topic.get(topic)
+        if exact is not None:
+            subscribers |= exact
+        if len(self._by_prefix) > 0:
+            for end in range(len(topic) + 1):
+                by_prefix = self._by_prefix.get(topic[:end])
+                if by_prefix is not None:
+                    subscribers |= by_prefix
+        return subscribers
+
+    def _index_for(self, pattern):
+        if pattern.endswith(WILDCARD):
+            return self._by_prefix, pattern[: -len(WILDCARD)]
+        return self._by_topic, pattern
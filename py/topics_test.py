@@ -0,0 +1,56 @@
+import unittest
+
+import topics
+
+
+class TestTopicIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = topics.TopicIndex()
+        for subscriber in ("a", "b", "c"):
+            self.index.add(subscriber)
+
+    def test_everyone_gets_everything_until_they_subscribe(self):
+        self.assertEqual(self.index.subscribers("time"), {"a", "b", "c"})
+        self.index.subscribe("a", "time")
+        self.assertEqual(self.index.subscribers("time"), {"a", "b", "c"})
+        self.assertEqual(self.index.subscribers("news"), {"b", "c"})
+
+    def test_wildcards(self):
+        self.index.subscribe("a", "news.*")
+        self.index.subscribe("b", "*")
+        self.index.subscribe("c", "news.sport")
+        self.assertEqual(self.index.subscribers("news.sport"), {"a", "b", "c"})
+        self.assertEqual(self.index.subscribers("news.weather"), {"a", "b"})
+        self.assertEqual(self.index.subscribers("news."), {"a", "b"})
+        self.assertEqual(self.index.subscribers("news"), {"b"})
+        self.assertEqual(self.index.subscribers(""), {"b"})
+
+    def test_unsubscribe(self):
+        self.index.subscribe("a", "time")
+        self.index.subscribe("a", "news.*")
+        self.index.unsubscribe("a", "news.*")
+        self.index.unsubscribe("a", "never-subscribed")
+        self.assertEqual(self.index.patterns_of("a"), ["time"])
+        self.assertEqual(self.index.subscribers("news.sport"), {"b", "c"})
+        # unsubscribing from everything leaves it getting nothing
+        self.index.unsubscribe("b", "*")
+        self.assertEqual(self.index.subscribers("news.sport"), {"c"})
+
+    def test_remove(self):
+        self.index.subscribe("a", "time")
+        self.index.subscribe("a", "news.*")
+        self.index.remove("a")
+        self.index.remove("b")
+        self.assertEqual(self.index.subscribers("time"), {"c"})
+        self.assertEqual(self.index.subscribers("news.sport"), {"c"})
+        self.assertEqual(self.index.patterns_of("a"), [])
+        self.assertEqual(self.index._by_topic, {})
+        self.assertEqual(self.index._by_prefix, {})
+
+    def test_topic_of(self):
+        self.assertEqual(topics.topic_of({"cmd": "time"}), "time")
+        self.assertEqual(topics.topic_of({}), "None")
+
+
+if __name__ == "__main__":
+    unittest.main()
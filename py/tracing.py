@@ -0,0 +1,189 @@
+"""Per-request latency tracing. A frame with TRACE_FLAG set in its header carries a
+trace extension between its header and body: the trace id and the time the client
+sent it, and the server's timings for the request, which a server fills in on the
+reply. Clients only send traced frames when asked to, and servers only trace the
+replies to them, so untraced traffic is unchanged.
+
+The server's timings are microseconds since it read the request: when it started
+decoding it (until then it was queued behind the frames read before it), when its
+handler was called, and when the reply was handed back to be sent. Each end only
+compares its own clock readings, so their clocks needn't agree; whatever of the
+round trip the server's timings don't account for is put down to the network
+(including both ends' send queues).
+
+    trace = tracing.Trace(trace_id)
+    messenger.batch_message(tid, {"cmd": "ping", ...}, trace=trace)
+    ...
+    # on the reply
+    stats.add(reply["cmd"], messenger.received_traces.pop(tid))
+    print(stats.summary())
+"""
+import struct
+import time
+
+# set in a header's data_length; the extension is counted in the body's length
+TRACE_FLAG = 0x20000000
+
+# the byte of a frame that holds the header's flags, and TRACE_FLAG within it
+FLAGS_OFFSET = 4
+TRACE_FLAG_BYTE = TRACE_FLAG >> 24
+
+# trace_id, sent_at_us, decode_started_us, dispatched_us, enqueued_us
+TRACE_EXTENSION = struct.Struct("!QQIII")
+
+TRACE_EXTENSION_SIZE = TRACE_EXTENSION.size
+
+# the server's timings are sent as 32-bit microseconds
+MAX_TIMING_US = 2 ** 32 - 1
+
+# what each round trip is broken into; see TraceStats.add()
+STAGES = ("total", "network", "queued", "decode", "handler")
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def now_us():
+    """A monotonic time in microseconds, comparable only within this process"""
+    return int(time.perf_counter() * 1000000)
+
+
+def is_traced(frame):
+    return bool(frame[FLAGS_OFFSET] & TRACE_FLAG_BYTE)
+
+
+class Trace(object):
+    """The trace extension of one frame, along with when this end read it (in
+    perf_counter() seconds, or None if it hasn't been)"""
+
+    __slots__ = (
+        "trace_id",
+        "sent_at_us",
+        "decode_started_us",
+        "dispatched_us",
+        "enqueued_us",
+        "received_at",
+    )
+
+    def __init__(self, trace_id, sent_at_us=None):
+        self.trace_id = trace_id
+        self.sent_at_us = now_us() if sent_at_us is None else sent_at_us
+        self.decode_started_us = 0
+        self.dispatched_us = 0
+        self.enqueued_us = 0
+        self.received_at = None
+
+    def since_received_us(self):
+        elapsed = int((time.perf_counter() - self.received_at) * 1000000)
+        return min(max(elapsed, 0), MAX_TIMING_US)
+
+    def pack(self):
+        return TRACE_EXTENSION.pack(
+            self.trace_id,
+            self.sent_at_us,
+            self.decode_started_us,
+            self.dispatched_us,
+            self.enqueued_us,
+        )
+
+    @classmethod
+    def unpack_from(cls, frame, offset):
+        """Reads the trace extension at offset in frame (just after its header)"""
+        trace_id, sent_at_us, decode_started_us, dispatched_us, enqueued_us = (
+            TRACE_EXTENSION.unpack_from(frame, offset)
+        )
+        trace = cls(trace_id, sent_at_us)
+        trace.decode_started_us = decode_started_us
+        trace.dispatched_us = dispatched_us
+        trace.enqueued_us = enqueued_us
+        return trace
+
+    def stages(self):
+        """Breaks the round trip of the request this is the reply's trace for into
+        STAGES, in microseconds"""
+        total = max(int(self.received_at * 1000000) - self.sent_at_us, 0)
+        return {
+            "total": total,
+            "network": max(total - self.enqueued_us, 0),
+            "queued": self.decode_started_us,
+            "decode": max(self.dispatched_us - self.decode_started_us, 0),
+            "handler": max(self.enqueued_us - self.dispatched_us, 0),
+        }
+
+
+class LatencyHistogram(object):
+    """Counts of latencies in microseconds, in buckets an eighth of a power of two
+    wide, so memory stays bounded however many are added and percentiles are
+    within 12.5% of the truth"""
+
+    SUB_BUCKET_BITS = 3
+
+    def __init__(self):
+        # bucket index -> count
+        self.buckets = {}
+        self.count = 0
+        self.max_us = 0
+
+    def add(self, us):
+        index = self._bucket_of(us)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        if us > self.max_us:
+            self.max_us = us
+
+    def percentile(self, percent):
+        """The top of the bucket holding the nearest-rank percentile, or None if
+        nothing was added"""
+        if self.count == 0:
+            return None
+        rank = max(int(-(-percent * self.count // 100)), 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self._top_of(index), self.max_us)
+        return self.max_us
+
+    def _bucket_of(self, us):
+        shift = us.bit_length() - self.SUB_BUCKET_BITS - 1
+        if shift <= 0:
+            # small enough to count exactly
+            return us
+        return (shift << self.SUB_BUCKET_BITS) + (us >> shift)
+
+    def _top_of(self, index):
+        shift = (index >> self.SUB_BUCKET_BITS) - 1
+        if shift <= 0:
+            return index
+        mantissa = index - (shift << self.SUB_BUCKET_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+
+class TraceStats(object):
+    """Latency histograms per cmd and stage for the replies to traced requests"""
+
+    def __init__(self):
+        # cmd -> stage -> LatencyHistogram
+        self.histograms = {}
+
+    def add(self, cmd, trace):
+        """Adds the stages of a round trip, given the cmd and trace of its reply"""
+        histograms = self.histograms.get(cmd)
+        if histograms is None:
+            histograms = {stage: LatencyHistogram() for stage in STAGES}
+            self.histograms[cmd] = histograms
+        for stage, us in trace.stages().items():
+            histograms[stage].add(us)
+
+    def summary(self):
+        """cmd -> stage -> {"count", "p50_us", ..., "max_us"}"""
+        summary = {}
+        for cmd, histograms in self.histograms.items():
+            summary[cmd] = {}
+            for stage in STAGES:
+                histogram = histograms[stage]
+                stage_summary = {"count": histogram.count}
+                for percent in PERCENTILES:
+                    stage_summary["p{:g}_us".format(percent)] = histogram.percentile(percent)
+                stage_summary["max_us"] = histogram.max_us
+                summary[cmd][stage] = stage_summary
+        return summary
@@ -0,0 +1,77 @@
+import unittest
+
+import tracing
+
+
+class TestTrace(unittest.TestCase):
+    def test_pack_round_trip(self):
+        trace = tracing.Trace(2 ** 40, sent_at_us=123)
+        trace.decode_started_us = 1
+        trace.dispatched_us = 2
+        trace.enqueued_us = 3
+        packed = b"12345678" + trace.pack()
+        self.assertEqual(len(packed), 8 + tracing.TRACE_EXTENSION_SIZE)
+        unpacked = tracing.Trace.unpack_from(packed, 8)
+        self.assertEqual(
+            [getattr(unpacked, name) for name in tracing.Trace.__slots__],
+            [2 ** 40, 123, 1, 2, 3, None],
+        )
+
+    def test_stages(self):
+        trace = tracing.Trace(1, sent_at_us=1000)
+        trace.decode_started_us = 50
+        trace.dispatched_us = 70
+        trace.enqueued_us = 100
+        trace.received_at = 0.0015
+        self.assertEqual(
+            trace.stages(),
+            {"total": 500, "network": 400, "queued": 50, "decode": 20, "handler": 30},
+        )
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_small_values_are_exact(self):
+        histogram = tracing.LatencyHistogram()
+        for us in range(1, 11):
+            histogram.add(us)
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(100), 10)
+        self.assertEqual(histogram.count, 10)
+
+    def test_percentiles_are_within_bucket_width(self):
+        histogram = tracing.LatencyHistogram()
+        for us in range(1, 100001):
+            histogram.add(us)
+        for percent in (50, 99, 99.9):
+            expected = percent * 1000
+            self.assertGreaterEqual(histogram.percentile(percent), expected)
+            self.assertLessEqual(histogram.percentile(percent), expected * 1.125)
+        self.assertEqual(histogram.percentile(100), 100000)
+        # far fewer buckets than values
+        self.assertLess(len(histogram.buckets), 150)
+
+    def test_empty(self):
+        self.assertIsNone(tracing.LatencyHistogram().percentile(50))
+
+
+class TestTraceStats(unittest.TestCase):
+    def test_summary_by_cmd_and_stage(self):
+        stats = tracing.TraceStats()
+        for sent_at_us in (1000, 1200):
+            trace = tracing.Trace(1, sent_at_us)
+            trace.enqueued_us = 100
+            trace.received_at = 0.0015
+            stats.add("pong", trace)
+        summary = stats.summary()
+        self.assertEqual(list(summary), ["pong"])
+        self.assertEqual(list(summary["pong"]), list(tracing.STAGES))
+        self.assertEqual(summary["pong"]["total"]["count"], 2)
+        self.assertEqual(summary["pong"]["total"]["max_us"], 500)
+        self.assertEqual(summary["pong"]["network"]["max_us"], 400)
+        # the top of the bucket 200 is in
+        self.assertEqual(summary["pong"]["network"]["p50_us"], 207)
+        self.assertEqual(summary["pong"]["handler"]["p99.9_us"], 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
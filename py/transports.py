@@ -0,0 +1,318 @@
+"""The transports a Messenger can run over, picked by URL:
+
+    tcp://host:port   TCP, the only one that works between machines
+    unix:///path      a Unix domain socket bound to path
+    shm:///path       a pair of rings in shared memory, one each way, set up over a
+                      Unix domain socket bound to path that is then only used for
+                      wakeups, so messages never pass through the kernel
+
+Unix domain sockets and shared memory only work between processes on the same
+machine (and not on Windows).
+"""
+import array
+import mmap
+import os
+import socket
+import stat
+import struct
+import tempfile
+
+SCHEMES = ("tcp", "unix", "shm")
+
+DEFAULT_URL = "tcp://localhost:8000"
+
+# the capacity of each of a shared memory connection's two rings
+SHM_RING_SIZE = 2 ** 20
+
+# sent by the server on accepting a shared memory connection, along with the file
+# descriptor of the mapping
+SHM_HANDSHAKE_FMT = "!Q"  # ring size
+SHM_HANDSHAKE_SIZE = struct.calcsize(SHM_HANDSHAKE_FMT)
+
+# how long a client waits for the handshake before giving up
+SHM_HANDSHAKE_TIMEOUT_SECS = 5
+
+# tmpfs, where there is one, so the mapping is never written to disk
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def parse_url(url):
+    """Returns (scheme, address), where address is (host, port) for TCP and a path
+    for the others"""
+    scheme, separator, rest = url.partition("://")
+    if separator == "" or scheme not in SCHEMES:
+        raise ValueError("Unsupported transport URL {}; use one of {}".format(
+            url, ", ".join(scheme + "://" for scheme in SCHEMES)
+        ))
+    if scheme != "tcp":
+        return scheme, rest
+    host, _, port = rest.rpartition(":")
+    if host == "" or not port.isdigit():
+        raise ValueError("Expected tcp://host:port, got {}".format(url))
+    # IPv6 addresses are written in brackets so that their colons aren't ambiguous
+    return scheme, (host.strip("[]"), int(port))
+
+
+def tcp_url(host_and_port):
+    host, port = host_and_port[:2]
+    if ":" in host:
+        host = "[{}]".format(host)
+    return "tcp://{}:{}".format(host, port)
+
+
+def listen(url, backlog, reuse_port=False):
+    """Returns a non-blocking listening socket for url. reuse_port (TCP only) lets
+    several processes listen on the same port."""
+    scheme, address = parse_url(url)
+    if scheme == "tcp":
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if os.name == "posix":
+            # so that a restarted server can listen again straight away, while
+            # connections from before the restart are still in TIME_WAIT (on
+            # Windows it would let another process take over the port instead)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    else:
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _remove_stale_socket_file(address)
+    server_socket.setblocking(False)
+    server_socket.bind(address)
+    server_socket.listen(backlog)
+    return server_socket
+
+
+def _remove_stale_socket_file(path):
+    # a socket file left behind by a server that's gone would stop us binding
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def accept(url, server_socket):
+    """Accepts a connection on a socket from listen(url), returning (connection,
+    address). For shared memory the connection is a ShmChannel, which a Messenger
+    can use just like a socket."""
+    connection, address = server_socket.accept()
+    if parse_url(url)[0] == "shm":
+        connection = ShmChannel.accept(connection)
+    return connection, address
+
+
+def connect(url):
+    """Connects to a server listening on url, returning a blocking socket (or
+    ShmChannel)"""
+    scheme, address = parse_url(url)
+    if scheme == "tcp":
+        return socket.create_connection(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        if scheme == "shm":
+            return ShmChannel.connect(sock)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+class SharedRing(object):
+    """A single-producer, single-consumer ring of bytes in shared memory. It works
+    like RingBuffer, except that the read and write positions are kept in the
+    mapping too, so the writer and reader can be in different processes. Each
+    position counts every byte ever written or read, and only its own side updates
+    it: the ring is empty when they're equal and full when they're size apart."""
+
+    # write position, read position
+    POSITION = struct.Struct("=Q")
+    HEADER_SIZE = 2 * POSITION.size
+
+    def __init__(self, view, size):
+        """view is a memoryview of HEADER_SIZE + size bytes of the mapping"""
+        self.view = view
+        self.data = view[self.HEADER_SIZE : self.HEADER_SIZE + size]
+        self.size = size
+
+    def _positions(self):
+        return (
+            self.POSITION.unpack_from(self.view, 0)[0],
+            self.POSITION.unpack_from(self.view, self.POSITION.size)[0],
+        )
+
+    def bytes_used(self):
+        write_position, read_position = self._positions()
+        return write_position - read_position
+
+    def write(self, regions):
+        """Copies as much of regions (a list of bytes-like objects) as fits into the
+        ring, returning how many bytes that was"""
+        write_position, read_position = self._positions()
+        free = self.size - (write_position - read_position)
+        written = 0
+        for region in regions:
+            region = memoryview(region).cast("B")
+            if free == 0:
+                break
+            region = region[:free]
+            start = (write_position + written) % self.size
+            first = min(len(region), self.size - start)
+            self.data[start : start + first] = region[:first]
+            self.data[: len(region) - first] = region[first:]
+            written += len(region)
+            free -= len(region)
+        # the data has to be in place before the reader can see it
+        self.POSITION.pack_into(self.view, 0, write_position + written)
+        return written
+
+    def read_into(self, buffer):
+        """Moves as much as fits into buffer out of the ring, returning how many
+        bytes that was"""
+        write_position, read_position = self._positions()
+        buffer = memoryview(buffer).cast("B")
+        count = min(len(buffer), write_position - read_position)
+        start = read_position % self.size
+        first = min(count, self.size - start)
+        buffer[:first] = self.data[start : start + first]
+        buffer[first:count] = self.data[: count - first]
+        self.POSITION.pack_into(self.view, self.POSITION.size, read_position + count)
+        return count
+
+    def release(self):
+        self.data.release()
+        self.view.release()
+
+
+class ShmChannel(object):
+    """A connection whose data goes through a pair of SharedRings rather than a
+    socket, with just enough of the socket interface for Messengers and selectors.
+
+    The Unix domain socket it was set up over becomes a doorbell: a byte is sent on
+    it after each write into the ring, which is what makes the other end readable.
+    It's only drained once the ring is empty, so recv_into() must be called until
+    it raises BlockingIOError, as Messenger does. A writer that finds the ring full fills the
+    socket's send buffer with bytes until it isn't writable any more, so that it
+    only becomes writable again once the reader has drained them, which it does
+    before reading from (and so making room in) the ring."""
+
+    def __init__(self, sock, mapping, ring_size, is_server):
+        self.socket = sock
+        self._mapping = mapping
+        view = memoryview(mapping)
+        ring_length = SharedRing.HEADER_SIZE + ring_size
+        rings = [
+            SharedRing(view[:ring_length], ring_size),
+            SharedRing(view[ring_length : 2 * ring_length], ring_size),
+        ]
+        view.release()
+        # the server sends on the first ring and the client on the second
+        if is_server:
+            self._send_ring, self._recv_ring = rings
+        else:
+            self._recv_ring, self._send_ring = rings
+
+    @classmethod
+    def accept(cls, sock, ring_size=SHM_RING_SIZE):
+        """Creates the mapping for a newly accepted connection and hands it to the
+        client. The file behind it is anonymous, so it goes away with the last
+        process that has it mapped."""
+        length = 2 * (SharedRing.HEADER_SIZE + ring_size)
+        with tempfile.TemporaryFile(dir=SHM_DIR) as f:
+            os.ftruncate(f.fileno(), length)
+            mapping = mmap.mmap(f.fileno(), length)
+            sock.sendmsg(
+                [struct.pack(SHM_HANDSHAKE_FMT, ring_size)],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [f.fileno()]))],
+            )
+        return cls(sock, mapping, ring_size, is_server=True)
+
+    @classmethod
+    def connect(cls, sock):
+        """Maps the shared memory a server sends on accepting sock"""
+        sock.settimeout(SHM_HANDSHAKE_TIMEOUT_SECS)
+        data, ancillary, _flags, _address = sock.recvmsg(
+            SHM_HANDSHAKE_SIZE, socket.CMSG_LEN(array.array("i").itemsize)
+        )
+        fds = array.array("i")
+        for level, kind, fd_data in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(fd_data[: len(fd_data) - len(fd_data) % fds.itemsize])
+        if len(data) != SHM_HANDSHAKE_SIZE or len(fds) != 1:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionError("Server didn't set up shared memory")
+        sock.settimeout(None)
+        (ring_size,) = struct.unpack(SHM_HANDSHAKE_FMT, data)
+        try:
+            mapping = mmap.mmap(fds[0], 2 * (SharedRing.HEADER_SIZE + ring_size))
+        finally:
+            os.close(fds[0])
+        return cls(sock, mapping, ring_size, is_server=False)
+
+    @property
+    def family(self):
+        return self.socket.family
+
+    @property
+    def type(self):
+        return self.socket.type
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def setblocking(self, flag):
+        self.socket.setblocking(flag)
+
+    def getpeername(self):
+        return self.socket.getpeername()
+
+    def recv_into(self, buffer):
+        received = self._recv_ring.read_into(buffer)
+        if received > 0:
+            # leave the doorbell ringing, in case the caller stops before it's empty
+            return received
+        connection_closed = self._drain_doorbell()
+        # anything written before the rings we just drained is in the ring by now
+        received = self._recv_ring.read_into(buffer)
+        if received > 0 or connection_closed:
+            return received
+        raise BlockingIOError("Nothing to read")
+
+    def _drain_doorbell(self):
+        """Returns True if the other end has closed the connection"""
+        try:
+            while True:
+                if len(self.socket.recv(4096)) == 0:
+                    return True
+        except BlockingIOError:
+            return False
+
+    def sendmsg(self, regions):
+        sent = self._send_ring.write(regions)
+        if sent == 0 and sum(len(region) for region in regions) > 0:
+            self._ring_doorbell(b"\0" * 4096, until_full=True)
+            raise BlockingIOError("Shared memory ring is full")
+        self._ring_doorbell(b"\0")
+        return sent
+
+    def send(self, data):
+        return self.sendmsg([data])
+
+    def _ring_doorbell(self, data, until_full=False):
+        try:
+            while True:
+                self.socket.send(data)
+                if not until_full:
+                    return
+        except BlockingIOError:
+            # it's already full of rings the reader hasn't seen yet
+            pass
+
+    def close(self):
+        self.socket.close()
+        if self._mapping is not None:
+            self._send_ring.release()
+            self._recv_ring.release()
+            self._mapping.close()
+            self._mapping = None
@@ -0,0 +1,150 @@
+import os
+import select
+import socket
+import tempfile
+import threading
+import unittest
+
+import networking
+import server
+import transports
+
+
+class TestParseUrl(unittest.TestCase):
+    def test_schemes(self):
+        self.assertEqual(
+            transports.parse_url("tcp://localhost:8000"), ("tcp", ("localhost", 8000))
+        )
+        self.assertEqual(transports.parse_url("tcp://[::1]:80"), ("tcp", ("::1", 80)))
+        self.assertEqual(transports.parse_url("unix:///tmp/s"), ("unix", "/tmp/s"))
+        self.assertEqual(transports.parse_url("shm://relative"), ("shm", "relative"))
+
+    def test_bad_urls(self):
+        for url in ("localhost:8000", "udp://localhost:8000", "tcp://localhost", "tcp://:80"):
+            with self.assertRaises(ValueError):
+                transports.parse_url(url)
+
+    def test_tcp_url(self):
+        self.assertEqual(transports.tcp_url(("127.0.0.1", 80)), "tcp://127.0.0.1:80")
+        self.assertEqual(transports.tcp_url(("::1", 80, 0, 0)), "tcp://[::1]:80")
+        url = transports.tcp_url(("::1", 80))
+        self.assertEqual(transports.parse_url(url), ("tcp", ("::1", 80)))
+
+
+class TestSharedRing(unittest.TestCase):
+    def test_wraps_around(self):
+        ring = transports.SharedRing(
+            memoryview(bytearray(transports.SharedRing.HEADER_SIZE + 8)), 8
+        )
+        buffer = bytearray(8)
+        self.assertEqual(ring.write([b"abc", b"def"]), 6)
+        self.assertEqual(ring.read_into(memoryview(buffer)[:4]), 4)
+        self.assertEqual(buffer[:4], b"abcd")
+        # only 6 of these fit, wrapping past the end
+        self.assertEqual(ring.write([b"ghijklmn"]), 6)
+        self.assertEqual(ring.bytes_used(), 8)
+        self.assertEqual(ring.write([b"o"]), 0)
+        self.assertEqual(ring.read_into(buffer), 8)
+        self.assertEqual(buffer, b"efghijkl")
+        self.assertEqual(ring.read_into(buffer), 0)
+
+
+class TestShmChannel(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = "shm://" + os.path.join(self.directory.name, "socket")
+        listener = transports.listen(self.url, 1)
+        client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client_socket.connect(transports.parse_url(self.url)[1])
+        self.server_end = transports.ShmChannel.accept(listener.accept()[0], ring_size=64)
+        self.client_end = transports.ShmChannel.connect(client_socket)
+        listener.close()
+        self.server_end.setblocking(False)
+        self.client_end.setblocking(False)
+
+    def tearDown(self):
+        self.server_end.close()
+        self.client_end.close()
+        self.directory.cleanup()
+
+    def test_full_ring_blocks_until_drained(self):
+        self.assertEqual(self.client_end.sendmsg([b"x" * 50, b"y" * 50]), 64)
+        with self.assertRaises(BlockingIOError):
+            self.client_end.send(b"z")
+        _, writable, _ = select.select([], [self.client_end], [], 0)
+        self.assertEqual(writable, [])
+
+        buffer = bytearray(100)
+        readable, _, _ = select.select([self.server_end], [], [], 1)
+        self.assertEqual(readable, [self.server_end])
+        self.assertEqual(self.server_end.recv_into(buffer), 64)
+        with self.assertRaises(BlockingIOError):
+            self.server_end.recv_into(buffer)
+        _, writable, _ = select.select([], [self.client_end], [], 1)
+        self.assertEqual(writable, [self.client_end])
+        self.assertEqual(self.client_end.send(b"z"), 1)
+
+    def test_close(self):
+        self.client_end.send(b"bye")
+        self.client_end.close()
+        buffer = bytearray(10)
+        self.assertEqual(self.server_end.recv_into(buffer), 3)
+        self.assertEqual(self.server_end.recv_into(buffer), 0)
+
+
+class TestServerTransports(unittest.TestCase):
+    def serve(self, url):
+        self.server = server.Server(url=url, sends_time_broadcasts=False)
+        self.server.listen()
+        self.stopping = False
+        thread = threading.Thread(target=self.poll)
+        thread.start()
+
+        def stop():
+            self.stopping = True
+            thread.join()
+            self.server.server_socket.close()
+            for sock in list(self.server.known_clients):
+                self.server.remove_client(sock)
+
+        self.addCleanup(stop)
+
+    def poll(self):
+        while not self.stopping:
+            self.server.poll(0.01)
+
+    def ping(self, url):
+        messenger = networking.Messenger(transports.connect(url))
+        self.addCleanup(messenger.socket.close)
+        messenger.queue_message(1, {"cmd": "ping", "pingpong-counter": 7})
+        messenger.send_messages()
+        while True:
+            readable, _, _ = select.select([messenger.socket], [], [], 10)
+            self.assertTrue(readable, "timed out waiting for a reply")
+            for tid, message in messenger.read_messages():
+                return tid, dict(message)
+
+    def test_unix(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        url = "unix://" + os.path.join(directory.name, "socket")
+        self.serve(url)
+        self.assertEqual(self.ping(url), (1, {"cmd": "pong", "pingpong-counter": 8}))
+
+    def test_shm(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        url = "shm://" + os.path.join(directory.name, "socket")
+        self.serve(url)
+        self.assertEqual(self.ping(url), (1, {"cmd": "pong", "pingpong-counter": 8}))
+        self.assertEqual(self.ping(url), (1, {"cmd": "pong", "pingpong-counter": 8}))
+
+    def test_tcp_url_is_updated_with_port(self):
+        self.serve("tcp://127.0.0.1:0")
+        self.assertNotEqual(self.server.host_and_port[1], 0)
+        self.assertEqual(self.server.url, transports.tcp_url(self.server.host_and_port))
+        self.assertEqual(self.ping(self.server.url)[0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()